@@ -0,0 +1,191 @@
+"""
+Benchmarks of Zundler on documentation fixtures.
+
+Run them with `pytest benchmarks`. Each benchmark records the wall time, the
+peak RSS and the output size of one operation on one fixture. The results
+are written to `benchmarks/results.json` and compared with a baseline,
+`benchmarks/baseline.json` by default: a benchmark fails if it is slower,
+uses more memory or produces more output than the baseline plus a
+tolerance. Record a new baseline with `--save-baseline`. Timings and memory
+usage depend on the machine, so only compare baselines from the same one.
+
+The fixtures are the Sphinx projects in `tests/`. A project is benchmarked
+on its HTML output in `html/` or `_build/html/`. If there is none, it is
+built into a temporary directory if Sphinx is installed, or skipped
+otherwise. The scaling benchmarks use synthetic documentation instead, see
+`synthetic.py`, with the page counts given by `--pages`.
+
+"""
+
+import contextlib
+import json
+import platform
+import re
+import resource
+import sys
+from pathlib import Path
+
+import pytest
+
+from zundler.args import __version__
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+FIXTURE_DIR = BENCHMARK_DIR.parent / "tests"
+FIXTURES = sorted(path.parent.name for path in FIXTURE_DIR.glob("*/conf.py"))
+
+# The metrics compared with the baseline, and the options with their
+# tolerances
+METRICS = {
+    "time": "time_tolerance",
+    "peak_rss": "memory_tolerance",
+    "output_size": "size_tolerance",
+}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("zundler benchmarks")
+    group.addoption(
+        "--baseline",
+        default=str(BENCHMARK_DIR / "baseline.json"),
+        help="results to compare with (default: %(default)s)",
+    )
+    group.addoption(
+        "--save-baseline",
+        action="store_true",
+        default=False,
+        help="save the results as the new baseline instead of comparing with it",
+    )
+    group.addoption(
+        "--results",
+        default=str(BENCHMARK_DIR / "results.json"),
+        help="where to write the results (default: %(default)s)",
+    )
+    group.addoption(
+        "--pages",
+        default="100,1000",
+        help="comma-separated page counts of the synthetic documentation (default: %(default)s)",
+    )
+    group.addoption("--time-tolerance", type=float, default=0.25, help="allowed slowdown (default: %(default)s)")
+    group.addoption(
+        "--memory-tolerance", type=float, default=0.25, help="allowed growth of peak RSS (default: %(default)s)"
+    )
+    group.addoption("--size-tolerance", type=float, default=0.01, help="allowed output growth (default: %(default)s)")
+
+
+def pytest_configure(config):
+    config.zundler_results = {}
+
+
+def pytest_sessionfinish(session):
+    results = session.config.zundler_results
+    if not results:
+        return
+
+    report = {
+        "zundler": __version__,
+        "python": sys.version.split()[0],
+        "machine": platform.platform(),
+        "benchmarks": dict(sorted(results.items())),
+    }
+    paths = [session.config.getoption("results")]
+    if session.config.getoption("save_baseline"):
+        paths.append(session.config.getoption("baseline"))
+    for path in paths:
+        Path(path).write_text(json.dumps(report, indent=2) + "\n")
+
+
+def pytest_generate_tests(metafunc):
+    if "pages" in metafunc.fixturenames:
+        pages = [int(count) for count in metafunc.config.getoption("pages").split(",")]
+        metafunc.parametrize("pages", pages, scope="module")
+
+
+@pytest.fixture(scope="session")
+def baseline(pytestconfig):
+    path = Path(pytestconfig.getoption("baseline"))
+    if pytestconfig.getoption("save_baseline") or not path.exists():
+        return {}
+    return json.loads(path.read_text())["benchmarks"]
+
+
+@pytest.fixture(scope="session", params=FIXTURES)
+def documentation(request, tmp_path_factory):
+    """The directory of the HTML output of a fixture"""
+
+    source = FIXTURE_DIR / request.param
+    for html_dir in [source / "html", source / "_build" / "html"]:
+        if (html_dir / "index.html").exists():
+            return html_dir
+
+    try:
+        from sphinx.cmd.build import build_main
+    except ImportError:
+        pytest.skip(f"{request.param} is not built and Sphinx is not installed")
+
+    html_dir = tmp_path_factory.mktemp(request.param) / "html"
+    if build_main(["-q", "-b", "html", str(source), str(html_dir)]) != 0:
+        pytest.skip(f"Cannot build {request.param}")
+    return html_dir
+
+
+@pytest.fixture
+def measure(benchmark, baseline, request):
+    """Benchmark a function and compare the results with the baseline
+
+    `measure(func, *args, size=None, setup=None, **kwargs)` calls
+    `func(*args, **kwargs)` a few times and returns the last result.
+    `size(result)` returns the output size in bytes, and `setup()` is called
+    before each call.
+    """
+
+    def measure(func, *args, size=None, setup=None, **kwargs):
+        def prepare():
+            if setup:
+                setup()
+            return args, kwargs
+
+        _reset_peak_rss()
+        result = benchmark.pedantic(func, setup=prepare, rounds=request.config.getoption("benchmark_min_rounds"))
+
+        metrics = {
+            "time": benchmark.stats.stats.mean if benchmark.stats else None,
+            "peak_rss": _peak_rss(),
+            "output_size": size(result) if size else None,
+        }
+        benchmark.extra_info.update(metrics)
+        request.config.zundler_results[request.node.name] = metrics
+
+        failures = []
+        for metric, option in METRICS.items():
+            value = metrics[metric]
+            reference = baseline.get(request.node.name, {}).get(metric)
+            tolerance = request.config.getoption(option)
+            if value is not None and reference and value > reference * (1 + tolerance):
+                failures.append(
+                    f"{metric} is {value / reference - 1:.0%} above the baseline: "
+                    f"{value:.6g} > {reference:.6g} (tolerance {tolerance:.0%})"
+                )
+        if failures:
+            pytest.fail(f"Regression in {request.node.name}:\n" + "\n".join(failures))
+
+        return result
+
+    return measure
+
+
+def _reset_peak_rss():
+    # Linux can reset the peak RSS of a process
+    with contextlib.suppress(OSError):
+        Path("/proc/self/clear_refs").write_text("5")
+
+
+def _peak_rss():
+    """Return the peak RSS since the last reset in bytes"""
+    try:
+        status = Path("/proc/self/status").read_text()
+        return int(re.search(r"VmHWM:\s*(\d+) kB", status)[1]) * 1024
+    except (OSError, TypeError):
+        # Elsewhere, the peak of the whole process is the best we have. It is
+        # in kilobytes on Linux, but in bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
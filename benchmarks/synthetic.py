@@ -0,0 +1,254 @@
+"""
+Generate large Sphinx-like documentation for scaling benchmarks.
+
+The documentation fixtures in `tests/` are small, but problems show up with
+thousands of pages, big `_static` directories, long `@import` chains and
+lots of small images. `generate` writes an HTML tree resembling the output
+of Sphinx' HTML builder of any size:
+
+* Pages in nested directories, each with a navigation, a main section,
+  header links and a few images, plus `genindex.html`, `search.html`,
+  `searchindex.js` and the page sources in `_sources/`
+* A chain of style sheets in `_static/` importing each other, `css_depth`
+  levels deep, each referencing images and fonts with `url()`
+* Images in `_images/`, fonts and scripts in `_static/` and downloads in
+  `_downloads/`, a share of which are copies of other files, controlled by
+  `duplicate_ratio`
+
+The output only depends on the parameters, so results can be compared
+between runs. It can also be used as a script:
+
+    python benchmarks/synthetic.py OUTPUT_DIR --pages 10000
+
+"""
+
+import argparse
+import json
+import random
+import struct
+import zlib
+from pathlib import Path
+
+PAGES_PER_DIRECTORY = 100
+
+
+def generate(
+    output_dir,
+    pages=100,
+    images=50,
+    fonts=4,
+    scripts=4,
+    downloads=0,
+    download_size=1 << 20,
+    css_depth=3,
+    duplicate_ratio=0.1,
+    seed=0,
+):
+    """Write synthetic documentation to `output_dir` and return the path of its root document
+
+    `pages` is the number of pages besides the index, `images`, `fonts`,
+    `scripts` and `downloads` the number of assets of each kind. Downloads
+    have `download_size` bytes each. `css_depth` is the length of the
+    `@import` chain, and `duplicate_ratio` the share of assets that are
+    copies of an earlier asset of the same kind.
+    """
+
+    rng = random.Random(seed)
+    output_dir = Path(output_dir)
+
+    image_names = _write_assets(
+        output_dir / "_images",
+        [(f"image{i:05}.png", lambda: _png(rng, rng.randint(8, 48), rng.randint(8, 48))) for i in range(images)],
+        duplicate_ratio,
+        rng,
+    )
+    font_names = _write_assets(
+        output_dir / "_static" / "fonts",
+        [(f"font{i:03}.woff2", lambda: rng.randbytes(rng.randint(10_000, 60_000))) for i in range(fonts)],
+        duplicate_ratio,
+        rng,
+    )
+    script_names = _write_assets(
+        output_dir / "_static",
+        [(f"script{i:03}.js", lambda: _script(rng)) for i in range(scripts)],
+        duplicate_ratio,
+        rng,
+    )
+    download_names = _write_assets(
+        output_dir / "_downloads",
+        [(f"download{i:04}.bin", lambda: rng.randbytes(download_size)) for i in range(downloads)],
+        duplicate_ratio,
+        rng,
+    )
+    _write_style_sheets(output_dir / "_static", css_depth, image_names, font_names, rng)
+
+    docnames = [f"section{i // PAGES_PER_DIRECTORY:03}/page{i:05}" for i in range(pages)]
+    titles = [_words(rng, 3).title() for _ in docnames]
+    for i, docname in enumerate(docnames):
+        neighbours = [docnames[i - 1] if i else "index", docnames[i + 1] if i + 1 < pages else "index"]
+        page_images = [f"_images/{rng.choice(image_names)}" for _ in range(min(len(image_names), 3))]
+        page_downloads = [f"_downloads/{rng.choice(download_names)}"] if download_names and rng.random() < 0.1 else []
+        text = "".join(f"<p>{_words(rng, rng.randint(20, 80))}.</p>\n" for _ in range(rng.randint(2, 8)))
+        _write_page(
+            output_dir,
+            docname,
+            titles[i],
+            text,
+            links=neighbours,
+            images=page_images,
+            downloads=page_downloads,
+            scripts=script_names,
+        )
+        _write(output_dir / "_sources" / f"{docname}.rst.txt", f"{titles[i]}\n{'=' * len(titles[i])}\n")
+
+    toc = "".join(
+        f'<li class="toctree-l1"><a class="reference internal" href="{docname}.html">{title}</a></li>\n'
+        for docname, title in zip(docnames, titles, strict=True)
+    )
+    _write_page(output_dir, "index", "Synthetic Documentation", f"<ul>\n{toc}</ul>\n", scripts=script_names)
+    _write_page(output_dir, "genindex", "Index", "", scripts=script_names)
+    _write_page(output_dir, "search", "Search", "", scripts=[*script_names, "searchtools.js"])
+    _write(output_dir / "_static" / "searchtools.js", "/* search tools */\n")
+    _write(output_dir / "_static" / "doctools.js", "/* doc tools */\n")
+    _write(output_dir / "_static" / "documentation_options.js", "const DOCUMENTATION_OPTIONS = {};\n")
+
+    index = {
+        "docnames": ["index", *docnames],
+        "filenames": [f"{docname}.rst" for docname in ["index", *docnames]],
+        "titles": ["Synthetic Documentation", *titles],
+        "terms": {},
+        "objects": {},
+    }
+    _write(output_dir / "searchindex.js", f"Search.setIndex({json.dumps(index)})")
+
+    return output_dir / "index.html"
+
+
+def _write_assets(directory, assets, duplicate_ratio, rng):
+    """Write assets, each a `(name, generate)` pair, and return their names
+
+    Some assets are copies of earlier ones instead of calling `generate`.
+    """
+
+    written = []
+    for name, generate_asset in assets:
+        data = written[rng.randrange(len(written))][1] if written and rng.random() < duplicate_ratio else None
+        if data is None:
+            data = generate_asset()
+        _write(directory / name, data)
+        written.append((name, data))
+    return [name for name, _ in written]
+
+
+def _write_style_sheets(static_dir, depth, image_names, font_names, rng):
+    """Write `basic.css`, which imports a chain of `depth` style sheets"""
+
+    for level in reversed(range(depth + 1)):
+        name = "basic.css" if level == 0 else f"level{level:02}.css"
+        rules = [f'@import url("level{level + 1:02}.css");\n'] if level < depth else []
+        for font in font_names[level :: depth + 1]:
+            rules.append(f'@font-face {{ font-family: "{font[:-6]}"; src: url("fonts/{font}") format("woff2"); }}\n')
+        for i, image in enumerate(image_names[level :: depth + 1][:20]):
+            rules.append(f".icon-{level}-{i} {{ background: url(../_images/{image}) no-repeat; }}\n")
+        for i in range(rng.randint(20, 100)):
+            rules.append(f".rule-{level}-{i} {{ margin: {rng.randint(0, 20)}px; color: #{rng.randbytes(3).hex()}; }}\n")
+        _write(static_dir / name, "".join(rules))
+
+
+def _write_page(output_dir, docname, title, text, links=(), images=(), downloads=(), scripts=()):
+    root = "../" * docname.count("/")
+    head = "".join(f'<script src="{root}_static/{script}"></script>\n' for script in scripts)
+    nav = "".join(f'<a href="{root}{link}.html">{link}</a>\n' for link in links)
+    body = "".join(f'<img alt="" src="{root}{image}" />\n' for image in images)
+    body += "".join(f'<a class="reference download" href="{root}{download}">Download</a>\n' for download in downloads)
+    _write(
+        output_dir / f"{docname}.html",
+        f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8" />
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="{root}_static/basic.css" />
+<script src="{root}_static/documentation_options.js"></script>
+<script src="{root}_static/doctools.js"></script>
+{head}</head>
+<body>
+<nav>
+<a href="{root}index.html">Home</a>
+<a href="{root}genindex.html">Index</a>
+<a href="{root}search.html">Search</a>
+{nav}</nav>
+<div class="body" role="main">
+<section id="{docname.rsplit("/")[-1]}">
+<h1>{title}<a class="headerlink" href="#{docname.rsplit("/")[-1]}" title="Link to this heading">¶</a></h1>
+{text}{body}</section>
+</div>
+</body>
+</html>
+""",
+    )
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        path.write_text(data, encoding="utf-8")
+    else:
+        path.write_bytes(data)
+
+
+WORDS = ["the", "of", "a", "is", "to", "data", "file", "page", "module", "function", "class", "method", "value"]
+WORDS += ["option", "default", "example", "section", "image", "style", "sheet", "document", "returns", "can"]
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _script(rng):
+    functions = "".join(
+        f"function f{i}(x) {{\n  return x * {rng.randint(1, 100)} + {rng.randint(0, 100)};\n}}\n"
+        for i in range(rng.randint(50, 300))
+    )
+    return f"/* {_words(rng, 10)} */\n{functions}"
+
+
+def _png(rng, width, height):
+    """Return a noisy RGB PNG image"""
+
+    rows = b"".join(b"\0" + rng.randbytes(3 * width) for _ in range(height))
+
+    def chunk(chunk_type, body):
+        return struct.pack(">I4s", len(body), chunk_type) + body + struct.pack(">I", zlib.crc32(chunk_type + body))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Sphinx-like documentation")
+    parser.add_argument("output_dir", help="where to write the documentation")
+    parser.add_argument("--pages", type=int, default=100, help="number of pages (default: %(default)s)")
+    parser.add_argument("--images", type=int, default=50, help="number of images (default: %(default)s)")
+    parser.add_argument("--fonts", type=int, default=4, help="number of fonts (default: %(default)s)")
+    parser.add_argument("--scripts", type=int, default=4, help="number of scripts (default: %(default)s)")
+    parser.add_argument("--downloads", type=int, default=0, help="number of downloads (default: %(default)s)")
+    parser.add_argument(
+        "--download-size", type=int, default=1 << 20, help="size of each download in bytes (default: %(default)s)"
+    )
+    parser.add_argument("--css-depth", type=int, default=3, help="length of the @import chain (default: %(default)s)")
+    parser.add_argument(
+        "--duplicate-ratio", type=float, default=0.1, help="share of assets that are copies (default: %(default)s)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator (default: %(default)s)")
+    args = parser.parse_args()
+
+    print(generate(**vars(args)))
+
+
+if __name__ == "__main__":
+    main()
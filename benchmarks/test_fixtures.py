@@ -0,0 +1,65 @@
+"""Benchmarks of the main stages of bundling on the documentation fixtures."""
+
+import json
+import shutil
+
+import pytest
+
+from zundler.embed import deflate, embed_assets, embed_css_resources, extract_assets, load_filetree
+
+
+def _tree_size(path):
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def test_load_filetree(documentation, measure):
+    measure(
+        load_filetree,
+        documentation,
+        size=lambda file_tree: sum(len(entry["data"]) for entry in file_tree.values()),
+    )
+
+
+def test_embed_css_resources(documentation, measure):
+    style_sheets = [(path.read_bytes(), path.as_posix()) for path in sorted(documentation.rglob("*.css"))]
+    if not style_sheets:
+        pytest.skip("No style sheets")
+
+    def embed_all():
+        # Without a shared graph, like the style sheets of separate bundles
+        return [embed_css_resources(css, filename) for css, filename in style_sheets]
+
+    measure(embed_all, size=lambda results: sum(map(len, results)))
+
+
+def test_deflate(documentation, measure):
+    data = json.dumps(load_filetree(documentation))
+    measure(deflate, data, size=len)
+
+
+def test_embed_assets(documentation, measure, tmp_path):
+    output = tmp_path / "bundle.html"
+    measure(
+        embed_assets,
+        documentation / "index.html",
+        output_path=output,
+        size=lambda _: output.stat().st_size,
+    )
+
+
+def test_extract_assets(documentation, measure, tmp_path):
+    bundle = tmp_path / "bundle.html"
+    embed_assets(documentation / "index.html", output_path=bundle)
+    output = tmp_path / "extracted"
+
+    def clean():
+        shutil.rmtree(output, ignore_errors=True)
+        output.mkdir()
+
+    measure(
+        extract_assets,
+        bundle,
+        output_path=output,
+        setup=clean,
+        size=lambda _: _tree_size(output),
+    )
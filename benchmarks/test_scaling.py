@@ -0,0 +1,37 @@
+"""Benchmarks of bundling synthetic documentation of growing size."""
+
+import pytest
+from synthetic import generate
+
+from zundler.embed import embed_assets
+
+
+@pytest.fixture(scope="module")
+def synthetic_documentation(pages, tmp_path_factory):
+    """Synthetic documentation with `pages` pages and assets in proportion"""
+
+    return generate(
+        tmp_path_factory.mktemp(f"synthetic-{pages}"),
+        pages=pages,
+        images=pages // 2,
+        fonts=4 + pages // 1000,
+        scripts=4 + pages // 1000,
+        downloads=pages // 100,
+        css_depth=3 + pages // 1000,
+    )
+
+
+def test_embed_assets(synthetic_documentation, measure, tmp_path):
+    output = tmp_path / "bundle.html"
+    measure(embed_assets, synthetic_documentation, output_path=output, size=lambda _: output.stat().st_size)
+
+
+def test_embed_assets_tree_shake(synthetic_documentation, measure, tmp_path):
+    output = tmp_path / "bundle.html"
+    measure(
+        embed_assets,
+        synthetic_documentation,
+        output_path=output,
+        tree_shake=True,
+        size=lambda _: output.stat().st_size,
+    )
@@ -0,0 +1,55 @@
+/*
+ * Benchmark the base64 decoders of the browser runtime.
+ *
+ * Run with `deno task bench`. The decoders are taken from the emitted
+ * `zundler_common.js`, so run `deno task build` first after changing the
+ * TypeScript sources. The baseline is the `atob` and `charCodeAt` loop that
+ * the runtime used before.
+ */
+
+const COMMON_JS = new URL(
+	"../src/zundler/assets/zundler_common.js",
+	import.meta.url,
+);
+
+type Decoder = (base64: string) => Uint8Array;
+
+// zundler_common.js is a plain script. Evaluate it with a CommonJS shim, like
+// the Node unit tests do, to get hold of its helpers.
+const module = { exports: {} as Record<string, Decoder> };
+new Function("module", await Deno.readTextFile(COMMON_JS))(module);
+const { decodeBase64, _decodeBase64WithTable } = module.exports;
+
+const SIZE = 16 * 1024 * 1024;
+const bytes = new Uint8Array(SIZE);
+for (let i = 0; i < SIZE; i += 65536) {
+	crypto.getRandomValues(bytes.subarray(i, i + 65536));
+}
+let base64 = "";
+for (let i = 0; i < SIZE; i += 3 * 8192) {
+	base64 += btoa(String.fromCharCode(...bytes.subarray(i, i + 3 * 8192)));
+}
+
+const decodeWithLoop: Decoder = (base64) => {
+	const binaryString = atob(base64);
+	const result = new Uint8Array(binaryString.length);
+	for (let i = 0; i < binaryString.length; i++) {
+		result[i] = binaryString.charCodeAt(i);
+	}
+	return result;
+};
+
+Deno.bench("atob and charCodeAt loop", {
+	group: "decode 16 MiB",
+	baseline: true,
+}, () => {
+	decodeWithLoop(base64);
+});
+
+Deno.bench("lookup table", { group: "decode 16 MiB" }, () => {
+	_decodeBase64WithTable(base64);
+});
+
+Deno.bench("decodeBase64", { group: "decode 16 MiB" }, () => {
+	decodeBase64(base64);
+});
@@ -1,7 +1,18 @@
 def main():
-    from .args import parse_args
+    from .args import parse_args, parser
 
     args = parse_args()
+    batch = args.manifest or len(args.input_path) > 1
+    if not args.input_path and not args.manifest:
+        parser.error("the following arguments are required: input_path")
+    if batch and (args.extract or args.list):
+        parser.error("only one bundle can be extracted at a time")
+    if (args.include or args.exclude) and not (args.extract or args.list):
+        parser.error("--include and --exclude require -x/--extract or --list")
+    if batch and args.output_path:
+        parser.error("-o/--output-path cannot be used with several inputs")
+    if batch and (args.stats or args.report):
+        parser.error("--stats and --report cannot be used with several inputs")
 
     import logging
 
@@ -10,21 +21,70 @@ def main():
     else:
         logging.getLogger("zundler").setLevel("INFO")
 
-    from .embed import embed_assets, extract_assets
+    from .embed import embed_assets, extract_assets, list_assets
 
-    if args.extract:
+    if args.list:
+        for path, size in list_assets(args.input_path[0], include=args.include, exclude=args.exclude):
+            print(f"{size:>12}  {path}")
+    elif args.extract:
         extract_assets(
-            args.input_path,
+            args.input_path[0],
             output_path=args.output_path,
+            include=args.include,
+            exclude=args.exclude,
         )
+    elif batch:
+        import sys
+
+        from .batch import embed_batch, load_manifest
+
+        bundles = [(path, None) for path in args.input_path]
+        if args.manifest:
+            bundles += load_manifest(args.manifest)
+        failed = embed_batch(
+            bundles,
+            append_pre=args.append_pre,
+            append_post=args.append_post,
+            debug=args.debug,
+            jobs=args.jobs,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size * 1024 * 1024,
+            archive=args.archive,
+            prerender=args.prerender,
+            minify=args.minify,
+            optimize_images=args.optimize_images,
+            tree_shake=args.tree_shake,
+            keep=args.keep,
+            accelerate_search=args.accelerate_search,
+        )
+        if failed:
+            sys.exit(1)
     else:
+        from .report import BuildReport
+
+        report = BuildReport() if args.stats or args.report else None
         embed_assets(
-            args.input_path,
+            args.input_path[0],
             output_path=args.output_path,
             append_pre=args.append_pre,
             append_post=args.append_post,
             debug=args.debug,
+            jobs=args.jobs,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size * 1024 * 1024,
+            archive=args.archive,
+            prerender=args.prerender,
+            minify=args.minify,
+            optimize_images=args.optimize_images,
+            tree_shake=args.tree_shake,
+            keep=args.keep,
+            accelerate_search=args.accelerate_search,
+            report=report,
         )
+        if args.report:
+            report.write(args.report)
+        if args.stats:
+            print(report.summary())
 
 
 if __name__ == "__main__":
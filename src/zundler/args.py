@@ -42,6 +42,29 @@ parser.add_argument(
     help='extract files from a Zundler file (output_path must be a directory; "." by default)',
 )
 
+parser.add_argument(
+    "--list",
+    default=False,
+    action="store_true",
+    help="print the paths and sizes of the files in a Zundler file instead of extracting them",
+)
+
+parser.add_argument(
+    "--include",
+    default=[],
+    action="append",
+    metavar="PATTERN",
+    help="with -x or --list, only select files whose relative path matches this glob pattern (can be repeated)",
+)
+
+parser.add_argument(
+    "--exclude",
+    default=[],
+    action="append",
+    metavar="PATTERN",
+    help="with -x or --list, skip files whose relative path matches this glob pattern (can be repeated)",
+)
+
 parser.add_argument(
     "-P",
     "--append-pre",
@@ -58,9 +81,112 @@ parser.add_argument(
 )
 
 
+parser.add_argument(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    help="number of files to prepare in parallel (default: %(default)s)",
+)
+
+
+parser.add_argument(
+    "--cache-dir",
+    help="directory of a cache of prepared files that speeds up re-bundling",
+)
+
+
+parser.add_argument(
+    "--cache-size",
+    default=1024,
+    type=int,
+    help="maximum size of the cache in MiB (default: %(default)s)",
+)
+
+
+parser.add_argument(
+    "--archive",
+    default=False,
+    action="store_true",
+    help="compress each file separately so the browser only inflates the files it needs",
+)
+
+
+parser.add_argument(
+    "--prerender",
+    default=False,
+    action="store_true",
+    help="rewrite HTML pages when bundling instead of in the browser",
+)
+
+
+parser.add_argument(
+    "--minify",
+    default=False,
+    action="store_true",
+    help="strip comments and whitespace from HTML, CSS and JavaScript files (skips *.min.* files)",
+)
+
+
+parser.add_argument(
+    "--optimize-images",
+    default=False,
+    action="store_true",
+    help="losslessly recompress PNG, JPEG and GIF images and strip their metadata (better with Pillow)",
+)
+
+
+parser.add_argument(
+    "--tree-shake",
+    default=False,
+    action="store_true",
+    help="only pack files that are reachable from the input file",
+)
+
+
+parser.add_argument(
+    "--keep",
+    default=[],
+    action="append",
+    metavar="PATTERN",
+    help="with --tree-shake, also pack files whose relative path matches this glob pattern (can be repeated)",
+)
+
+
+parser.add_argument(
+    "--accelerate-search",
+    default=False,
+    action="store_true",
+    help="parse the Sphinx search index only once and prepare search result summaries when bundling",
+)
+
+
+parser.add_argument(
+    "--stats",
+    default=False,
+    action="store_true",
+    help="print the time spent in each stage and the heaviest files and directories",
+)
+
+
+parser.add_argument(
+    "--report",
+    metavar="FILE",
+    help="write timings and the size of each file as JSON to this file",
+)
+
+
+parser.add_argument(
+    "--manifest",
+    metavar="FILE",
+    help="bundle the documents listed in this JSON file, a list of objects with an input and optionally an output path",
+)
+
+
 parser.add_argument(
     "input_path",
-    help="input path to the root HTML file",
+    nargs="*",
+    help="input path to the root HTML file; give several to bundle them in one run, each next to its input",
 )
 
 parser.add_argument(
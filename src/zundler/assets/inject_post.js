@@ -55,14 +55,28 @@ const monkeyPatch = ()=>{
 	 * Monkey patch jQuery.ajax
 	 * Only settings.url and settings.complete are supported for virtual
 	 * URLs.
+	 *
+	 * Older versions of Sphinx' search page fetch the pages in the results
+	 * this way, so they get the page summaries as well, see `window.fetch` in
+	 * `inject_pre`. Their `Search.htmlToText` only finds descendants of the
+	 * parsed elements, so the summary is wrapped in one more element.
 	 */ jQuery._ajax = jQuery.ajax;
   jQuery.ajax = (settings)=>{
     const url = normalizePath(settings.url);
     if (isVirtual(url)) {
-      retrieveFile(url, (file)=>{
-        settings.complete({
-          responseText: file.data
-        }, "");
+      const summary = window.globalContext.summaries && typeof Search !== "undefined" ? getPageSummary(url) : Promise.resolve(undefined);
+      summary.then((summary)=>{
+        if (summary !== undefined) {
+          settings.complete({
+            responseText: `<div>${summary}</div>`
+          }, "");
+        } else {
+          retrieveFile(url, (file)=>{
+            settings.complete({
+              responseText: file.data
+            }, "");
+          });
+        }
       });
       return; // Return value not actually needed in searchtools.js
     }
@@ -70,6 +84,12 @@ const monkeyPatch = ()=>{
   };
 };
 monkeyPatch();
+// Everything before this script is the page itself: parsing it and running
+// its scripts
+performance.measure(`${PERFORMANCE_PREFIX}scripts`, {
+  start: 0,
+  end: performance.now()
+});
 // Set up message listener
 window.addEventListener("message", (evnt)=>{
   if (DEBUG) console.log("Received message in iframe", evnt.data);
@@ -78,7 +98,10 @@ window.addEventListener("message", (evnt)=>{
   }
 }, false);
 window.parent.postMessage({
-  action: "ready"
+  action: "ready",
+  argument: {
+    path: window.globalContext.current_path
+  }
 }, "*");
 document.addEventListener("keyup", (event)=>{
   if (event.key === "Z" && event.ctrlKey) {
@@ -90,9 +113,30 @@ document.addEventListener("keyup", (event)=>{
 document.addEventListener("DOMContentLoaded", (event)=>{
   // Look for fixable nodes because scripts may have altered the DOM with
   // document.write()
-  embedJs(document);
-  embedCss(document);
-  embedImgs(document);
-  fixLinks(document);
-  fixForms(document);
+  timeStage("fixups", ()=>{
+    const embedded = Promise.all([
+      embedJs(document),
+      embedCss(document),
+      embedImgs(document)
+    ]);
+    fixLinks(document);
+    fixForms(document);
+    return embedded;
+  });
+});
+window.addEventListener("load", (event)=>{
+  // Report the timings of this page to the parent document, which shows
+  // them in the popup
+  performance.measure(`${PERFORMANCE_PREFIX}load`, {
+    start: 0,
+    end: performance.now()
+  });
+  window.parent.postMessage({
+    action: "performance",
+    argument: {
+      path: window.globalContext.current_path,
+      timeOrigin: performance.timeOrigin,
+      entries: performanceEntries()
+    }
+  }, "*");
 });
@@ -46,13 +46,20 @@ window.fetch = async (...args)=>{
   const [resource, config] = args;
   const path = normalizePath(resource);
   let response;
-  if (isVirtual(path)) {
+  // Sphinx' search page fetches the pages in the results only to extract
+  // their text, which may have been done when the bundle was built. The
+  // summary keeps the elements with ids, which `Search.htmlToText` looks
+  // up by the anchor of a result.
+  const summary = window.globalContext.summaries && isVirtual(path) && typeof Search !== "undefined" ? await getPageSummary(path) : undefined;
+  if (summary !== undefined) {
+    response = new Response(summary, {
+      headers: {
+        "content-type": "text/html"
+      }
+    });
+  } else if (isVirtual(path)) {
     const file = await waitForParentResponse(path);
-    let data = file.data;
-    if (file.base64encoded) {
-      data = _base64ToArrayBuffer(data);
-    }
-    response = new Response(data);
+    response = new Response(fileToBlob(file));
     response.headers.set("content-type", file.mime_type);
   } else {
     response = await originalFetch(resource, config);
@@ -60,18 +67,15 @@ window.fetch = async (...args)=>{
   return response;
 };
 const embedImgFromParent = (img)=>{
-  function setSrc(img, file) {
-    if (file.mime_type === "image/svg+xml") {
-      img.setAttribute("src", `data:image/svg+xml;charset=utf-8;base64, ${btoa(file.data)}`);
-    } else {
-      img.setAttribute("src", `data:${file.mime_type};base64, ${file.data}`);
-    }
-  }
   if (img.hasAttribute("src")) {
     const src = img.getAttribute("src");
     if (isVirtual(src)) {
       const path = normalizePath(src);
-      retrieveFile(path, (file)=>setSrc(img, file));
+      getFileUrl(path).then((url)=>{
+        if (url) {
+          img.setAttribute("src", url);
+        }
+      });
     }
   }
 };
@@ -1,16 +1,108 @@
 /*
  * Functions that will be needed by several files
- */ const _base64ToArrayBuffer = (base64)=>{
+ */ // Upper bound for the total size of decoded archive entries kept in memory,
+// in characters of text files and bytes of binary files
+const ARCHIVE_CACHE_SIZE = 64 * 1024 * 1024;
+class LruCache {
+  maxSize;
+  sizeOf;
+  onEvict;
+  isPinned;
+  // A map that evicts the least recently used entries once the total size
+  // of its values exceeds `maxSize`. A Map iterates in insertion order, so
+  // re-inserting an entry on each use keeps the least recently used one
+  // first. Entries for which `isPinned` is true are never evicted.
+  entries;
+  size;
+  constructor(maxSize, sizeOf, onEvict, isPinned){
+    this.maxSize = maxSize;
+    this.sizeOf = sizeOf;
+    this.onEvict = onEvict;
+    this.isPinned = isPinned;
+    this.entries = new Map();
+    this.size = 0;
+  }
+  get(key) {
+    const value = this.entries.get(key);
+    if (value !== undefined) {
+      this.entries.delete(key);
+      this.entries.set(key, value);
+    }
+    return value;
+  }
+  set(key, value) {
+    const old = this.entries.get(key);
+    if (old !== undefined) {
+      this.entries.delete(key);
+      this.size -= this.sizeOf(old);
+    }
+    this.entries.set(key, value);
+    this.size += this.sizeOf(value);
+    for (const [oldKey, oldValue] of this.entries){
+      if (this.size <= this.maxSize) {
+        break;
+      }
+      if (oldKey === key || this.isPinned?.(oldKey, oldValue)) {
+        continue;
+      }
+      this.entries.delete(oldKey);
+      this.size -= this.sizeOf(oldValue);
+      this.onEvict?.(oldKey, oldValue);
+    }
+  }
+}
+const archiveCache = new LruCache(ARCHIVE_CACHE_SIZE, (data)=>data.length);
+// Maps the character codes of the base64 alphabet to their six-bit values
+const BASE64_TABLE = (()=>{
+  const alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+  const table = new Uint8Array(256);
+  for(let i = 0; i < alphabet.length; i++){
+    table[alphabet.charCodeAt(i)] = i;
+  }
+  return table;
+})();
+const _decodeBase64WithTable = (base64)=>{
+  // Convert the string to ASCII bytes in one native call, then decode four
+  // characters at a time with a lookup table. This avoids `atob` and a
+  // `charCodeAt` call per byte.
+  const chars = new TextEncoder().encode(base64);
+  let length = chars.length;
+  while(length > 0 && chars[length - 1] === 61 /* = */ ){
+    length--;
+  }
+  const bytes = new Uint8Array(length * 3 >> 2);
+  const end = length - length % 4;
+  let i = 0;
+  let j = 0;
+  for(; i < end; i += 4){
+    const n = BASE64_TABLE[chars[i]] << 18 | BASE64_TABLE[chars[i + 1]] << 12 | BASE64_TABLE[chars[i + 2]] << 6 | BASE64_TABLE[chars[i + 3]];
+    bytes[j++] = n >> 16;
+    bytes[j++] = n >> 8 & 255;
+    bytes[j++] = n & 255;
+  }
+  if (length - end >= 2) {
+    const n = BASE64_TABLE[chars[i]] << 18 | BASE64_TABLE[chars[i + 1]] << 12 | BASE64_TABLE[chars[i + 2]] << 6;
+    bytes[j++] = n >> 16;
+    if (length - end === 3) {
+      bytes[j++] = n >> 8 & 255;
+    }
+  }
+  return bytes;
+};
+const decodeBase64 = (base64)=>{
+  // Decode base64 with the fastest method available. Recent browsers
+  // implement `Uint8Array.fromBase64` natively.
+  const native = Uint8Array;
+  if (native.fromBase64) {
+    return native.fromBase64(base64);
+  }
+  return _decodeBase64WithTable(base64);
+};
+const _base64ToArrayBuffer = (base64)=>{
   if (!base64) {
     return [];
   }
-  const binary_string = window.atob(base64);
-  const len = binary_string.length;
-  const bytes = new Uint8Array(len);
-  for(let i = 0; i < len; i++){
-    bytes[i] = binary_string.charCodeAt(i);
-  }
-  return bytes.buffer;
+  return decodeBase64(base64).buffer;
 };
 const isVirtual = (url)=>{
   // Return true if the url should be retrieved from the virtual file tree.
@@ -36,39 +128,283 @@ const splitUrl = (url)=>{
   if (DEBUG) console.log("Split URL", url, result);
   return result;
 };
-const retrieveFileFromFileTree = (path, callback)=>{
-  if (DEBUG) console.log("Retrieving file: " + path);
-  const fileTree = window.globalContext.fileTree;
-  const file = fileTree[path];
-  if (!file) {
-    console.warn(`File not found: ${path}`);
-  } else {
-    callback(file);
+const inflate = async (bytes)=>{
+  const stream = new Blob([
+    bytes
+  ]).stream().pipeThrough(new DecompressionStream("deflate"));
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+};
+const readArchive = (offset, length)=>{
+  // The archive is one base64 string. Every three bytes are encoded as four
+  // characters, so a byte range can be decoded on its own from the
+  // enclosing groups of characters.
+  const archive = window.zundlerArchive;
+  const start = Math.floor(offset / 3) * 4;
+  const end = Math.min(archive.length, Math.ceil((offset + length) / 3) * 4);
+  const bytes = decodeBase64(archive.slice(start, end));
+  const skip = offset % 3;
+  return bytes.subarray(skip, skip + length);
+};
+const readArchiveEntry = async (entry, binary)=>{
+  // Read a file from the archive. Text files are decoded to strings, binary
+  // files are returned as bytes. Recently used files are kept in a bounded
+  // cache.
+  const offset = entry.offset;
+  let data = archiveCache.get(offset);
+  if (data === undefined) {
+    let bytes = readArchive(offset, entry.length);
+    if (entry.method === "deflate") {
+      bytes = await inflate(bytes);
+    }
+    data = binary ? bytes : new TextDecoder().decode(bytes);
+    archiveCache.set(offset, data);
   }
+  return data;
 };
-const retrieveFileFromParent = (path, callback)=>{
-  // Get the file into the iframe by messaging the parent document
+const lookupFile = async (path)=>{
+  // Resolve a path in the virtual file tree to the file's contents. Each
+  // unique content is stored once, so several paths may share a blob. In
+  // archive mode, the contents are inflated on demand.
+  const entry = window.globalContext.fileTree[path];
+  if (!entry) {
+    return undefined;
+  }
+  if (entry.blob === undefined) {
+    return {
+      ...entry,
+      data: await readArchiveEntry(entry, entry.base64encoded)
+    };
+  }
+  return {
+    ...entry,
+    data: window.globalContext.blobs[entry.blob]
+  };
+};
+const fileToBlob = (file)=>{
+  // Binary files are raw bytes in archive mode and base64-encoded otherwise
+  let data = file.data;
+  if (typeof file.data === "string" && file.base64encoded) {
+    data = _base64ToArrayBuffer(file.data);
+  }
+  return new Blob([
+    data
+  ], {
+    type: file.mime_type
+  });
+};
+// The connection of an iframe to the parent document, see
+// `requestFromParent`
+let parentPort;
+let nextRequestId = 0;
+let requestBatch = [];
+const pendingRequests = new Map();
+const pendingReplies = new Map();
+const connectToParent = ()=>{
+  // Open a dedicated channel to the parent document. Its replies carry the
+  // ids of the requests they answer.
+  if (!parentPort) {
+    const channel = new MessageChannel();
+    parentPort = channel.port1;
+    parentPort.onmessage = (event)=>{
+      const replies = event.data.argument.files;
+      for (const reply of replies){
+        pendingRequests.get(reply.id)(reply);
+        pendingRequests.delete(reply.id);
+      }
+    };
+    window.parent.postMessage({
+      action: "connect"
+    }, "*", [
+      channel.port2
+    ]);
+  }
+  return parentPort;
+};
+const sendRequestBatch = ()=>{
+  connectToParent().postMessage({
+    action: "retrieveFiles",
+    argument: {
+      requests: requestBatch
+    }
+  });
+  requestBatch = [];
+};
+const requestFromParent = (path, kind = "file")=>{
+  // Ask the parent document for a file, or for something derived from it,
+  // e.g. its object URL. All requests made in the same task are sent as one
+  // batch, and concurrent requests for the same thing share one reply.
   if (DEBUG) console.log("Retrieving file from parent: " + path);
-  function messageHandler(event) {
-    if (event.data.action === "sendFile" && event.data.argument.path === path) {
-      callback(event.data.argument.file);
-      window.removeEventListener("message", messageHandler);
+  const key = `${kind}:${path}`;
+  let reply = pendingReplies.get(key);
+  if (!reply) {
+    reply = new Promise((resolve)=>{
+      const id = nextRequestId++;
+      pendingRequests.set(id, resolve);
+      if (requestBatch.length === 0) {
+        queueMicrotask(sendRequestBatch);
+      }
+      requestBatch.push(kind === "file" ? {
+        id,
+        path
+      } : {
+        id,
+        path,
+        [kind]: true
+      });
+    });
+    pendingReplies.set(key, reply);
+    reply.then(()=>pendingReplies.delete(key));
+  }
+  return reply;
+};
+const getFile = (path)=>{
+  // Resolve a path to the file's contents. The parent document looks it up
+  // in the file tree, the iframe asks the parent document. Resolves to
+  // undefined if the file does not exist.
+  const file = window.globalContext.fileTree ? lookupFile(path) : requestFromParent(path).then((reply)=>reply.file);
+  return file.then((file)=>{
+    if (!file) {
+      console.warn(`File not found: ${path}`);
     }
+    return file;
+  });
+};
+// Upper bound for the total size of the files behind shared object URLs, in
+// bytes
+const OBJECT_URL_CACHE_SIZE = 64 * 1024 * 1024;
+// Object URLs are owned by the parent document and shared by all pages.
+// They are revoked when they are evicted. The URLs handed out for the
+// current page are pinned until the next navigation, since the page may
+// still load them, e.g. lazy images, late style sheet resources or another
+// `srcset` candidate.
+const objectUrls = new LruCache(OBJECT_URL_CACHE_SIZE, (entry)=>entry.size, (path, entry)=>{
+  URL.revokeObjectURL(entry.url);
+  objectUrlPaths.delete(entry.url);
+}, (path)=>pinnedObjectUrls.has(path));
+const objectUrlPaths = new Map();
+const pinnedObjectUrls = new Set();
+const getFileUrl = async (path)=>{
+  // Return an object URL of a file, e.g. for the source of an image. The
+  // iframe asks the parent document, so the same URL is reused across
+  // navigations instead of encoding the file again for each page.
+  if (!window.globalContext.fileTree) {
+    return (await requestFromParent(path, "url")).url;
   }
-  window.addEventListener("message", messageHandler);
-  window.parent.postMessage({
-    action: "retrieveFile",
-    argument: {
-      path: path
+  pinnedObjectUrls.add(path);
+  let entry = objectUrls.get(path);
+  if (entry === undefined) {
+    const file = await getFile(path);
+    if (!file) {
+      return undefined;
+    }
+    // Another call may have created the URL in the meantime
+    entry = objectUrls.get(path);
+    if (entry === undefined) {
+      const blob = fileToBlob(file);
+      entry = {
+        url: URL.createObjectURL(blob),
+        size: blob.size
+      };
+      objectUrls.set(path, entry);
+      objectUrlPaths.set(entry.url, path);
     }
-  }, "*");
+  }
+  return entry.url;
 };
-const retrieveFile = (path, callback)=>{
+const retainObjectUrls = (urls)=>{
+  // Check whether the object URLs handed out by `getFileUrl` are all still
+  // valid, and if so, pin them for the current page
+  const paths = urls.map((url)=>objectUrlPaths.get(url));
+  if (!paths.every((path)=>path !== undefined && objectUrls.get(path))) {
+    return false;
+  }
+  for (const path of paths){
+    pinnedObjectUrls.add(path);
+  }
+  return true;
+};
+const unpinObjectUrls = ()=>{
+  // Let the object URLs of the previous page be evicted, on navigation
+  pinnedObjectUrls.clear();
+};
+// Must match `SEARCH_INDEX_PATTERN` in `zundler.search`
+const SEARCH_INDEX_PATTERN = /^\s*Search\.setIndex\(([\s\S]*)\)\s*;?\s*$/;
+// The parsed search indexes, by path. The parent document keeps them for as
+// long as it is open.
+const searchIndexes = new Map();
+const parseSearchIndex = async (path)=>{
+  // Parse a search index that was marked when the bundle was built. JSON is
+  // parsed much faster than the equivalent script is evaluated.
+  if (!window.globalContext.fileTree[path]?.search_index) {
+    return undefined;
+  }
+  const file = await lookupFile(path);
+  const match = file.data.match(SEARCH_INDEX_PATTERN);
+  return match ? JSON.parse(match[1]) : undefined;
+};
+const getSearchIndex = (path)=>{
+  // Return the parsed search index of Sphinx, or undefined if the file is
+  // not one. The iframe asks the parent document, which parses each index
+  // only once.
+  let index = searchIndexes.get(path);
+  if (index === undefined) {
+    index = window.globalContext.fileTree ? parseSearchIndex(path) : requestFromParent(path, "searchIndex").then((reply)=>reply.searchIndex);
+    searchIndexes.set(path, index);
+  }
+  return index;
+};
+const loadSearchIndex = async (path)=>{
+  // Pass the parsed search index to Sphinx' search module in place of
+  // evaluating `searchindex.js`. Return false if there is no such index.
+  const index = await getSearchIndex(path);
+  if (index === undefined) {
+    return false;
+  }
+  if (document.readyState === "loading") {
+    // `searchtools.js` may not have run yet
+    await new Promise((resolve)=>document.addEventListener("DOMContentLoaded", resolve, {
+        once: true
+      }));
+  }
+  Search.setIndex(index);
+  return true;
+};
+const getPageSummary = async (path)=>{
+  // Return the text of a page for search result summaries, if it was
+  // extracted when the bundle was built. Summaries are stored apart from
+  // the file tree, so they are only read, and in archive mode inflated,
+  // when search results are shown. Without any summaries in the bundle,
+  // the iframe does not ask the parent document at all.
+  if (!window.globalContext.summaries) {
+    return undefined;
+  }
+  if (!window.globalContext.fileTree) {
+    return (await requestFromParent(path, "summary")).summary;
+  }
+  const summary = window.globalContext.fileTree[path]?.summary;
+  if (summary === undefined) {
+    return undefined;
+  }
+  if (summary.blob !== undefined) {
+    return window.globalContext.blobs[summary.blob];
+  }
+  return await readArchiveEntry(summary, false);
+};
+const isSearchIndex = async (path)=>{
+  // The parent document knows from the file tree; the iframe has to ask
   if (window.globalContext.fileTree) {
-    retrieveFileFromFileTree(path, callback);
-  } else {
-    retrieveFileFromParent(path, callback);
+    return window.globalContext.fileTree[path]?.search_index === true;
   }
+  return path.endsWith("searchindex.js") && await getSearchIndex(path) !== undefined;
+};
+const retrieveFile = (path, callback)=>{
+  // Like `getFile`, but calls `callback` only if the file exists
+  if (DEBUG) console.log("Retrieving file: " + path);
+  getFile(path).then((file)=>{
+    if (file) {
+      callback(file);
+    }
+  });
 };
 const fixLink = (a)=>{
   const href = a.getAttribute("href");
@@ -95,23 +431,17 @@ const fixForm = (form)=>{
     form.setAttribute("onsubmit", "virtualClick(event)");
   }
 };
-const embedImg = (img)=>{
-  if (img.hasAttribute("src")) {
-    const src = img.getAttribute("src");
-    if (isVirtual(src)) {
-      const path = normalizePath(src);
-      retrieveFile(path, (file)=>{
-        const mime_type = file.mime_type;
-        if (mime_type === "image/svg+xml") {
-          img.setAttribute("src", `data:image/svg+xml;charset=utf-8;base64, ${btoa(file.data)}`);
-        } else {
-          img.setAttribute("src", `data:${mime_type};base64, ${file.data}`);
-        }
-      });
-    }
+const embedImg = async (img, base = window.globalContext.current_path)=>{
+  const src = img.getAttribute("src");
+  if (!isVirtual(src)) {
+    return;
+  }
+  const url = await getFileUrl(normalizePath(src, base));
+  if (url) {
+    img.setAttribute("src", url);
   }
 };
-const fixScriptTag = (doc, oldScript)=>{
+const fixScriptTag = async (doc, oldScript, base = window.globalContext.current_path)=>{
   const newScript = doc.createElement("script");
   for (const attr of Array.from(oldScript.attributes)){
     newScript.setAttribute(attr.name, attr.value);
@@ -120,39 +450,52 @@ const fixScriptTag = (doc, oldScript)=>{
     if (newScript.hasAttribute("src") && isVirtual(newScript.getAttribute("src"))) {
       const src = newScript.getAttribute("src");
       let [path, getParameters, anchor] = splitUrl(src);
-      path = normalizePath(path);
+      path = normalizePath(path, base);
       console.debug(`Embed script: ${path}`);
-      retrieveFile(path, (file)=>{
-        const src = `${file.data}\n//# sourceURL=${path}`;
-        newScript.appendChild(doc.createTextNode(src));
+      let code;
+      if (await isSearchIndex(path)) {
+        code = `loadSearchIndex(${JSON.stringify(path)});`;
+      } else {
+        const file = await getFile(path);
+        if (file) {
+          code = `${file.data}\n//# sourceURL=${path}`;
+        }
+      }
+      if (code !== undefined) {
+        newScript.appendChild(doc.createTextNode(code));
         newScript.removeAttribute("src");
         oldScript.parentNode.replaceChild(newScript, oldScript);
-      });
+      }
     }
   } catch (e) {
     // Make sure all scripts are loaded
     console.error(`Caught error in ${oldScript.getAttribute("src")}`, e);
   }
 };
-const embedJs = (doc)=>{
-  for (const oldScript of Array.from(doc.querySelectorAll("script"))){
-    fixScriptTag(doc, oldScript);
-  }
+const embedJs = async (doc, base = window.globalContext.current_path)=>{
+  await Promise.all(Array.from(doc.querySelectorAll("script")).map((oldScript)=>fixScriptTag(doc, oldScript, base)));
 };
-const embedCss = (doc)=>{
-  for (const link of Array.from(doc.querySelectorAll("link"))){
-    if (link.getAttribute("rel") === "stylesheet" && link.getAttribute("href")) {
-      const href = link.getAttribute("href");
-      let [path, getParameters, anchor] = splitUrl(href);
-      path = normalizePath(path);
-      retrieveFile(path, (file)=>{
-        const style = doc.createElement("style");
-        style.textContent = file.data;
-        link.replaceWith(style);
-      });
+const embedStylesheet = async (link, base = window.globalContext.current_path)=>{
+  const href = link.getAttribute("href");
+  if (link.getAttribute("rel") !== "stylesheet" || !href) {
+    return;
+  }
+  let [path, getParameters, anchor] = splitUrl(href);
+  path = normalizePath(path, base);
+  const file = await getFile(path);
+  if (file) {
+    const style = link.ownerDocument.createElement("style");
+    style.textContent = file.data;
+    const media = link.getAttribute("media");
+    if (media) {
+      style.setAttribute("media", media);
     }
+    link.replaceWith(style);
   }
 };
+const embedCss = async (doc, base = window.globalContext.current_path)=>{
+  await Promise.all(Array.from(doc.querySelectorAll("link")).map((link)=>embedStylesheet(link, base)));
+};
 const fixLinks = (doc)=>{
   for (const a of Array.from(doc.querySelectorAll("a"))){
     fixLink(a);
@@ -163,14 +506,12 @@ const fixForms = (doc)=>{
     fixForm(form);
   }
 };
-const embedImgs = (doc)=>{
-  for (const img of Array.from(doc.querySelectorAll("img"))){
-    embedImg(img);
-  }
+const embedImgs = async (doc, base = window.globalContext.current_path)=>{
+  await Promise.all(Array.from(doc.querySelectorAll("img")).map((img)=>embedImg(img, base)));
 };
-const normalizePath = (path)=>{
-  // make relative paths absolute
-  let result = window.globalContext.current_path;
+const normalizePath = (path, base = window.globalContext.current_path)=>{
+  // make relative paths absolute, relative to the page at `base`
+  let result = base;
   result = result.split("/");
   result.pop();
   // path can be a request object
@@ -194,10 +535,39 @@ const normalizePath = (path)=>{
   }
   result = array.join("/");
   if (DEBUG) {
-    console.log(`Normalized path: ${path} -> ${result} (@${window.globalContext.current_path})`);
+    console.log(`Normalized path: ${path} -> ${result} (@${base})`);
   }
   return result;
 };
+/***** Performance instrumentation *****/ // The marks and measures of Zundler are prefixed to tell them apart from
+// those of the embedded pages. They also show up in the performance panel of
+// the browser's developer tools.
+const PERFORMANCE_PREFIX = "zundler:";
+const markStage = (name)=>{
+  performance.mark(PERFORMANCE_PREFIX + name);
+};
+const timeStage = async (name, func)=>{
+  // Call `func` and measure how long it takes, including asynchronous work
+  const start = performance.now();
+  markStage(name);
+  try {
+    return await func();
+  } finally{
+    performance.measure(PERFORMANCE_PREFIX + name, {
+      start,
+      end: performance.now()
+    });
+  }
+};
+const performanceEntries = ()=>{
+  // Return the measures of Zundler in this document in milliseconds since
+  // its time origin, in the order they started
+  return performance.getEntriesByType("measure").filter((entry)=>entry.name.startsWith(PERFORMANCE_PREFIX)).map((entry)=>({
+      name: entry.name.slice(PERFORMANCE_PREFIX.length),
+      start: entry.startTime,
+      duration: entry.duration
+    })).sort((a, b)=>a.start - b.start);
+};
 // Expose helpers for unit tests when loaded under Node. In the browser this
 // script is injected as a <script> textContent, where `module` is undefined,
 // so the guard is a no-op there.
@@ -206,7 +576,22 @@ if (typeof module !== "undefined" && module.exports) {
     isVirtual,
     splitUrl,
     normalizePath,
+    lookupFile,
+    getFile,
+    getFileUrl,
+    retainObjectUrls,
+    unpinObjectUrls,
+    getSearchIndex,
+    loadSearchIndex,
+    getPageSummary,
+    decodeBase64,
+    _decodeBase64WithTable,
+    readArchive,
+    LruCache,
+    fileToBlob,
     fixLink,
-    fixForm
+    fixForm,
+    timeStage,
+    performanceEntries
   };
 }
@@ -1,23 +1,38 @@
 const iFrameId = "zundler-iframe";
-const setFavicon = (href)=>{
+// Upper bound for the total size of prepared pages kept in memory, in
+// characters
+const PAGE_CACHE_SIZE = 32 * 1024 * 1024;
+// Stands in for the global context script in prepared pages. The global
+// context differs on each visit, so it is inserted when a page is loaded.
+const GLOBAL_CONTEXT_PLACEHOLDER = "/* zundler global context */";
+// The placeholders in prerendered pages, see `zundler.prerender`
+const PRERENDER_PATTERN = /<(script|style) data-zundler-(inline|util)="([^"]*)"([^>]*)><\/\1>|data-zundler-src="([^"]*)"/g;
+// The shared object URLs in a prepared page, see `getFileUrl`
+const OBJECT_URL_PATTERN = /blob:[^"'\s)]+/g;
+const pageCache = new LruCache(PAGE_CACHE_SIZE, (page)=>page.html.length);
+// When the navigation to each page that is not ready yet started
+const navigationStarts = new Map();
+// Counts the navigations, so a page that is ready only after a later
+// navigation started is not shown
+let navigationCount = 0;
+let opened = false;
+const setFavicon = async (href)=>{
   if (!href) {
     return;
   }
   const favicon = document.createElement("link");
   favicon.setAttribute("rel", "shortcut icon");
   const href_ = normalizePath(href);
-  const file = window.globalContext.fileTree[href_];
+  const file = await lookupFile(href_);
   if (!file) {
     return;
   }
   if (file.mime_type === "image/svg+xml") {
-    favicon.setAttribute("href", `data:${file.mime_type};charset=utf-8;base64,${btoa(file.data)}`);
     favicon.setAttribute("type", file.mime_type);
-  } else {
-    if (file.base64encoded) {
-      favicon.setAttribute("href", `data:${file.mime_type};base64,${file.data}`);
-    }
+  } else if (!file.base64encoded) {
+    return;
   }
+  favicon.setAttribute("href", await getFileUrl(href_));
   document.head.appendChild(favicon);
 };
 const createIframe = (html)=>{
@@ -42,28 +57,26 @@ function deepCopyExcept(obj, skipProps) {
   }
   return result;
 }
-const prepare = (html)=>{
-  function unicodeToBase64(string) {
-    const utf8EncodedString = unescape(encodeURIComponent(string));
-    return btoa(utf8EncodedString);
-  }
-  const parser = new DOMParser();
-  const doc = parser.parseFromString(html, "text/html");
-  // Insert the global context into the iframe's DOM, but without the file
-  // tree or utils. They are not necessary; the iframe will message the
-  // parent document to retrieve files.
+const globalContextScript = ()=>{
+  // Return a script that sets the global context in the iframe, but without
+  // the file tree, blobs or utils. They are not necessary; the iframe will
+  // message the parent document to retrieve files.
   //
   // Convert JSON object to b64 because it contain all kinds of
   // problematic characters: `, ", ', &, </script>, ...
   // atob is insufficient, because it only deals with ASCII - we have
   // unicode
-  const gcTag = doc.createElement("script");
+  function unicodeToBase64(string) {
+    const utf8EncodedString = unescape(encodeURIComponent(string));
+    return btoa(utf8EncodedString);
+  }
   const strippedGC = deepCopyExcept(window.globalContext, [
     "fileTree",
+    "blobs",
     "utils"
   ]);
   const serializedGC = unicodeToBase64(JSON.stringify(strippedGC));
-  gcTag.textContent = `
+  return `
         function base64ToUnicode(base64String) {
             const utf8EncodedString = atob(base64String);
             return decodeURIComponent(escape(utf8EncodedString));
@@ -71,75 +84,264 @@ const prepare = (html)=>{
 
         window.globalContext = JSON.parse(base64ToUnicode("${serializedGC}"));
     `;
+};
+const utilSource = (name)=>{
+  // zundler_common runs in the parent document as well, so it is taken
+  // from there instead of being shipped twice
+  if (name === "zundler_common") {
+    return document.getElementById("zundler-common")?.textContent ?? "";
+  }
+  const utils = window.globalContext.utils;
+  return utils[name] ?? "";
+};
+const prepare = async (html, path)=>{
+  // Relative paths in the page are resolved against `path`, not the current
+  // path, which changes if another navigation starts meanwhile
+  const parser = new DOMParser();
+  const doc = parser.parseFromString(html, "text/html");
+  const gcTag = doc.createElement("script");
+  gcTag.textContent = GLOBAL_CONTEXT_PLACEHOLDER;
   const commonTag = doc.createElement("script");
-  commonTag.textContent = window.globalContext.utils.zundler_common;
+  commonTag.textContent = utilSource("zundler_common");
   const injectPreTag = doc.createElement("script");
-  injectPreTag.textContent = window.globalContext.utils.inject_pre;
+  injectPreTag.textContent = utilSource("inject_pre");
   const injectPostTag = doc.createElement("script");
-  injectPostTag.textContent = window.globalContext.utils.inject_post;
+  injectPostTag.textContent = utilSource("inject_post");
   doc.head.prepend(commonTag);
   doc.head.prepend(gcTag);
   doc.head.prepend(injectPreTag);
   doc.body.append(injectPostTag);
-  embedJs(doc);
-  embedCss(doc);
-  embedImgs(doc);
+  await Promise.all([
+    embedJs(doc, path),
+    embedCss(doc, path),
+    embedImgs(doc, path)
+  ]);
   fixLinks(doc);
   fixForms(doc);
-  window.document.title = doc.title;
-  return doc.documentElement.outerHTML;
+  return preparedPage(doc.documentElement.outerHTML, doc.title);
 };
-const loadVirtualPage = (path, getParams, anchor)=>{
+const preparedPage = (html, title)=>{
+  return {
+    html,
+    title,
+    urls: html.match(OBJECT_URL_PATTERN) ?? []
+  };
+};
+const unescapeAttribute = (value)=>{
+  const entities = {
+    amp: "&",
+    lt: "<",
+    gt: ">",
+    quot: '"',
+    "#x27": "'"
+  };
+  return value.replace(/&(amp|lt|gt|quot|#x27);/g, (_, name)=>entities[name]);
+};
+const render = async (html, title, pagePath)=>{
+  // Fill in the placeholders of a page that was prerendered when the bundle
+  // was built. This only takes string replacements, the page is not parsed.
+  // It does the same as `prepare` otherwise.
+  const fileTree = window.globalContext.fileTree;
+  const paths = new Set();
+  const imagePaths = new Set();
+  for (const match of html.matchAll(PRERENDER_PATTERN)){
+    if (match[5] !== undefined) {
+      imagePaths.add(normalizePath(unescapeAttribute(match[5]), pagePath));
+    } else if (match[2] !== "util") {
+      const path = normalizePath(unescapeAttribute(match[3]), pagePath);
+      if (!fileTree[path]?.search_index) {
+        paths.add(path);
+      }
+    }
+  }
+  const files = new Map();
+  const urls = new Map();
+  await Promise.all([
+    ...Array.from(paths).map(async (path)=>files.set(path, await getFile(path))),
+    ...Array.from(imagePaths).map(async (path)=>urls.set(path, await getFileUrl(path)))
+  ]);
+  html = html.replace(PRERENDER_PATTERN, (match, tag, kind, value, attributes, src)=>{
+    if (src !== undefined) {
+      const url = urls.get(normalizePath(unescapeAttribute(src), pagePath));
+      return `src="${url ?? src}"`;
+    }
+    if (kind === "util") {
+      return `<script>${utilSource(value)}</script>`;
+    }
+    const path = normalizePath(unescapeAttribute(value), pagePath);
+    if (tag === "script" && fileTree[path]?.search_index) {
+      return `<script${attributes}>loadSearchIndex(${JSON.stringify(path)});</script>`;
+    }
+    const file = files.get(path);
+    if (!file) {
+      return match;
+    }
+    if (tag === "script") {
+      return `<script${attributes}>${file.data}\n//# sourceURL=${path}</script>`;
+    }
+    return `<style${attributes}>${file.data}</style>`;
+  });
+  return preparedPage(html, title);
+};
+const loadVirtualPage = async (path, getParams, anchor)=>{
   // fill the iframe with the new page
   // return True if it worked
   // return False if loading indicator should be removed right away
-  const file = window.globalContext.fileTree[path];
-  if (!file) {
-    console.error("File not found:", path, getParams, anchor);
-    return false;
-  }
-  let data = file.data;
+  //
+  // Prepared pages are cached, so revisiting a page skips `prepare`. A
+  // page must be prepared again if an object URL it uses was revoked.
+  //
+  // If another navigation starts while the page is loaded, the page is
+  // dropped, and the later navigation takes care of the loading indicator.
+  const navigation = ++navigationCount;
+  const superseded = ()=>navigation !== navigationCount;
   window.globalContext.getParameters = getParams;
-  // libmagic doesn't properly recognize mimetype of HTMl files that start
-  // with empty lines. It thinks it's javascript. So we also consider the
-  // filename when determining the file type.
-  if (file.mime_type === "text/html" || path.toLowerCase().endsWith(".html")) {
-    window.globalContext.current_path = path;
-    window.globalContext.anchor = anchor;
-    const html = prepare(data);
-    window.history.pushState({
-      path,
-      getParams,
-      anchor
-    }, "", "#");
-    const oldIframe = document.getElementById(iFrameId);
-    if (oldIframe) {
-      oldIframe.setAttribute("id", `old-${iFrameId}`);
+  navigationStarts.set(path, performance.now());
+  markStage(`navigate ${path}`);
+  unpinObjectUrls();
+  let page = pageCache.get(path);
+  if (page !== undefined && !retainObjectUrls(page.urls)) {
+    page = undefined;
+  }
+  if (page === undefined) {
+    const file = await timeStage(`lookup ${path}`, ()=>lookupFile(path));
+    if (superseded()) {
+      return true;
+    }
+    if (!file) {
+      console.error("File not found:", path, getParams, anchor);
+      navigationStarts.delete(path);
+      return false;
+    }
+    // libmagic doesn't properly recognize mimetype of HTMl files that start
+    // with empty lines. It thinks it's javascript. So we also consider the
+    // filename when determining the file type.
+    if (file.mime_type !== "text/html" && !path.toLowerCase().endsWith(".html")) {
+      const url = await getFileUrl(path);
+      if (superseded()) {
+        return true;
+      }
+      const myWindow = window.open(url, "_blank");
+      navigationStarts.delete(path);
+      return false;
+    }
+    if (file.prerendered) {
+      page = await timeStage(`render ${path}`, ()=>render(file.data, file.title ?? "", path));
+    } else {
+      page = await timeStage(`prepare ${path}`, ()=>prepare(file.data, path));
+    }
+    // The page is still good for a later visit
+    pageCache.set(path, page);
+    if (superseded()) {
+      return true;
     }
-    const iframe = createIframe(html);
-    window.document.body.append(iframe);
-    return true;
   }
-  if (file.base64encoded) {
-    data = _base64ToArrayBuffer(data);
+  window.globalContext.current_path = path;
+  window.globalContext.anchor = anchor;
+  const html = page.html.replace(GLOBAL_CONTEXT_PLACEHOLDER, globalContextScript);
+  window.document.title = page.title;
+  window.history.pushState({
+    path,
+    getParams,
+    anchor
+  }, "", "#");
+  const oldIframe = document.getElementById(iFrameId);
+  if (oldIframe) {
+    oldIframe.setAttribute("id", `old-${iFrameId}`);
+  }
+  const iframe = createIframe(html);
+  window.document.body.append(iframe);
+  return true;
+};
+const answerFileRequests = async (port, requests)=>{
+  // Answer a batch of file requests from the iframe in one message. Binary
+  // files are sent as bytes whose buffers are transferred, not copied.
+  const transfer = [];
+  const answer = async ({ id, path, url, searchIndex, summary })=>{
+    if (url) {
+      return {
+        id,
+        url: await getFileUrl(path)
+      };
+    }
+    if (searchIndex) {
+      return {
+        id,
+        searchIndex: await getSearchIndex(path)
+      };
+    }
+    if (summary) {
+      return {
+        id,
+        summary: await getPageSummary(path)
+      };
+    }
+    const file = await lookupFile(path);
+    if (file && file.base64encoded) {
+      // Cached bytes must stay usable here, so transfer a copy
+      const bytes = typeof file.data === "string" ? decodeBase64(file.data) : file.data.slice();
+      transfer.push(bytes.buffer);
+      file.data = bytes;
+    }
+    return {
+      id,
+      file
+    };
+  };
+  // A failed lookup must not hold up the other replies, and the iframe
+  // treats it like a missing file
+  const replies = await Promise.all(requests.map((request)=>answer(request).catch((error)=>{
+      console.error(`Cannot answer request for ${request.path}:`, error);
+      return {
+        id: request.id
+      };
+    })));
+  port.postMessage({
+    action: "sendFiles",
+    argument: {
+      files: replies
+    }
+  }, transfer);
+};
+const finishNavigation = (path)=>{
+  // A page is ready, so measure how long it took since its navigation
+  // started, and since the document was opened for the first page
+  const end = performance.now();
+  const start = navigationStarts.get(path);
+  if (start !== undefined) {
+    performance.measure(`${PERFORMANCE_PREFIX}navigate ${path}`, {
+      start,
+      end
+    });
+    navigationStarts.delete(path);
+  }
+  if (!opened) {
+    performance.measure(`${PERFORMANCE_PREFIX}open`, {
+      start: 0,
+      end
+    });
+    opened = true;
+  }
+};
+const recordPageTimings = (path, timeOrigin, entries)=>{
+  // The timings of a page are relative to the time origin of its iframe
+  const offset = timeOrigin - performance.timeOrigin;
+  for (const entry of entries){
+    performance.measure(`${PERFORMANCE_PREFIX}page ${entry.name} ${path}`, {
+      start: entry.start + offset,
+      duration: entry.duration
+    });
   }
-  const blob = new Blob([
-    data
-  ], {
-    type: file.mime_type
-  });
-  const url = URL.createObjectURL(blob);
-  const myWindow = window.open(url, "_blank");
-  return false;
 };
 function main() {
-  setUpPopup();
+  timeStage("setUpPopup", setUpPopup);
   // Set up message listener
   window.addEventListener("message", (evnt)=>{
     if (DEBUG) console.log("Received message in parent", evnt.data);
     const iframe = document.getElementById(iFrameId);
     if (evnt.data.action === "ready") {
       // iframe is ready
+      finishNavigation(evnt.data.argument.path);
       hideLoadingIndicator();
       iframe.contentWindow.postMessage({
         action: "scrollToAnchor"
@@ -149,19 +351,19 @@ function main() {
         oldIframe.remove();
       }
       iframe.contentWindow.document.body.focus();
-    } else if (evnt.data.action === "retrieveFile") {
-      const path = evnt.data.argument.path;
-      retrieveFile(path, (file)=>{
-        iframe.contentWindow.postMessage({
-          action: "sendFile",
-          argument: {
-            path: path,
-            file: file
-          }
-        }, "*");
-      });
+    } else if (evnt.data.action === "connect") {
+      // The iframe retrieves files through a dedicated channel
+      const port = evnt.ports[0];
+      port.onmessage = (message)=>{
+        if (message.data.action === "retrieveFiles") {
+          answerFileRequests(port, message.data.argument.requests);
+        }
+      };
     } else if (evnt.data.action === "showMenu") {
       showPopup();
+    } else if (evnt.data.action === "performance") {
+      const { path, timeOrigin, entries } = evnt.data.argument;
+      recordPageTimings(path, timeOrigin, entries);
     } else if (evnt.data.action === "set_title") {
       // iframe has finished loading and sent us its title
       // parent sets the title and responds with the globalContext object
@@ -170,10 +372,11 @@ function main() {
     } else if (evnt.data.action === "virtualClick") {
       // user has clicked on a link in the iframe
       // showLoadingIndicator();
-      const loaded = loadVirtualPage(evnt.data.argument.path, evnt.data.argument.getParameters, evnt.data.argument.anchor);
-      if (!loaded) {
-        hideLoadingIndicator();
-      }
+      loadVirtualPage(evnt.data.argument.path, evnt.data.argument.getParameters, evnt.data.argument.anchor).then((loaded)=>{
+        if (!loaded) {
+          hideLoadingIndicator();
+        }
+      });
     }
   }, false);
   // Set up history event listener
@@ -192,6 +395,7 @@ const hideLoadingIndicator = ()=>{
   loading.style.display = "none";
 };
 /***** Code for the popup menu *****/ function showPopup() {
+  updatePerformanceSection();
   document.getElementById("zundler-popup").style.display = "block";
 }
 function hidePopup() {
@@ -219,6 +423,7 @@ function setUpPopup() {
             <ul>
                 <li><a href="#" data-target="info">Info</a>
                 <li><a href="#" data-target="file-tree">Embedded Files</a>
+                <li><a href="#" data-target="performance">Performance</a>
             </ul>
         </div>
         <div class="zundler-popup-content">
@@ -235,6 +440,16 @@ function setUpPopup() {
                     <h1>Embedded Files</h1>
                     <div id="file-tree"><ul></ul></div>
                 </div>
+                <div id="content-performance" class="content-section">
+                    <h1>Performance</h1>
+                    <p>Time spent in each stage of opening this document and its pages, in milliseconds since it was opened. Stages of pages start with "page".</p>
+                    <table id="zundler-performance">
+                        <thead><tr><th>Stage</th><th>Start</th><th>Duration</th></tr></thead>
+                        <tbody></tbody>
+                    </table>
+                    <p><button id="zundler-performance-copy">Copy as JSON</button></p>
+                    <textarea id="zundler-performance-json" readonly rows="10"></textarea>
+                </div>
             </div>
         </div>
     </div>`;
@@ -254,9 +469,13 @@ function setUpPopup() {
         div.style.display = "none";
       }
       // Show the selected content div
+      if (target === "performance") {
+        updatePerformanceSection();
+      }
       document.getElementById(`content-${target}`).style.display = "block";
     });
   }
+  popup.querySelector("#zundler-performance-copy").addEventListener("click", copyPerformanceReport);
   for (const [path, file] of Object.entries(window.globalContext.fileTree)){
     const listitem = document.createElement("li");
     const link = document.createElement("a");
@@ -268,27 +487,56 @@ function setUpPopup() {
   }
   document.body.append(popup);
 }
-async function downloadVirtualFile(path) {
-  retrieveFile(path, (file)=>{
-    let data;
-    if (file.base64encoded) {
-      data = _base64ToArrayBuffer(file.data);
-    } else {
-      data = file.data;
+function performanceReport() {
+  // Everything needed to compare the numbers from different machines
+  return JSON.stringify({
+    zundler_version,
+    userAgent: navigator.userAgent,
+    hardwareConcurrency: navigator.hardwareConcurrency,
+    entries: performanceEntries()
+  }, null, 2);
+}
+function updatePerformanceSection() {
+  const tbody = document.querySelector("#zundler-performance tbody");
+  if (!tbody) {
+    return;
+  }
+  tbody.replaceChildren(...performanceEntries().map(({ name, start, duration })=>{
+    const row = document.createElement("tr");
+    for (const value of [
+      name,
+      start.toFixed(1),
+      duration.toFixed(1)
+    ]){
+      const cell = document.createElement("td");
+      cell.textContent = value;
+      row.append(cell);
     }
-    const blob = new Blob([
-      data
-    ], {
-      type: file.mime_type
-    });
-    const url = URL.createObjectURL(blob);
-    // var myWindow = window.open(url, "_blank");
-    // Create link and click it so file is downloaded
-    const link = document.createElement("a");
-    link.href = window.URL.createObjectURL(blob);
-    const fileName = path;
-    link.download = fileName;
-    link.click();
-  });
+    return row;
+  }));
+  document.getElementById("zundler-performance-json").value = performanceReport();
+}
+async function copyPerformanceReport() {
+  updatePerformanceSection();
+  const textarea = document.getElementById("zundler-performance-json");
+  try {
+    await navigator.clipboard.writeText(textarea.value);
+  } catch  {
+    // The clipboard API is not available for files in some browsers, so
+    // select the text for the user to copy
+    textarea.select();
+  }
+}
+async function downloadVirtualFile(path) {
+  const url = await getFileUrl(path);
+  if (!url) {
+    return;
+  }
+  // Create link and click it so file is downloaded
+  const link = document.createElement("a");
+  link.href = url;
+  const fileName = path;
+  link.download = fileName;
+  link.click();
 }
 main();
@@ -13,7 +13,7 @@
  * ambient declaration within that file; there is no conflict.
  */
 
-import type { FileEntry, GlobalContext } from "./types.ts";
+import type { FileEntry, GlobalContext, StageTiming } from "./types.ts";
 
 declare global {
 	/** Injected by `embed.py` as `const DEBUG = true|false;`. */
@@ -26,31 +26,68 @@ declare global {
 	// deno-lint-ignore no-explicit-any
 	const jQuery: any;
 
+	/** Sphinx' search module, present only on search pages. */
+	// deno-lint-ignore no-explicit-any
+	const Search: any;
+
 	/** CommonJS shim, defined only when loaded under Node for unit tests. */
 	const module: { exports: Record<string, unknown> } | undefined;
 
 	interface Window {
 		globalContext: GlobalContext;
+		/** Base64-encoded archive of compressed files, in archive mode. */
+		zundlerArchive?: string;
 	}
 
 	// --- zundler_common ---
+	class LruCache<K, V> {
+		constructor(
+			maxSize: number,
+			sizeOf: (value: V) => number,
+			onEvict?: (key: K, value: V) => void,
+		);
+		get(key: K): V | undefined;
+		set(key: K, value: V): void;
+	}
+	function lookupFile(path: string): Promise<FileEntry | undefined>;
+	function getFile(path: string): Promise<FileEntry | undefined>;
 	function retrieveFile(
 		path: string,
 		callback: (file: FileEntry) => void,
 	): void;
-	function normalizePath(path: string | URL | { href: string }): string;
+	function decodeBase64(base64: string): Uint8Array;
+	function inflate(bytes: Uint8Array): Promise<Uint8Array>;
+	function fileToBlob(file: FileEntry): Blob;
+	function getFileUrl(path: string): Promise<string | undefined>;
+	function getSearchIndex(path: string): Promise<unknown>;
+	function loadSearchIndex(path: string): Promise<boolean>;
+	function getPageSummary(path: string): Promise<string | undefined>;
+	function retainObjectUrls(urls: string[]): boolean;
+	function unpinObjectUrls(): void;
+	function normalizePath(
+		path: string | URL | { href: string },
+		base?: string,
+	): string;
 	function isVirtual(url: string | URL | null | undefined): boolean;
 	function splitUrl(url: string): [string, string, string];
 	function fixLink(a: Element): void;
 	function fixForm(form: Element): void;
 	function fixLinks(doc: Document): void;
 	function fixForms(doc: Document): void;
-	function embedImg(img: Element): void;
-	function embedImgs(doc: Document): void;
-	function embedJs(doc: Document): void;
-	function embedCss(doc: Document): void;
-	function fixScriptTag(doc: Document, oldScript: Element): void;
+	function embedImg(img: Element, base?: string): Promise<void>;
+	function embedImgs(doc: Document, base?: string): Promise<void>;
+	function embedJs(doc: Document, base?: string): Promise<void>;
+	function embedCss(doc: Document, base?: string): Promise<void>;
+	function fixScriptTag(
+		doc: Document,
+		oldScript: Element,
+		base?: string,
+	): Promise<void>;
 	const _base64ToArrayBuffer: (base64: string) => ArrayBuffer | never[];
+	const PERFORMANCE_PREFIX: string;
+	function markStage(name: string): void;
+	function timeStage<T>(name: string, func: () => T | Promise<T>): Promise<T>;
+	function performanceEntries(): StageTiming[];
 
 	// --- inject_post ---
 	function virtualClick(event: Event): boolean | undefined;
@@ -59,6 +96,7 @@ declare global {
 	function showPopup(): void;
 	function hidePopup(): void;
 	function setUpPopup(): void;
+	function updatePerformanceSection(): void;
 	function showLoadingIndicator(): void;
 	function hideLoadingIndicator(): void;
 	function downloadVirtualFile(path: string): Promise<void>;
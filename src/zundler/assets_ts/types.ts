@@ -5,17 +5,47 @@
  * transpiler erases it entirely and the emitted `.js` contains no import.
  */
 
-/** A single entry in the virtual file tree. */
+/** A file from the virtual file tree, resolved to its contents. */
 export interface FileEntry {
-	data: string;
+	/** Text, or binary contents as bytes in archive mode and base64 otherwise. */
+	data: string | Uint8Array;
 	mime_type: string;
 	base64encoded: boolean;
+	/** Whether an HTML page was rewritten when the bundle was built. */
+	prerendered?: boolean;
+	/** The title of a prerendered page. */
+	title?: string;
+	/** Whether a script is a Sphinx search index in JSON. */
+	search_index?: boolean;
+}
+
+/** Where contents are stored: in a blob, or in a byte range of the archive. */
+export interface StoredContents {
+	/** Key into `GlobalContext.blobs`; identical files share one blob. */
+	blob?: string;
+	/** Byte range of the file in the archive, in archive mode. */
+	offset?: number;
+	length?: number;
+	/** Whether the bytes in the archive are deflated or stored as they are. */
+	method?: "deflate" | "store";
+}
+
+/** A single entry in the virtual file tree. */
+export interface FileTreeEntry extends StoredContents {
+	mime_type: string;
+	base64encoded: boolean;
+	/** Size of the contents in bytes, for listing a bundle. */
+	size?: number;
+	prerendered?: boolean;
+	title?: string;
+	search_index?: boolean;
+	/** Where the text of a page for search result summaries is stored. */
+	summary?: StoredContents;
 }
 
 /** The bundled JavaScript payloads injected at runtime. */
 export interface ZundlerUtils {
 	zundler_main: string;
-	zundler_common: string;
 	inject_pre: string;
 	inject_post: string;
 }
@@ -23,12 +53,57 @@ export interface ZundlerUtils {
 /** The global context shared between the parent document and the iframe. */
 export interface GlobalContext {
 	current_path: string;
-	fileTree: Record<string, FileEntry>;
+	fileTree: Record<string, FileTreeEntry>;
+	/** File contents, keyed by content hash. */
+	blobs: Record<string, string>;
 	utils: ZundlerUtils;
+	/** Whether pages have summaries for search results, see `getPageSummary`. */
+	summaries?: boolean;
 	getParameters?: string;
 	anchor?: string;
 }
 
+/** What the iframe asks for about a file, see `requestFromParent`. */
+export type RequestKind = "file" | "url" | "searchIndex" | "summary";
+
+/** A request of the iframe for a file, see `requestFromParent`. */
+export interface FileRequest {
+	id: number;
+	path: string;
+	/** Ask for a shared object URL instead of the contents. */
+	url?: boolean;
+	/** Ask for the parsed search index instead of the script. */
+	searchIndex?: boolean;
+	/** Ask for the text of a page instead of the contents. */
+	summary?: boolean;
+}
+
+/** The parent's reply to a `FileRequest`; empty if the file is missing. */
+export interface FileReply {
+	id: number;
+	file?: FileEntry;
+	url?: string;
+	searchIndex?: unknown;
+	summary?: string;
+}
+
+/** A page prepared for the iframe, see `prepare` in `zundler_main`. */
+export interface PreparedPage {
+	/** The HTML, with a placeholder in place of the global context script. */
+	html: string;
+	title: string;
+	/** The shared object URLs the page refers to. */
+	urls: string[];
+}
+
+/** How long a stage of loading took, see `timeStage`. */
+export interface StageTiming {
+	name: string;
+	/** Milliseconds since the time origin of the document. */
+	start: number;
+	duration: number;
+}
+
 /** Payload of the `postMessage` calls exchanged between parent and iframe. */
 export interface ZundlerMessage {
 	action: string;
@@ -0,0 +1,107 @@
+"""
+Bundle several documents in one go.
+
+Documentation is often released in many versions and languages, which are
+bundled separately but share most of their theme. Bundling all of them in
+one process saves starting an interpreter for each and lets them share:
+
+* A pool of worker threads that prepare the files of all bundles
+* A `MemoryCache` of prepared files, keyed by content, so identical theme
+  assets and style sheets are only prepared once, including the resources
+  inlined into the style sheets
+
+The documents are bundled one after another, each with all workers. The
+inputs can be given on the command line or in a manifest, a JSON file with
+a list of objects with an `input` and optionally an `output` path, relative
+to the manifest:
+
+    [
+        {"input": "en/html/index.html", "output": "dist/docs-en.html"},
+        {"input": "de/html/index.html", "output": "dist/docs-de.html"}
+    ]
+
+"""
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from zundler.cache import DEFAULT_MAX_SIZE as DEFAULT_CACHE_SIZE
+from zundler.cache import MemoryCache
+from zundler.embed import embed_assets, open_cache
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest(path):
+    """Return the `(input, output)` pairs of a manifest; `output` may be None"""
+
+    path = Path(path)
+    base_dir = path.parent
+    result = []
+    for item in json.loads(path.read_text()):
+        if not isinstance(item, dict) or "input" not in item:
+            raise ValueError(f"invalid manifest entry in {path}: {item!r}")
+        output = item.get("output")
+        result.append((base_dir / item["input"], base_dir / output if output else None))
+    return result
+
+
+def embed_batch(
+    bundles,
+    jobs=1,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    prerender=False,
+    minify=False,
+    optimize_images=False,
+    accelerate_search=False,
+    **kwargs,
+):
+    """Bundle several documents with a shared worker pool and cache
+
+    `bundles` are `(input, output)` pairs; an output of None means the
+    default path next to the input. Missing output directories are created. If `cache_dir` is given, the shared
+    cache is backed by a persistent cache there. Other keyword arguments
+    are passed on to `embed_assets`.
+
+    A bundle that fails is logged and skipped. Return the inputs of the
+    failed bundles.
+    """
+
+    options = {
+        "prerender": prerender,
+        "minify": minify,
+        "optimize_images": optimize_images,
+        "accelerate_search": accelerate_search,
+    }
+    backing = open_cache(cache_dir, cache_size=cache_size, **options) if cache_dir else None
+    cache = MemoryCache(backing=backing)
+    failed = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for index_file, output_path in bundles:
+                logger.info("Bundling %s", index_file)
+                try:
+                    if output_path:
+                        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+                    embed_assets(
+                        index_file,
+                        output_path=output_path,
+                        jobs=jobs,
+                        cache=cache,
+                        executor=executor,
+                        **options,
+                        **kwargs,
+                    )
+                except Exception as e:
+                    logger.error("Cannot bundle %s: %s", index_file, e)
+                    failed.append(index_file)
+    finally:
+        if backing:
+            backing.close()
+
+    cache.log_report()
+    return failed
@@ -0,0 +1,382 @@
+"""
+Persistent cache of prepared file entries.
+
+Preparing a file for the file tree means reading it, sniffing its mime type,
+inlining the resources referenced by CSS files and encoding the result. When
+a document is bundled again after a small change, most of that work is
+wasted. This cache keeps the output of `prepare_file` in an SQLite database
+inside a cache directory, so only files that actually changed are prepared
+again.
+
+Entries are keyed by the path of the file and validated against its size,
+its modification time and a hash of its contents. Entries of CSS files also
+record the files they pulled in via `@import` or `url()`, and become invalid
+as soon as one of them changes. Entries written by a different version of
+Zundler or with different options, e.g. with or without prerendering, are
+ignored. When the cache grows beyond its size limit, the least recently used
+entries are evicted.
+
+The cache also stores blobs by key, e.g. optimized images by the hash of
+the original image. These do not depend on the path or the options, so
+they survive renames and changes of unrelated options.
+
+When several documents are bundled in one go, a `MemoryCache` shares
+prepared entries between them by content instead of by path, so identical
+theme files are only prepared once.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+
+from zundler.args import __version__
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_MEMORY_SIZE = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    dependencies TEXT NOT NULL,
+    entry BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+class PreparedCache:
+    """Cache of prepared file entries, stored in `cache_dir`
+
+    The cache is safe to use from several threads and processes at once.
+    `max_size` is the total size of the stored entries in bytes above which
+    entries are evicted. `options` are the options that affect how files are
+    prepared; entries prepared with other options are ignored.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, options=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.fingerprint = f"{__version__} {json.dumps(options or {}, sort_keys=True)}"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.cache_dir / "prepared.sqlite3",
+            timeout=60,
+            check_same_thread=False,
+        )
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, filename):
+        """Return the cached entry of a file, or None if there is no valid one"""
+
+        filename = str(Path(filename).resolve())
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint, size, mtime_ns, hash, dependencies, entry FROM entries WHERE path = ?",
+                (filename,),
+            ).fetchone()
+
+        if not row or row[0] != self.fingerprint:
+            self.misses += 1
+            return None
+
+        _, size, mtime_ns, digest, dependencies, entry = row
+        if not _is_unchanged([filename, size, mtime_ns, digest]) or not all(
+            _is_unchanged(dependency) for dependency in json.loads(dependencies)
+        ):
+            logger.debug("Cache entry outdated: %s", filename)
+            self.misses += 1
+            return None
+
+        with self._lock, self._db:
+            self._db.execute("UPDATE entries SET last_used = ? WHERE path = ?", (time.time(), filename))
+
+        self.hits += 1
+        return _load_entry(zlib.decompress(entry))
+
+    def put(self, filename, entry, dependencies=(), state=None):
+        """Store the prepared entry of a file
+
+        `dependencies` are the paths of all other files that went into the
+        entry, e.g. the targets of `@import` rules in a CSS file. `state` is
+        the state of the file that was prepared, as returned by `read_file`.
+        Without it, the file is read again, so the entry may be stored for
+        contents that changed after it was prepared.
+        """
+
+        filename = str(Path(filename).resolve())
+        if state is None:
+            state = _file_state(filename)
+        if state is None:
+            return
+
+        dependencies = sorted(str(Path(path).resolve()) for path in dependencies)
+        dependencies = [_file_state(path) or [path, None, None, None] for path in dependencies]
+        data = zlib.compress(_dump_entry(entry), 1)
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    filename,
+                    self.fingerprint,
+                    state[1],
+                    state[2],
+                    state[3],
+                    json.dumps(dependencies),
+                    data,
+                    len(data),
+                    time.time(),
+                ),
+            )
+
+    def get_blob(self, key):
+        """Return the blob stored under `key`, or None"""
+
+        with self._lock:
+            row = self._db.execute("SELECT data FROM blobs WHERE key = ?", (key,)).fetchone()
+            if row:
+                with self._db:
+                    self._db.execute("UPDATE blobs SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        return zlib.decompress(row[0]) if row else None
+
+    def put_blob(self, key, data):
+        """Store a blob under `key`"""
+
+        data = zlib.compress(data, 1)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size limit"""
+
+        with self._lock, self._db:
+            (total,) = self._db.execute(
+                "SELECT (SELECT COALESCE(SUM(nbytes), 0) FROM entries) + (SELECT COALESCE(SUM(nbytes), 0) FROM blobs)"
+            ).fetchone()
+            if total <= self.max_size:
+                return
+            rows = self._db.execute(
+                "SELECT 'entries', path, nbytes, last_used FROM entries"
+                " UNION ALL SELECT 'blobs', key, nbytes, last_used FROM blobs ORDER BY last_used"
+            ).fetchall()
+            evicted = defaultdict(list)
+            for table, key, nbytes, _ in rows:
+                if total <= self.max_size:
+                    break
+                evicted[table].append((key,))
+                total -= nbytes
+            self._db.executemany("DELETE FROM entries WHERE path = ?", evicted["entries"])
+            self._db.executemany("DELETE FROM blobs WHERE key = ?", evicted["blobs"])
+        logger.debug("Evicted %d cache entries", sum(map(len, evicted.values())))
+
+    def close(self):
+        self.evict()
+        logger.debug("Cache hits: %d, misses: %d", self.hits, self.misses)
+        with self._lock:
+            self._db.close()
+
+
+class MemoryCache:
+    """In-memory cache of prepared entries shared by several bundles
+
+    Documentation sets built with the same theme contain many identical
+    files at different paths. Entries are keyed by the name and the content
+    hash of a file instead of its path, so an entry prepared for one bundle
+    is reused for identical files in all others. Entries of style sheets
+    also record the hashes of the files they pull in, relative to the style
+    sheet, and are only reused if these files are the same as well.
+
+    All bundles must be prepared with the same options. If `backing` is a
+    `PreparedCache` opened with these options, entries missing here are
+    looked up there, and new entries are stored there as well. Once the
+    entries exceed `max_size` characters, the least recently used ones are
+    dropped. The cache is safe to use from several threads at once.
+    """
+
+    def __init__(self, backing=None, max_size=DEFAULT_MEMORY_SIZE):
+        self.backing = backing
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps `(name, hash)` to a list of `(dependencies, entry)` pairs
+        self._entries = OrderedDict()
+        self._blobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Return the entry of a file with the same name and contents, or None"""
+
+        key = _content_key(filename)
+        if key is None:
+            return None
+        with self._lock:
+            candidates = list(self._entries.get(key, ()))
+            if candidates:
+                self._entries.move_to_end(key)
+
+        directory = Path(filename).parent
+        for dependencies, entry in candidates:
+            if all(_digest(directory / path) == digest for path, digest in dependencies):
+                self.hits += 1
+                return dict(entry)
+
+        self.misses += 1
+        entry = self.backing.get(filename) if self.backing else None
+        if entry is not None and not str(filename).lower().endswith(".css"):
+            # The dependencies of style sheets are not known here
+            self._add(key, [], entry)
+        return entry
+
+    def put(self, filename, entry, dependencies=(), state=None):
+        """Store the prepared entry of a file, see `PreparedCache.put`"""
+
+        if state is None:
+            state = _file_state(filename)
+        if state is None:
+            return
+        directory = Path(filename).parent
+        dependencies = [(os.path.relpath(path, directory), _digest(path)) for path in sorted(dependencies)]
+        self._add((Path(filename).name, state[3]), dependencies, dict(entry))
+        if self.backing:
+            self.backing.put(filename, entry, dependencies=[directory / path for path, _ in dependencies], state=state)
+
+    def get_blob(self, key):
+        with self._lock:
+            data = self._blobs.get(key)
+        if data is None and self.backing:
+            data = self.backing.get_blob(key)
+        return data
+
+    def put_blob(self, key, data):
+        with self._lock:
+            if key not in self._blobs:
+                self._blobs[key] = data
+                self.size += len(data)
+                self._evict()
+        if self.backing:
+            self.backing.put_blob(key, data)
+
+    def log_report(self):
+        logger.info("Shared cache hits: %d, misses: %d", self.hits, self.misses)
+
+    def _add(self, key, dependencies, entry):
+        with self._lock:
+            self._entries.setdefault(key, []).append((dependencies, entry))
+            self._entries.move_to_end(key)
+            self.size += len(entry["data"])
+            self._evict()
+
+    def _evict(self):
+        # The most recent entry is always kept
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, candidates = self._entries.popitem(last=False)
+            self.size -= sum(len(entry["data"]) for _, entry in candidates)
+        while self.size > self.max_size and self._blobs:
+            _, data = self._blobs.popitem(last=False)
+            self.size -= len(data)
+
+
+def _dump_entry(entry):
+    """Serialize an entry, whose `data` may be text or raw bytes"""
+
+    if isinstance(entry["data"], bytes):
+        # JSON without indentation has no line breaks
+        metadata = {key: value for key, value in entry.items() if key != "data"}
+        return json.dumps(metadata).encode() + b"\n" + entry["data"]
+    return json.dumps(entry).encode()
+
+
+def _load_entry(data):
+    metadata, _, raw = data.partition(b"\n")
+    entry = json.loads(metadata)
+    if "data" not in entry:
+        entry["data"] = raw
+    return entry
+
+
+def read_file(filename):
+    """Return the contents of a file and its state, to store an entry prepared from these contents
+
+    The state is `[path, size, mtime_ns, hash]`, where the hash is the hash of
+    the returned contents. The file is examined before it is read, so if it
+    changes in between, the state does not match the file anymore.
+    """
+
+    stat = Path(filename).stat()
+    data = Path(filename).read_bytes()
+    return data, [str(filename), stat.st_size, stat.st_mtime_ns, hashlib.blake2b(data, digest_size=16).hexdigest()]
+
+
+def _content_key(filename):
+    digest = _digest(filename)
+    return None if digest is None else (Path(filename).name, digest)
+
+
+def _digest(filename):
+    """Return the hash of a file, or None if it does not exist"""
+    state = _file_state(filename)
+    return state and state[3]
+
+
+def _file_state(filename):
+    """Return `[path, size, mtime_ns, hash]` of a file, or None if it does not exist"""
+    try:
+        return read_file(filename)[1]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _is_unchanged(state):
+    """Check whether a file still matches a state returned by `_file_state`
+
+    Files whose size and modification time match are assumed to be
+    unchanged. Otherwise the contents are hashed, so touching a file does
+    not invalidate entries.
+    """
+    filename, size, mtime_ns, digest = state
+    try:
+        stat = Path(filename).stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return digest is None
+    if digest is None:
+        return False
+    if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+        return True
+    current = _file_state(filename)
+    return current is not None and current[3] == digest
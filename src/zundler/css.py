@@ -0,0 +1,155 @@
+"""
+Rewrite references to other files in CSS.
+
+This is a minimal tokenizer that recognizes only the tokens that matter for
+embedding resources: comments, strings, `url()` and `@import` rules. The
+style sheet is scanned once from start to end. Everything but the rewritten
+tokens is copied verbatim, and the output is joined once at the end, so the
+cost is linear in the size of the style sheet.
+
+URLs in comments or strings are left alone, and escape sequences in URLs are
+resolved according to the CSS syntax specification.
+
+"""
+
+import re
+
+# The start of all tokens we are interested in. `url(` and `@import` must not
+# be the tail of a longer identifier.
+_TOKEN_START = re.compile(
+    rb"""/\*|["']|(?<![\w\-\\\x80-\xff])(?:url\(|@import(?![\w\-\\\x80-\xff]))""",
+    re.IGNORECASE,
+)
+_STRING = {quote: re.compile(rb"%s((?:[^%s\\\n]|\\[\s\S])*)(%s)?" % (quote, quote, quote)) for quote in [b'"', b"'"]}
+_WHITESPACE = re.compile(rb"\s*")
+# A hex escape may be followed by one whitespace character, which ends it
+_UNQUOTED_URL = re.compile(rb"""((?:[^\s"'()\\]|\\[0-9a-fA-F]{1,6}[ \t\r\n\f]?|\\[\s\S])*)\s*\)""")
+_CLOSING_PAREN = re.compile(rb"\s*\)")
+_FORMAT = re.compile(rb"""\s*format\(\s*(["'])(.*?)\1\s*\)""", re.IGNORECASE)
+_ESCAPE = re.compile(r"\\(?:([0-9a-fA-F]{1,6})[ \t\r\n\f]?|(\n)|([\s\S]))")
+
+
+def rewrite(css, on_url, on_import):
+    """Rewrite the `url()` tokens and `@import` rules of a style sheet
+
+    `css` is the style sheet as bytes.
+
+    `on_url(url, format)` is called for each `url()` token outside of
+    `@import` rules with the unescaped URL and the value of a subsequent
+    `format()` hint, if any. It returns the bytes that replace the token, or
+    None to keep it.
+
+    `on_import(url, media)` is called for each `@import` rule with the
+    unescaped URL and the remaining prelude of the rule, e.g. a media query.
+    It returns the bytes that replace the whole rule, or None to keep it.
+    """
+
+    result = []
+    last = 0
+    pos = 0
+
+    while True:
+        m = _TOKEN_START.search(css, pos)
+        if not m:
+            break
+        start = m.start()
+        token = m.group().lower()
+
+        if token == b"/*":
+            end = css.find(b"*/", start + 2)
+            pos = len(css) if end < 0 else end + 2
+            continue
+
+        if token in _STRING:
+            pos = _STRING[token].match(css, start).end()
+            continue
+
+        if token == b"url(":
+            parsed = _parse_url(css, m.end())
+            if not parsed:
+                pos = m.end()
+                continue
+            url, end = parsed
+            hint = _FORMAT.match(css, end)
+            replacement = on_url(url, hint[2].decode() if hint else None)
+        else:
+            parsed = _parse_import(css, m.end())
+            if not parsed:
+                pos = m.end()
+                continue
+            url, media, end = parsed
+            replacement = on_import(url, media)
+
+        if replacement is not None:
+            result.append(css[last:start])
+            result.append(replacement)
+            last = end
+        pos = end
+
+    result.append(css[last:])
+    return b"".join(result)
+
+
+def _parse_url(css, pos):
+    """Parse the rest of a `url(` token
+
+    Return the unescaped URL and the position after the closing parenthesis,
+    or None if the token is malformed.
+    """
+    pos = _WHITESPACE.match(css, pos).end()
+    quote = css[pos : pos + 1]
+    if quote in _STRING:
+        m = _STRING[quote].match(css, pos)
+        if not m[2]:
+            return None
+        closing = _CLOSING_PAREN.match(css, m.end())
+        if not closing:
+            return None
+        return _unescape(m[1]), closing.end()
+
+    m = _UNQUOTED_URL.match(css, pos)
+    if not m:
+        return None
+    return _unescape(m[1]), m.end()
+
+
+def _parse_import(css, pos):
+    """Parse the rest of an `@import` rule
+
+    Return the unescaped URL, the remaining prelude and the position after
+    the rule, or None if the rule is malformed.
+    """
+    pos = _WHITESPACE.match(css, pos).end()
+    quote = css[pos : pos + 1]
+    if css[pos : pos + 4].lower() == b"url(":
+        parsed = _parse_url(css, pos + 4)
+        if not parsed:
+            return None
+        url, pos = parsed
+    elif quote in _STRING:
+        m = _STRING[quote].match(css, pos)
+        if not m[2]:
+            return None
+        url, pos = _unescape(m[1]), m.end()
+    else:
+        return None
+
+    end = css.find(b";", pos)
+    if end < 0:
+        end = len(css)
+    return url, css[pos:end].strip(), end + 1
+
+
+def _unescape(raw):
+    def replace(m):
+        if m[1]:
+            codepoint = int(m[1], 16)
+            if codepoint == 0 or codepoint > 0x10FFFF or 0xD800 <= codepoint <= 0xDFFF:
+                return "\ufffd"
+            return chr(codepoint)
+        if m[2]:
+            # An escaped newline in a string is a line continuation
+            return ""
+        return m[3]
+
+    return _ESCAPE.sub(replace, raw.decode(errors="replace"))
@@ -16,15 +16,31 @@ Author: Adrian Vollmer
 """
 
 import base64
+import functools
+import hashlib
 import json
 import logging
 import mimetypes
+import os
 import re
+import threading
 import zlib
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from fnmatch import fnmatch
 from pathlib import Path
 
+from zundler import css as css_tokenizer
 from zundler.args import __version__
+from zundler.cache import DEFAULT_MAX_SIZE as DEFAULT_CACHE_SIZE
+from zundler.cache import MemoryCache, PreparedCache, read_file
+from zundler.extract import iter_files, read_index
+from zundler.images import ImageOptimizer
+from zundler.minify import Minifier
+from zundler.prerender import prerender as prerender_page
+from zundler.reachability import reachable_files
+from zundler.report import stage
+from zundler.search import is_search_index, page_summary
 
 logger = logging.getLogger(__name__)
 
@@ -38,8 +54,77 @@ except ImportError as e:
 
 SCRIPT_PATH = Path(__file__).resolve().parent
 
+TEMPLATE = """
+<!DOCTYPE html>
+<!--
+This document has been prepared using Zundler {version}.
+You can use zundler to inspect the files embedded below: `zundler -x <file>`
+Alternatively, press CTRL-Shift-Z.
+https://github.com/AdrianVollmer/Zundler
+-->
+<html>
+<head><style>{style}</style></head>
+<body>{body}
+<script>const zundler_version = "{version}"</script>
+{payload}
+<script id="zundler-common">{common}</script>
+<script>{bootstrap}</script>
+</body><!-- {license} --></html>
+"""
+
+# The payload is streamed into the output file, so the template is split in
+# two at this marker.
+PAYLOAD_PLACEHOLDER = "\0"
+
+# Formats that are compressed already. Deflating them again costs time and
+# hardly saves any space, so they are stored as they are in archive mode.
+COMPRESSED_MIME_TYPES = {
+    "application/gzip",
+    "application/zip",
+    "font/woff",
+    "font/woff2",
+    "image/avif",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+}
+
+
+def embed_assets(
+    index_file,
+    output_path=None,
+    append_pre="",
+    append_post="",
+    debug=False,
+    jobs=1,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    archive=False,
+    prerender=False,
+    minify=False,
+    optimize_images=False,
+    tree_shake=False,
+    keep=(),
+    accelerate_search=False,
+    report=None,
+    cache=None,
+    executor=None,
+):
+    """Bundle the document `index_file` and all files next to it
+
+    If `report` is a `BuildReport`, the timings of all stages and the sizes
+    of all files are recorded in it, see `zundler.report`.
+
+    With a cache, the entries of files are reused if their size and
+    modification time, or else their contents, are the same. In archive
+    mode, the compressed files are cached as well.
+
+    To bundle several documents in one go, pass the same open `cache`, e.g.
+    a `MemoryCache`, instead of `cache_dir`, and the same `executor` with
+    `jobs` threads to each call, see `zundler.batch`. Neither is closed.
+    """
 
-def embed_assets(index_file, output_path=None, append_pre="", append_post="", debug=False):
     debug_const = f"const DEBUG = {'true' if debug else 'false'};"
 
     init_files = {}
@@ -54,8 +139,7 @@ def embed_assets(index_file, output_path=None, append_pre="", append_post="", de
         "inject_post.js",
         "LICENSE",
     ]:
-        path = SCRIPT_PATH / "assets" / filename
-        init_files[filename] = path.read_text()
+        init_files[filename] = _read_asset(filename)
 
         if filename == "zundler_main.js":
             init_files[filename] = debug_const + init_files[filename]
@@ -80,98 +164,567 @@ def embed_assets(index_file, output_path=None, append_pre="", append_post="", de
     if not output_path:
         output_path = base_dir / new_base_name
 
-    file_tree = load_filetree(
+    own_cache = cache is None and cache_dir
+    if own_cache:
+        cache = open_cache(
+            cache_dir,
+            cache_size=cache_size,
+            prerender=prerender,
+            minify=minify,
+            optimize_images=optimize_images,
+            accelerate_search=accelerate_search,
+        )
+
+    file_tree = iter_filetree(
         base_dir,
         exclude_pattern=new_base_name,
+        jobs=jobs,
+        cache=cache,
+        prerender=prerender,
+        minify=minify,
+        optimize_images=optimize_images,
+        root=base_name if tree_shake else None,
+        keep=keep,
+        accelerate_search=accelerate_search,
+        report=report,
+        executor=executor,
+        encode_binary=not archive,
     )
 
-    global_context = {
-        "current_path": base_name,
-        "fileTree": file_tree,
-        "utils": {
-            "zundler_main": init_files["zundler_main.js"],
-            "zundler_common": init_files["zundler_common.js"],
-            "inject_pre": init_files["inject_pre.js"],
-            "inject_post": init_files["inject_post.js"],
-        },
+    utils = {
+        "zundler_main": init_files["zundler_main.js"],
+        "inject_pre": init_files["inject_pre.js"],
+        "inject_post": init_files["inject_post.js"],
     }
 
-    global_context_serialized = json.dumps(global_context)
-    logger.debug("total asset size: %d", len(global_context_serialized))
-    global_context_zipped = deflate(global_context_serialized)
-    logger.debug("total asset size (compressed): %d", len(global_context_zipped))
-
-    result = """
-<!DOCTYPE html>
-<!--
-This document has been prepared using Zundler {version}.
-You can use zundler to inspect the files embedded below: `zundler -x <file>`
-Alternatively, press CTRL-Shift-Z.
-https://github.com/AdrianVollmer/Zundler
--->
-<html>
-<head><style>{style}</style></head>
-<body>{body}
-<script>const zundler_version = "{version}"</script>
-<script>window.globalContext = "{global_context}"</script>
-<script>{bootstrap}</script>
-</body><!-- {license} --></html>
-""".format(
+    result = TEMPLATE.format(
         style=init_files["init.css"],
         body=init_files["init.html"],
+        common=init_files["zundler_common.js"],
         bootstrap=init_files["zundler_bootstrap.js"],
         license=init_files["LICENSE"],
         version=__version__,
-        global_context=global_context_zipped,
+        payload=PAYLOAD_PLACEHOLDER,
     )
+    head, tail = result.split(PAYLOAD_PLACEHOLDER)
+    if report:
+        report.runtime_size = len(head.encode()) + len(tail.encode())
+    write_payload = functools.partial(write_archive, cache=cache) if archive else write_global_context
 
     if hasattr(output_path, "write"):
-        output_path.write(result)
+        with stage(report, "write"):
+            output_path.write(head)
+        write_payload(output_path, base_name, file_tree, utils, report=report)
+        with stage(report, "write"):
+            output_path.write(tail)
     else:
-        Path(output_path).write_text(result)
+        # Files are only prepared while the bundle is written, so write to a
+        # temporary file first, lest a failed build destroys the last bundle
+        output_path = Path(output_path)
+        partial_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+        try:
+            with partial_path.open("w") as fp:
+                with stage(report, "write"):
+                    fp.write(head)
+                write_payload(fp, base_name, file_tree, utils, report=report)
+                with stage(report, "write"):
+                    fp.write(tail)
+            partial_path.replace(output_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+
+    if own_cache:
+        cache.close()
+
+    if report:
+        report.finish(None if hasattr(output_path, "write") else Path(output_path).stat().st_size)
 
     logger.info("Result written to: %s", output_path)
     return output_path
 
 
-def prepare_file(filename):
+@functools.cache
+def _read_asset(filename):
+    return (SCRIPT_PATH / "assets" / filename).read_text()
+
+
+def open_cache(
+    cache_dir,
+    cache_size=DEFAULT_CACHE_SIZE,
+    prerender=False,
+    minify=False,
+    optimize_images=False,
+    accelerate_search=False,
+):
+    """Open the cache of files prepared with these options"""
+
+    return PreparedCache(
+        cache_dir,
+        max_size=cache_size,
+        options={
+            "prerender": prerender,
+            "minify": minify,
+            "optimize_images": optimize_images,
+            "accelerate_search": accelerate_search,
+        },
+    )
+
+
+class BackgroundPreparer:
+    """Prepare files into the cache while they are still being written
+
+    A generator like Sphinx writes one file after another. Each file it has
+    written can be submitted with `submit`, and is then prepared by a pool of
+    `jobs` threads and stored in the cache in `cache_dir`, or in a
+    `MemoryCache` without one. Once all files are written, `close` waits for
+    the pool. `embed_assets` with the same cache and options, i.e. the same
+    `cache_dir` or `cache`, then takes these files from the cache instead of
+    preparing them again. Pass `archive` if the bundle is an archive.
+
+    Files are only submitted from the process that created the instance, so
+    it is not shared with worker processes.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        jobs=1,
+        cache_size=DEFAULT_CACHE_SIZE,
+        prerender=False,
+        minify=False,
+        optimize_images=False,
+        accelerate_search=False,
+        archive=False,
+    ):
+        if cache_dir:
+            self.cache = open_cache(
+                cache_dir,
+                cache_size=cache_size,
+                prerender=prerender,
+                minify=minify,
+                optimize_images=optimize_images,
+                accelerate_search=accelerate_search,
+            )
+        else:
+            self.cache = MemoryCache()
+        self.prerender = prerender
+        self.accelerate_search = accelerate_search
+        self.archive = archive
+        self.minifier = Minifier() if minify else None
+        self.image_optimizer = ImageOptimizer(self.cache) if optimize_images else None
+        self.css_graph = CssAssetGraph(image_optimizer=self.image_optimizer)
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        self._futures = {}
+
+    def submit(self, filename):
+        if os.getpid() != self.pid:
+            return
+        self._futures[str(filename)] = self._executor.submit(
+            prepare_cached_file,
+            str(filename),
+            self.cache,
+            self.css_graph,
+            prerender=self.prerender,
+            minifier=self.minifier,
+            image_optimizer=self.image_optimizer,
+            accelerate_search=self.accelerate_search,
+            encode_binary=not self.archive,
+        )
+
+    def close(self):
+        """Wait for all submitted files and close the cache in `cache_dir`
+
+        A `MemoryCache` is not closed, so it can be passed to `embed_assets`.
+        """
+
+        if os.getpid() != self.pid:
+            return
+        self._executor.shutdown(wait=True)
+        for filename, future in self._futures.items():
+            # The file is prepared again when it is bundled
+            if future.exception():
+                logger.warning("Cannot prepare %s in advance: %s", filename, future.exception())
+        logger.debug("Prepared %d files in advance", len(self._futures))
+        self._futures.clear()
+        if isinstance(self.cache, PreparedCache):
+            self.cache.close()
+
+
+def prepare_file(
+    filename,
+    css_graph=None,
+    prerender=False,
+    minifier=None,
+    image_optimizer=None,
+    accelerate_search=False,
+    report=None,
+    buffer=None,
+    encode_binary=True,
+):
     """Prepare a file for the file tree
 
     Referenced assets in CSS files will be embedded.
     HTML files will be injected with two scripts.
 
     `filename`: The name of the file
+    `css_graph`: The `CssAssetGraph` shared by all style sheets of a bundle
+    `prerender`: Rewrite HTML files ahead of time, see `zundler.prerender`
+    `minifier`: The `Minifier` of a bundle, if HTML, CSS and JS files are to be minified
+    `image_optimizer`: The `ImageOptimizer` of a bundle, if images are to be recompressed
+    `accelerate_search`: Prepare Sphinx' search index and page summaries, see `zundler.search`
+    `report`: The `BuildReport` of a bundle, if the build is profiled
+    `buffer`: The contents of the file, if they have been read already
+    `encode_binary`: Whether to base64-encode binary files, or keep their raw bytes for the archive
 
     """
     ext = Path(filename).suffix.lower()[1:]
-    buffer = Path(filename).read_bytes()
-    mime_type = get_mime_type(filename, buffer)
+    if buffer is None:
+        with stage(report, "read"):
+            buffer = Path(filename).read_bytes()
+    with stage(report, "mime"):
+        mime_type = get_mime_type(filename, buffer)
     base64encoded = False
 
     if ext == "css":
         # assuming all CSS files have names ending in '.css'
-        buffer = embed_css_resources(buffer, filename)
+        size = len(buffer)
+        with stage(report, "css"):
+            buffer = embed_css_resources(buffer, filename, graph=css_graph)
+        if report:
+            report.add_css_inlined(filename, len(buffer) - size)
+    elif image_optimizer:
+        with stage(report, "optimize_images"):
+            buffer = image_optimizer.optimize(buffer, mime_type)
 
     try:
         data = buffer.decode()
     except UnicodeError:
-        data = base64.b64encode(buffer).decode()
+        data = base64.b64encode(buffer).decode() if encode_binary else buffer
         base64encoded = True
 
-    logger.debug("loaded file: %s [%s, %d bytes]", filename, mime_type, len(data))
-
-    return {
+    entry = {
         "data": data,
         "mime_type": mime_type,
         "base64encoded": base64encoded,
     }
 
+    is_html = mime_type == "text/html" or ext == "html"
+
+    if accelerate_search and not base64encoded:
+        with stage(report, "search"):
+            if Path(filename).name == "searchindex.js" and is_search_index(data):
+                entry["search_index"] = True
+            elif is_html:
+                summary = page_summary(data)
+                if summary is not None:
+                    entry["summary"] = summary
+
+    if minifier and not base64encoded:
+        with stage(report, "minify"):
+            entry["data"] = minifier.minify(data, filename)
+
+    if prerender and not base64encoded and is_html:
+        with stage(report, "prerender"):
+            page = prerender_page(entry["data"])
+        if page:
+            entry["data"], entry["title"] = page
+            entry["prerendered"] = True
+        else:
+            logger.debug("Cannot prerender %s", filename)
+
+    logger.debug("loaded file: %s [%s, %d bytes]", filename, mime_type, len(entry["data"]))
+
+    return entry
+
+
+def prepare_cached_file(
+    filename,
+    cache,
+    css_graph,
+    prerender=False,
+    minifier=None,
+    image_optimizer=None,
+    accelerate_search=False,
+    report=None,
+    encode_binary=True,
+):
+    """Like `prepare_file`, but look up the entry in the cache first"""
+
+    with stage(report, "cache"):
+        entry = cache.get(filename)
+    if entry is not None:
+        # The entry may have been prepared for the other bundle format
+        data = entry["data"]
+        if encode_binary and isinstance(data, bytes):
+            entry["data"] = base64.b64encode(data).decode()
+        elif not encode_binary and entry["base64encoded"] and isinstance(data, str):
+            entry["data"] = base64.b64decode(data)
+    else:
+        # The entry is stored with the state of the contents it was prepared
+        # from, so the file is neither read twice nor stored with a newer state
+        with stage(report, "read"):
+            buffer, state = read_file(filename)
+        entry = prepare_file(
+            filename,
+            css_graph=css_graph,
+            prerender=prerender,
+            minifier=minifier,
+            image_optimizer=image_optimizer,
+            accelerate_search=accelerate_search,
+            report=report,
+            buffer=buffer,
+            encode_binary=encode_binary,
+        )
+        with stage(report, "cache"):
+            cache.put(filename, entry, css_graph.dependencies(filename), state=state)
+    return entry
+
 
 def deflate(data: str) -> str:
     data_zipped = zlib.compress(data.encode())
     return base64.b64encode(data_zipped).decode()
 
 
+class Base64Writer:
+    """Write bytes base64-encoded to a text stream
+
+    Data is encoded in chunks whose length is a multiple of three bytes, so
+    the concatenation of all chunks is one valid base64 string. `size` is the
+    number of bytes written so far.
+    """
+
+    def __init__(self, fp, report=None):
+        self.fp = fp
+        self.report = report
+        self.pending = b""
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        data = self.pending + data
+        aligned = len(data) - len(data) % 3
+        self.pending = data[aligned:]
+        with stage(self.report, "write"):
+            self.fp.write(base64.b64encode(data[:aligned]).decode())
+
+    def close(self):
+        with stage(self.report, "write"):
+            self.fp.write(base64.b64encode(self.pending).decode())
+        self.pending = b""
+
+
+class DeflateWriter:
+    """Compress text and write it base64-encoded to a text stream
+
+    This is the streaming equivalent of `deflate`. With a `report`, the
+    compressed bytes are attributed to the files whose contents are written
+    with a `path`. Deflate emits its output in blocks, and each block is
+    split by size among the texts fed to it since the last one, including
+    the text that was fed when the last one was emitted.
+    """
+
+    def __init__(self, fp, report=None):
+        self.output = Base64Writer(fp, report=report)
+        self.compressor = zlib.compressobj()
+        self.report = report
+        self.size = 0
+        # `(path, size)` of the texts fed since the last output
+        self._fed = []
+
+    @property
+    def compressed_size(self):
+        return self.output.size
+
+    def write(self, text, path=None):
+        data = text.encode()
+        self.size += len(data)
+        with stage(self.report, "compress"):
+            compressed = self.compressor.compress(data)
+        self.output.write(compressed)
+        self._attribute(path, len(data), len(compressed))
+
+    def close(self):
+        with stage(self.report, "compress"):
+            compressed = self.compressor.flush()
+        self.output.write(compressed)
+        self.output.close()
+        self._attribute(None, 0, len(compressed))
+
+    def _attribute(self, path, size, compressed):
+        if not self.report:
+            return
+        self._fed.append((path, size))
+        if not compressed:
+            return
+        total = sum(size for _, size in self._fed) or 1
+        for path, size in self._fed:
+            if path is not None:
+                self.report.add_compressed(path, compressed * size // total)
+        # The rest of the last text may still be buffered
+        self._fed = self._fed[-1:]
+
+
+def write_global_context(fp, current_path, file_tree, utils, report=None):
+    """Serialize, compress and encode the global context into a text stream
+
+    `file_tree` is an iterable of `(path, entry)` pairs. It is consumed one
+    entry at a time, so the whole file tree is never held in memory.
+
+    The contents of all files go into `blobs`, keyed by content hash, and
+    are written only once even if several paths share the same contents.
+    The `fileTree` then only maps paths to the metadata, the blob key and
+    the `size` of the contents in bytes. Page summaries for the search, see
+    `zundler.search`, are blobs as well, and the `summary` of a page in the
+    `fileTree` is `{"blob": key}`.
+    Each blob ends up on a line of its own in the JSON document.
+    """
+    fp.write('<script>window.globalContext = "')
+    writer = DeflateWriter(fp, report=report)
+    writer.write(f'{{"current_path": {json.dumps(current_path)}, "blobs": {{')
+
+    index = {}
+    blobs = set()
+    separator = "\n"
+
+    def add_blob(path, data, encoded):
+        nonlocal separator
+        key = content_hash(encoded)
+        if key in blobs:
+            logger.debug("Deduplicated file %s", path)
+        else:
+            with stage(report, "serialize"):
+                blob = f"{separator}{json.dumps(key)}: {json.dumps(data)}"
+            writer.write(blob, path=path)
+            separator = ",\n"
+            blobs.add(key)
+        return key
+
+    for path, entry in file_tree:
+        data = entry["data"]
+        encoded = data.encode()
+        index[path] = _index_entry(entry)
+        index[path]["blob"] = add_blob(path, data, encoded)
+        index[path]["size"] = _base64_size(data) if entry["base64encoded"] else len(encoded)
+        if "summary" in entry:
+            index[path]["summary"] = {"blob": add_blob(path, entry["summary"], entry["summary"].encode())}
+
+    with stage(report, "serialize"):
+        end = (
+            f'\n}}, "fileTree": {json.dumps(index)}, "utils": {json.dumps(utils)}'
+            f', "summaries": {json.dumps(_has_summaries(index))}}}'
+        )
+    writer.write(end)
+    writer.close()
+    fp.write('"</script>')
+
+    logger.debug("total asset size: %d", writer.size)
+    logger.debug("total asset size (compressed): %d", writer.compressed_size)
+
+
+def write_archive(fp, current_path, file_tree, utils, report=None, cache=None):
+    """Write the file tree as an archive of individually compressed files
+
+    Every unique file content is compressed on its own and appended to the
+    archive, which is written base64-encoded to `window.zundlerArchive`.
+    The global context only holds an index that maps each path to the byte
+    range and the `size` of its contents, so the browser can decode the index right away
+    and inflate the files on demand.
+
+    Page summaries for the search are archive members of their own, and the
+    `summary` of a page in the index is the byte range of its summary. So
+    the summaries are only inflated when search results are shown.
+
+    Binary files are stored as raw bytes, so they are base64-encoded only
+    once. Their entries should be prepared with `encode_binary=False`, so
+    they are not encoded and decoded before that. Files in an already compressed format are not deflated again;
+    the `method` of each entry is either "deflate" or "store". If `cache` is
+    a `PreparedCache`, compressed files are looked up in it by content hash.
+    """
+    fp.write('<script>window.zundlerArchive = "')
+    writer = Base64Writer(fp, report=report)
+
+    index = {}
+    ranges = {}
+    size = 0
+
+    def add_member(path, data, mime_type):
+        nonlocal size
+        key = content_hash(data)
+        if key in ranges:
+            logger.debug("Deduplicated file %s", path)
+        else:
+            with stage(report, "compress"):
+                method, packed = pack_archive_entry(data, mime_type, cache=cache)
+            ranges[key] = (writer.size, len(packed), method)
+            writer.write(packed)
+            size += len(data)
+            if report:
+                report.add_compressed(path, len(packed))
+        return dict(zip(["offset", "length", "method"], ranges[key], strict=True))
+
+    for path, entry in file_tree:
+        data = entry["data"]
+        if isinstance(data, str):
+            data = base64.b64decode(data) if entry["base64encoded"] else data.encode()
+        index[path] = _index_entry(entry)
+        index[path].update(add_member(path, data, entry["mime_type"]))
+        index[path]["size"] = len(data)
+        if "summary" in entry:
+            index[path]["summary"] = add_member(path, entry["summary"].encode(), "text/html")
+
+    writer.close()
+    fp.write('"</script>\n')
+
+    global_context = {
+        "current_path": current_path,
+        "fileTree": index,
+        "utils": utils,
+        "summaries": _has_summaries(index),
+    }
+    with stage(report, "serialize"):
+        global_context = json.dumps(global_context)
+    with stage(report, "compress"):
+        global_context = deflate(global_context)
+    with stage(report, "write"):
+        fp.write(f'<script>window.globalContext = "{global_context}"</script>')
+
+    logger.debug("total asset size: %d", size)
+    logger.debug("total asset size (compressed): %d", writer.size)
+
+
+def _index_entry(entry):
+    """Return the metadata of a prepared file for the index of a bundle"""
+
+    return {k: v for k, v in entry.items() if k not in ("data", "summary")}
+
+
+def _has_summaries(index):
+    # Tells the runtime whether to ask for summaries at all
+    return any("summary" in entry for entry in index.values())
+
+
+def pack_archive_entry(data, mime_type, cache=None):
+    """Return the method and the bytes with which a file is stored in the archive"""
+
+    if mime_type not in COMPRESSED_MIME_TYPES:
+        key = f"deflate {content_hash(data)}"
+        compressed = cache.get_blob(key) if cache else None
+        if compressed is None:
+            compressed = zlib.compress(data)
+            if cache:
+                cache.put_blob(key, compressed)
+        if len(compressed) < len(data):
+            return "deflate", compressed
+    return "store", data
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
 def to_data_uri(filename, mime_type=None):
     """Create a data URI from the contents of a file"""
 
@@ -185,96 +738,190 @@ def to_data_uri(filename, mime_type=None):
     return f"data:{mime_type};charset=utf-8;base64, {data.decode()}"
 
 
-def _resolve_css_url(url_bytes, filename):
-    """Resolve a relative URL from a CSS file to a filesystem path."""
-    path = url_bytes.decode()
+def _base64_size(data):
+    """Return the number of bytes encoded in a base64 string"""
 
-    if "?" in path:
-        path = path.split("?")[0]
-    if "#" in path:
-        path = path.split("#")[0]
+    return len(data) * 3 // 4 - data[-2:].count("=")
 
-    return str(Path(filename).parent / path)
 
+def _resolve_css_url(url, filename):
+    """Resolve a relative URL from a CSS file to a filesystem path."""
+    path = url.split("?")[0].split("#")[0]
 
-def embed_css_resources(css, filename):
-    """Replace `url(<path>)` with `url(data:<mime_type>;base64, ...)`
+    return os.path.normpath(Path(filename).parent / path)
 
-    Also, handle @import by inlining the imported CSS directly."""
-    # This uses some heuristics which will fail in general.
-    # Eventually a library like tinycss2 might be preferable.
-
-    # Handle @import: inline imported CSS content directly rather than using
-    # data URIs, because @import url("data:...") doesn't work reliably in
-    # inline <style> elements (especially in srcdoc iframes).
-    # Both forms are valid: @import url("foo.css"); and @import "foo.css";
-    import_regex = (
-        rb"""(?P<rule>@import\s+(?:url\(\s*['"]?(?P<url_func>[^'"\)]+?)['"]?\s*\)"""
-        rb"""|['"](?P<url_str>[^'"]+)['"]);)"""
-    )
-    import_rules = {}
-    for m in re.finditer(import_regex, css, flags=re.IGNORECASE):
-        url = m["url_func"] or m["url_str"]
-        if url.lower().startswith(b"data:"):
-            continue
 
-        path = _resolve_css_url(url, filename)
+def _is_local_url(url):
+    """Check whether a URL in a CSS file references a local file"""
+    url = url.strip().lower()
+    return bool(url) and not (url.startswith(("#", "/", "data:")) or re.match(r"[a-z][a-z0-9+.-]*:", url))
 
-        try:
-            content = Path(path).read_bytes()
-        except FileNotFoundError as e:
-            logger.error(str(e))
-            continue
 
-        # Recursively process the imported CSS, using its own path for
-        # relative URL resolution
-        content = embed_css_resources(content, path)
-        import_rules[m["rule"]] = content
+def embed_css_resources(css, filename, graph=None):
+    """Replace `url(<path>)` with `url(data:<mime_type>;base64, ...)`
+
+    Also, handle @import by inlining the imported CSS directly. Pass a
+    `CssAssetGraph` to share resolved resources between style sheets."""
 
-    for orig, new in import_rules.items():
-        css = css.replace(orig, new)
+    if graph is None:
+        graph = CssAssetGraph()
+    return graph.embed(css, filename)
 
-    # Quotes are optional. But then URLs can contain escaped characters.
-    regex = (
-        rb"""(?P<url_statement>url\(['"]?(?P<url>.*?)['"]?\))"""
-        rb"""(\s*format\(['"](?P<format>.*?)['"]\))?"""
-    )
 
-    replace_rules = {}
+class CssAssetGraph:
+    """The resources referenced by the style sheets of one bundle
 
-    for m in re.finditer(regex, css, flags=re.IGNORECASE):
-        if re.match(b"""['"]?data:.*""", m["url"]):
-            continue
+    Each referenced resource is read and encoded only once, and each imported
+    style sheet is processed only once, no matter how many style sheets
+    reference it. The graph also records which style sheet pulled in which
+    files, and breaks import cycles.
 
-        path = _resolve_css_url(m["url"], filename)
+    An import cycle is cut where the chain of imports reaches a style sheet
+    a second time, so the result for a style sheet on a cycle depends on
+    where the chain started. These style sheets are processed again for
+    each chain instead of being reused, which keeps the result of each
+    style sheet independent of the order in which they are processed.
 
+    Instances can be shared between threads. Imported style sheets are
+    processed by one thread at a time, because import chains can cross
+    each other. If `image_optimizer` is given, images are recompressed
+    before they are embedded.
+    """
+
+    def __init__(self, image_optimizer=None):
+        self.image_optimizer = image_optimizer
+        self.edges = defaultdict(set)
+        self._imports = {}
+        # Imported style sheets that are on an import cycle
+        self._cyclic = set()
+        # Maps paths to futures of their resources
+        self._resources = {}
+        self._lock = threading.Lock()
+        self._import_lock = threading.RLock()
+
+    def embed(self, css, filename):
+        return self._embed(css, str(filename), (str(filename),))
+
+    def dependencies(self, filename):
+        """Return the paths of all files a style sheet pulls in, directly or not"""
+
+        result = set()
+        pending = [str(filename)]
+        with self._lock:
+            while pending:
+                for path in self.edges.get(pending.pop(), ()):
+                    if path not in result:
+                        result.add(path)
+                        pending.append(path)
+        return result
+
+    def log_report(self):
+        for filename, paths in sorted(self.edges.items()):
+            logger.debug("%s pulled in: %s", filename, ", ".join(sorted(paths)))
+
+    def _add_edge(self, filename, path):
+        with self._lock:
+            self.edges[filename].add(path)
+
+    def _embed(self, css, filename, stack):
+        def on_import(url, media):
+            # Inline imported CSS content directly rather than using data
+            # URIs, because @import url("data:...") doesn't work reliably in
+            # inline <style> elements (especially in srcdoc iframes).
+            if not _is_local_url(url):
+                return None
+
+            path = _resolve_css_url(url, filename)
+            self._add_edge(filename, path)
+
+            if path in stack:
+                logger.warning("Import cycle in CSS: %s", " -> ".join([*stack, path]))
+                with self._lock:
+                    self._cyclic.update(stack[stack.index(path) :])
+                return b""
+
+            content = self._import(path, stack)
+            if content is None or not media:
+                return content
+            if media.lower().startswith((b"layer", b"supports(")):
+                logger.warning("Ignoring conditions of @import in %s: %s", filename, media.decode())
+                return content
+            return b"@media %s {\n%s\n}" % (media, content)
+
+        def on_url(url, format_hint):
+            if not _is_local_url(url):
+                return None
+
+            path = _resolve_css_url(url, filename)
+            self._add_edge(filename, path)
+
+            resource = self._resource(path)
+            if resource is None:
+                return None
+            content, mime_type = resource
+
+            # The format hint takes precedence over the sniffed mime type
+            if format_hint:
+                mime_type = "font/" + format_hint
+
+            return b'url("data:%(mime_type)s;charset=utf-8;base64, %(content)s")' % {
+                b"content": content,
+                b"mime_type": mime_type.encode(),
+            }
+
+        return css_tokenizer.rewrite(css, on_url=on_url, on_import=on_import)
+
+    def _import(self, path, stack):
+        """Return the processed contents of an imported style sheet"""
+
+        with self._import_lock:
+            if path in self._imports:
+                return self._imports[path]
+            try:
+                content = Path(path).read_bytes()
+            except FileNotFoundError as e:
+                logger.error(str(e))
+                content = None
+            else:
+                # Recursively process the imported CSS, using its own path for
+                # relative URL resolution
+                content = self._embed(content, path, (*stack, path))
+            # All style sheets on a cycle through this one are on the stack
+            # while it is processed, so the cycle has been found by now
+            if path not in self._cyclic:
+                self._imports[path] = content
+            return content
+
+    def _resource(self, path):
+        """Return the base64-encoded contents and the mime type of a resource"""
+
+        with self._lock:
+            future = self._resources.get(path)
+            owner = future is None
+            if owner:
+                future = self._resources[path] = Future()
+        if owner:
+            try:
+                future.set_result(self._load_resource(path))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _load_resource(self, path):
         try:
             content = Path(path).read_bytes()
         except FileNotFoundError as e:
             logger.error(str(e))
-            continue
+            return None
 
         # If it's binary, determine mime type and encode in base64
-        if m["format"]:
-            mime_type = "font/" + m["format"].decode()
-        elif path[-3:].lower() == "eot":
-            mime_type = "font/eot"
-        else:
-            mime_type = get_mime_type(path, content)
+        mime_type = "font/eot" if path[-3:].lower() == "eot" else get_mime_type(path, content)
         if not mime_type:
             logger.error("Unable to determine mime type: %s", path)
             mime_type = "application/octet-stream"
-        content = base64.b64encode(content)
-
-        replace_rules[m["url_statement"]] = b'url("data:%(mime_type)s;charset=utf-8;base64, %(content)s")' % {
-            b"content": content,
-            b"mime_type": mime_type.encode(),
-        }
-
-    for orig, new in replace_rules.items():
-        css = css.replace(orig, new)
-
-    return css
+        if self.image_optimizer:
+            content = self.image_optimizer.optimize(content, mime_type)
+        return (base64.b64encode(content), mime_type)
 
 
 def get_mime_type(filename, buffer):
@@ -290,56 +937,246 @@ def get_mime_type(filename, buffer):
     return mime_type
 
 
-def load_filetree(base_dir, exclude_pattern=None):
+def load_filetree(
+    base_dir,
+    exclude_pattern=None,
+    jobs=1,
+    cache=None,
+    prerender=False,
+    minify=False,
+    optimize_images=False,
+    root=None,
+    keep=(),
+    accelerate_search=False,
+    report=None,
+):
     """Load entire directory in a dict"""
 
-    result = {}
+    return dict(
+        iter_filetree(
+            base_dir,
+            exclude_pattern=exclude_pattern,
+            jobs=jobs,
+            cache=cache,
+            prerender=prerender,
+            minify=minify,
+            optimize_images=optimize_images,
+            root=root,
+            keep=keep,
+            accelerate_search=accelerate_search,
+            report=report,
+        )
+    )
+
+
+def iter_filetree(
+    base_dir,
+    exclude_pattern=None,
+    jobs=1,
+    cache=None,
+    prerender=False,
+    minify=False,
+    optimize_images=False,
+    root=None,
+    keep=(),
+    accelerate_search=False,
+    report=None,
+    executor=None,
+    encode_binary=True,
+):
+    """Prepare all files in a directory one by one
+
+    Return an iterator of `(path, entry)` pairs in walk order. The directory
+    is walked right away, but files are only prepared as the iterator is
+    consumed.
+
+    With `jobs` > 1, the files are prepared concurrently by a pool of worker
+    threads. Reading files, sniffing mime types and compressing release the
+    GIL, and the result is the same as in the serial case. The threads are
+    taken from `executor` if given, e.g. to share them between bundles.
+
+    If `cache` is a `PreparedCache`, unchanged files are taken from it
+    instead of being prepared again. It must have been opened with the same
+    `prerender`, `minify`, `optimize_images` and `accelerate_search` options.
+
+    With `minify`, comments and whitespace are stripped from HTML, CSS and
+    JavaScript files, see `zundler.minify`. The bytes saved per file type
+    are logged once all files are prepared.
+
+    With `optimize_images`, images are recompressed losslessly, see
+    `zundler.images`. This includes images embedded in style sheets.
+
+    If `root` is given, only the files reachable from the root document with
+    this path are packed, as well as files matching one of the glob patterns
+    in `keep`, see `zundler.reachability`. The dropped files are logged.
+
+    With `accelerate_search`, Sphinx' search index is marked for the runtime
+    and the text of each page is stored for search result summaries, see
+    `zundler.search`.
+
+    If `report` is a `BuildReport`, the time spent in each stage and the
+    size of each file are recorded in it.
+
+    Without `encode_binary`, the `data` of binary files are their raw bytes
+    instead of base64, see `write_archive`.
+    """
+
     base_dir = Path(base_dir)
-    for path in base_dir.rglob("*"):
-        if exclude_pattern and fnmatch(path.name, exclude_pattern):
-            continue
-        if path.is_file():
+    with stage(report, "walk"):
+        paths = [
+            path
+            for path in base_dir.rglob("*")
+            if not (exclude_pattern and fnmatch(path.name, exclude_pattern)) and path.is_file()
+        ]
+    if root is not None:
+        with stage(report, "tree_shake"):
+            paths = _shake_tree(base_dir, paths, root, keep)
+    filenames = [path.as_posix() for path in paths]
+
+    image_optimizer = ImageOptimizer(cache) if optimize_images else None
+    css_graph = CssAssetGraph(image_optimizer=image_optimizer)
+    minifier = Minifier() if minify else None
+
+    def prepare(filename):
+        if cache:
+            return prepare_cached_file(
+                filename,
+                cache,
+                css_graph,
+                prerender=prerender,
+                minifier=minifier,
+                image_optimizer=image_optimizer,
+                accelerate_search=accelerate_search,
+                report=report,
+                encode_binary=encode_binary,
+            )
+        return prepare_file(
+            filename,
+            css_graph=css_graph,
+            prerender=prerender,
+            minifier=minifier,
+            image_optimizer=image_optimizer,
+            accelerate_search=accelerate_search,
+            report=report,
+            encode_binary=encode_binary,
+        )
+
+    def pack():
+        entries = _map_ordered(prepare, filenames, jobs, executor=executor)
+        for path, entry in zip(paths, entries, strict=True):
             key = path.relative_to(base_dir).as_posix()
-            result[key] = prepare_file(path.as_posix())
-            logger.debug("Packed file %s [%d]", key, len(result[key]))
-
+            logger.debug("Packed file %s [%d]", key, len(entry["data"]))
+            if report:
+                report.add_file(key, path.as_posix(), entry["mime_type"], path.stat().st_size, len(entry["data"]))
+            yield key, entry
+        css_graph.log_report()
+        if minifier:
+            minifier.log_report()
+        if image_optimizer:
+            image_optimizer.log_report()
+
+    return pack()
+
+
+def _shake_tree(base_dir, paths, root, keep):
+    """Return the paths that are reachable from the root document"""
+
+    reachable = reachable_files(base_dir, root, keep=keep)
+    result = []
+    dropped_size = 0
+    for path in paths:
+        key = path.relative_to(base_dir).as_posix()
+        if key in reachable:
+            result.append(path)
+        else:
+            size = path.stat().st_size
+            dropped_size += size
+            logger.info("Dropped unreachable file: %s [%d bytes]", key, size)
+    logger.info("Dropped %d unreachable files (%d bytes)", len(paths) - len(result), dropped_size)
     return result
 
 
-def extract_assets(input_path, output_path=None):
+def _map_ordered(func, items, jobs, executor=None):
+    """Like `map`, but spread over `jobs` threads
+
+    Results are yielded in order. Only a few items per worker are in flight
+    at any time, so memory usage stays bounded. The threads are taken from
+    `executor` if given.
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            yield from _map_ordered(func, items, jobs, executor=executor)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= 2 * jobs:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_assets(input_path, output_path=None, include=(), exclude=()):
     """Split a file generated by Zundler into its constituents
 
-    Important for debugging"""
+    Important for debugging. Only the files whose paths match any glob
+    pattern in `include`, if given, and none in `exclude` are extracted.
+    The bundle is read in a streaming fashion, see `zundler.extract`, so
+    only one file is held in memory at a time. Their metadata is written to
+    `file_tree.json`."""
 
     if not output_path:
         output_path = "."
 
-    html = Path(input_path).read_text()
+    output_path = Path(output_path)
+    file_tree = {}
+    for filename, file, data in _iter_bundle(input_path, include, exclude):
+        out_file = output_path / filename
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        out_file.write_bytes(data)
+        file_tree[filename] = {**file, "data": _preview(data, file["base64encoded"])}
+
+    with (output_path / "file_tree.json").open("w") as fp:
+        json.dump(dict(sorted(file_tree.items())), fp, indent=2)
+
+
+def list_assets(input_path, include=(), exclude=()):
+    """Return the paths and sizes of the files in a bundle as `(path, size)` pairs
+
+    Files are selected like in `extract_assets`. The sizes are taken from
+    the file tree, so no contents are decoded, except for bundles made
+    before the file tree had sizes.
+    """
 
     try:
-        # Find the base64 blob. Anchor on the exact assignment emitted by
-        # embed_assets; the '=' in the class covers base64 padding.
-        m = re.search(r'window\.globalContext = "(?P<blob>[A-Za-z0-9/+=]+)"', html)
-        if not m:
-            raise RuntimeError("No blob found")
-        blob = m.group("blob")
-        blob = base64.b64decode(blob)
-        blob = zlib.decompress(blob).decode()
-        blob = json.loads(blob)
-        file_tree = blob["fileTree"]
-    except Exception as e:
+        file_tree = read_index(input_path, include=include, exclude=exclude)
+    except (ValueError, zlib.error) as e:
         logger.error(str(e))
         logger.error("Does not look like a Zundler output file: %s", input_path)
         exit(1)
 
-    output_path = Path(output_path)
-    for filename, file in file_tree.items():
-        out_file = output_path / filename
-        out_file.parent.mkdir(parents=True, exist_ok=True)
-        data = file["data"]
-        data = base64.b64decode(data) if file["base64encoded"] else data.encode()
-        out_file.write_bytes(data)
-        file["data"] = file["data"][:100] + "..."
+    if all("size" in file for file in file_tree.values()):
+        return sorted((filename, file["size"]) for filename, file in file_tree.items())
+    return sorted((filename, len(data)) for filename, _, data in _iter_bundle(input_path, include, exclude))
 
-    with (output_path / "file_tree.json").open("w") as fp:
-        json.dump(file_tree, fp, indent=2)
+
+def _preview(data, base64encoded):
+    """Return the beginning of a file as it is stored in the file tree"""
+
+    if base64encoded:
+        return base64.b64encode(data[:75]).decode() + "..."
+    return data[:100].decode(errors="replace") + "..."
+
+
+def _iter_bundle(input_path, include, exclude):
+    try:
+        yield from iter_files(input_path, include=include, exclude=exclude)
+    except (ValueError, zlib.error) as e:
+        logger.error(str(e))
+        logger.error("Does not look like a Zundler output file: %s", input_path)
+        exit(1)
@@ -0,0 +1,237 @@
+"""
+Read the files of a bundle without loading all of it into memory.
+
+A bundle stores its files in one of two ways, see `write_global_context`
+and `write_archive` in `zundler.embed`:
+
+* In the global context, a compressed JSON document that holds the
+  contents of each file on a line of its own in `blobs`, followed by the
+  `fileTree` that maps paths to blob keys. Older bundles have no `blobs`
+  and keep the contents in the `fileTree`.
+* In an archive of individually compressed files, followed by a global
+  context that maps paths to their byte range in the archive.
+
+Either way, the index of the files comes after their contents. `iter_files`
+therefore reads a bundle twice: the first pass finds the index and skips
+the contents without decoding them, the second pass decodes and inflates
+the contents chunk by chunk and only keeps the selected files, one at a
+time. `read_index` only does the first pass. Files are selected with glob
+patterns on their paths, like `--keep`.
+
+"""
+
+import base64
+import json
+import zlib
+from fnmatch import fnmatch
+from pathlib import Path
+
+CHUNK_SIZE = 1 << 20
+
+GLOBAL_CONTEXT_MARKER = b'<script>window.globalContext = "'
+ARCHIVE_MARKER = b'<script>window.zundlerArchive = "'
+
+# The first bytes of a line in `blobs`: a quoted content hash, see
+# `content_hash` in `zundler.embed`
+BLOB_KEY_SIZE = 64
+
+
+def is_selected(path, include=(), exclude=()):
+    """Check whether a path matches any `include` pattern, if given, and no `exclude` pattern"""
+
+    if include and not any(fnmatch(path, pattern) for pattern in include):
+        return False
+    return not any(fnmatch(path, pattern) for pattern in exclude)
+
+
+def read_index(input_path, include=(), exclude=()):
+    """Return the file tree of a bundle with the selected files, without their contents
+
+    Raise `ValueError` if the input is not a bundle.
+    """
+
+    with Path(input_path).open("rb") as fp:
+        _, file_tree, _ = _read_index(fp, include, exclude)
+    return file_tree
+
+
+def iter_files(input_path, include=(), exclude=()):
+    """Yield `(path, entry, data)` for the selected files of a bundle
+
+    `entry` holds the metadata of the file from the file tree, and `data`
+    its contents as bytes. Files are yielded in the order in which they are
+    stored, not by path. Raise `ValueError` if the input is not a bundle.
+    """
+
+    with Path(input_path).open("rb") as fp:
+        offsets, file_tree, has_blobs = _read_index(fp, include, exclude)
+        if ARCHIVE_MARKER in offsets:
+            fp.seek(offsets[ARCHIVE_MARKER])
+            yield from _iter_archive(fp, file_tree)
+        elif has_blobs:
+            fp.seek(offsets[GLOBAL_CONTEXT_MARKER])
+            yield from _iter_blobs(fp, file_tree)
+        else:
+            for path, entry in file_tree.items():
+                data = entry.pop("data")
+                yield path, entry, _decode(data, entry)
+
+
+def _read_index(fp, include, exclude):
+    """Return the offsets of the payloads, the selected part of the file tree and whether it has blobs"""
+
+    offsets = _find_markers(fp, [ARCHIVE_MARKER, GLOBAL_CONTEXT_MARKER])
+    if GLOBAL_CONTEXT_MARKER not in offsets:
+        raise ValueError("No blob found")
+
+    fp.seek(offsets[GLOBAL_CONTEXT_MARKER])
+    # Only the lines that are not blobs, i.e. everything but the contents
+    lines = _iter_lines(_inflate(_iter_base64(fp)), lambda start: not start.startswith(b'"'))
+    global_context = json.loads(b"".join(lines))
+    file_tree = {
+        path: entry for path, entry in global_context["fileTree"].items() if is_selected(path, include, exclude)
+    }
+    return offsets, file_tree, "blobs" in global_context
+
+
+def _iter_blobs(fp, file_tree):
+    paths = {}
+    for path, entry in file_tree.items():
+        paths.setdefault(json.dumps(entry["blob"]).encode(), []).append(path)
+
+    def keep(start):
+        return start.split(b":", 1)[0] in paths
+
+    lines = _iter_lines(_inflate(_iter_base64(fp)), keep, prefix_size=BLOB_KEY_SIZE)
+    for line in lines:
+        key, data = json.loads(b"{" + line.rstrip(b",") + b"}").popitem()
+        for path in paths[json.dumps(key).encode()]:
+            yield path, file_tree[path], _decode(data, file_tree[path])
+
+
+def _iter_archive(fp, file_tree):
+    paths = {}
+    for path, entry in file_tree.items():
+        paths.setdefault((entry["offset"], entry["length"], entry["method"]), []).append(path)
+
+    for (offset, length, method), data in _iter_ranges(_iter_base64(fp), sorted(paths)):
+        if method == "deflate":
+            data = zlib.decompress(data)
+        for path in paths[(offset, length, method)]:
+            yield path, file_tree[path], data
+
+
+def _decode(data, entry):
+    return base64.b64decode(data) if entry["base64encoded"] else data.encode()
+
+
+def _find_markers(fp, markers):
+    """Return the offsets right after the first occurrence of each marker in a binary file
+
+    The search stops at the last marker, so the others must come before it.
+    """
+
+    offsets = {}
+    overlap = max(map(len, markers)) - 1
+    position = 0
+    buffer = b""
+    while markers[-1] not in offsets:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        start = position - len(buffer)
+        buffer += chunk
+        position += len(chunk)
+        for marker in markers:
+            index = buffer.find(marker)
+            if marker not in offsets and index >= 0:
+                offsets[marker] = start + index + len(marker)
+        buffer = buffer[-overlap:]
+    return offsets
+
+
+def _iter_base64(fp):
+    """Decode base64 from a binary file up to the closing quote, chunk by chunk"""
+
+    pending = b""
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("Unterminated payload")
+        end = chunk.find(b'"')
+        data = pending + (chunk if end < 0 else chunk[:end])
+        if end >= 0:
+            yield base64.b64decode(data, validate=True)
+            return
+        aligned = len(data) - len(data) % 4
+        pending = data[aligned:]
+        yield base64.b64decode(data[:aligned], validate=True)
+
+
+def _inflate(chunks):
+    """Decompress a zlib stream chunk by chunk, with bounded output per step"""
+
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        data = chunk
+        while data:
+            yield decompressor.decompress(data, CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+def _iter_lines(chunks, keep, prefix_size=1):
+    """Yield the lines of a byte stream for which `keep(start)` is true
+
+    `start` is the first `prefix_size` bytes of a line, or the whole line if
+    it is shorter. The other lines are skipped without holding them in
+    memory.
+    """
+
+    pieces = []
+    size = 0
+    # Whether to keep the current line, or None if undecided
+    decision = None
+    for chunk in chunks:
+        position = 0
+        while position < len(chunk):
+            end = chunk.find(b"\n", position)
+            stop = len(chunk) if end < 0 else end
+            if decision is not False:
+                pieces.append(chunk[position:stop])
+                size += stop - position
+                if decision is None and (size >= prefix_size or end >= 0):
+                    decision = keep(b"".join(pieces)[:prefix_size])
+                    if not decision:
+                        pieces = []
+            if end < 0:
+                break
+            if decision:
+                yield b"".join(pieces)
+            pieces, size, decision = [], 0, None
+            position = end + 1
+
+    if pieces and (decision or (decision is None and keep(b"".join(pieces)[:prefix_size]))):
+        yield b"".join(pieces)
+
+
+def _iter_ranges(chunks, ranges):
+    """Yield `(range, data)` for sorted, disjoint `(offset, length, ...)` ranges of a byte stream"""
+
+    ranges = iter(ranges)
+    current = next(ranges, None)
+    pieces = []
+    position = 0
+    for chunk in chunks:
+        chunk_start = position
+        position += len(chunk)
+        while current is not None and current[0] + current[1] <= position:
+            offset, length = current[:2]
+            pieces.append(chunk[max(offset - chunk_start, 0) : offset + length - chunk_start])
+            yield current, b"".join(pieces)
+            pieces = []
+            current = next(ranges, None)
+        if current is not None and current[0] < position:
+            pieces.append(chunk[max(current[0] - chunk_start, 0) :])
+    if current is not None:
+        raise ValueError("Truncated archive")
@@ -0,0 +1,295 @@
+"""
+Losslessly recompress images.
+
+Images are usually the largest part of a bundle, and many of them are not
+compressed as well as they could be. This module shrinks PNG, JPEG and GIF
+files without changing a single pixel:
+
+* PNG: the image data is deflated again with the best settings, split IDAT
+  chunks are merged and text and time stamp chunks are removed. If Pillow
+  is installed, the image is also re-encoded with its optimizer.
+* JPEG: comments, XMP and Photoshop segments are removed, as well as EXIF
+  data that does not rotate the image. The compressed image data is copied
+  verbatim, since re-encoding a JPEG is not lossless.
+* GIF: comment extensions are removed. If Pillow is installed, still images
+  are re-encoded with its optimizer.
+
+Color profiles, transparency and anything else that changes how an image
+is displayed are kept. The result of Pillow is only used if it decodes to
+exactly the same pixels. Of all candidates, the smallest one wins, and an
+image that cannot be parsed is left as it is.
+
+"""
+
+import hashlib
+import io
+import logging
+import struct
+import threading
+import zlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Part of the cache key, so cached results are discarded when the
+# optimizations change
+OPTIMIZER_VERSION = f"1 pillow={Image.__version__ if Image else None}"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Chunks that do not affect how a PNG is displayed
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+# Chunks that Pillow does not write back
+PNG_COLOR_CHUNKS = {b"gAMA", b"cHRM", b"sBIT", b"eXIf"}
+
+
+class ImageOptimizer:
+    """Optimize the images of one bundle and count the bytes saved
+
+    If `cache` is a `PreparedCache`, results are stored in it by content
+    hash, so an image is only optimized once, even if it is renamed or
+    referenced with different options.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.sizes = defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+        if not Image:
+            logger.info("Pillow is not installed, images are only optimized partially")
+
+    def optimize(self, data, mime_type):
+        """Return the optimized image, or `data` if it is not a supported image"""
+
+        optimize = OPTIMIZERS.get(mime_type)
+        if not optimize:
+            return data
+
+        key = f"image {OPTIMIZER_VERSION} {hashlib.blake2b(data, digest_size=16).hexdigest()}"
+        result = self.cache.get_blob(key) if self.cache else None
+        if result is None:
+            try:
+                result = optimize(data)
+            except (ValueError, EOFError, OSError, IndexError, struct.error, zlib.error) as e:
+                logger.debug("Cannot optimize image (%s): %s", mime_type, e)
+                result = data
+            if self.cache:
+                self.cache.put_blob(key, result)
+
+        with self._lock:
+            self.sizes[mime_type][0] += len(data)
+            self.sizes[mime_type][1] += len(result)
+        return result
+
+    def log_report(self):
+        for mime_type, (before, after) in sorted(self.sizes.items()):
+            logger.info(
+                "Optimized %s: %d -> %d bytes (saved %d bytes, %.1f%%)",
+                mime_type,
+                before,
+                after,
+                before - after,
+                100 * (before - after) / before if before else 0,
+            )
+
+
+def optimize_png(data):
+    """Recompress a PNG image"""
+
+    chunks = _png_chunks(data)
+    types = {chunk_type for chunk_type, _ in chunks}
+    if b"acTL" in types:
+        # Animated PNGs store frames outside of IDAT chunks
+        return data
+
+    image_data = zlib.decompress(b"".join(body for chunk_type, body in chunks if chunk_type == b"IDAT"))
+    compressed = min(
+        (_deflate(image_data, strategy) for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]), key=len
+    )
+
+    result = [PNG_SIGNATURE]
+    for chunk_type, body in chunks:
+        if chunk_type in PNG_METADATA_CHUNKS:
+            continue
+        if chunk_type == b"IDAT":
+            if compressed is not None:
+                result.append(_png_chunk(chunk_type, compressed))
+                compressed = None
+            continue
+        result.append(_png_chunk(chunk_type, body))
+
+    candidates = [data, b"".join(result)]
+    if Image and not types & PNG_COLOR_CHUNKS:
+        candidates.append(_reencode(data, "PNG"))
+    return _smallest(candidates)
+
+
+def optimize_jpeg(data):
+    """Remove metadata from a JPEG image"""
+
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG image")
+
+    result = [data[:2]]
+    pos = 2
+    while pos < len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("invalid JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA:
+            # The entropy-coded image data starts after the SOS segment
+            result.append(data[pos:])
+            break
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        segment = data[pos : pos + 2 + length]
+        if not _is_jpeg_metadata(marker, segment[4:]):
+            result.append(segment)
+        pos += 2 + length
+
+    return _smallest([data, b"".join(result)])
+
+
+def optimize_gif(data):
+    """Remove comments from a GIF image"""
+
+    if data[:3] != b"GIF":
+        raise ValueError("not a GIF image")
+
+    flags = data[10]
+    pos = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+    result = [data[:pos]]
+    frames = 0
+    while True:
+        block = data[pos]
+        if block == 0x3B:
+            result.append(data[pos : pos + 1])
+            break
+        if block == 0x21:
+            end = _skip_sub_blocks(data, pos + 2)
+            if data[pos + 1] != 0xFE:
+                result.append(data[pos:end])
+        elif block == 0x2C:
+            flags = data[pos + 9]
+            start = pos + 10 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+            end = _skip_sub_blocks(data, start + 1)
+            result.append(data[pos:end])
+            frames += 1
+        else:
+            raise ValueError("invalid GIF block")
+        pos = end
+
+    candidates = [data, b"".join(result)]
+    if Image and frames == 1:
+        candidates.append(_reencode(data, "GIF"))
+    return _smallest(candidates)
+
+
+OPTIMIZERS = {
+    "image/png": optimize_png,
+    "image/jpeg": optimize_jpeg,
+    "image/gif": optimize_gif,
+}
+
+
+def _png_chunks(data):
+    """Return the `(type, body)` pairs of a PNG image"""
+
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("not a PNG image")
+
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, pos)
+        body = data[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack_from(">I", data, pos + 8 + length)
+        if zlib.crc32(chunk_type + body) != crc:
+            raise ValueError("invalid PNG chunk")
+        chunks.append((chunk_type, body))
+        pos += 12 + length
+        if chunk_type == b"IEND":
+            break
+    return chunks
+
+
+def _png_chunk(chunk_type, body):
+    return struct.pack(">I4s", len(body), chunk_type) + body + struct.pack(">I", zlib.crc32(chunk_type + body))
+
+
+def _deflate(data, strategy):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _is_jpeg_metadata(marker, body):
+    if marker == 0xFE:
+        # Comment
+        return True
+    if marker == 0xED:
+        # Photoshop
+        return True
+    if marker == 0xE1:
+        if body.startswith(b"http://ns.adobe.com/xap/"):
+            return True
+        if body.startswith(b"Exif\0\0"):
+            # Browsers rotate images according to their EXIF orientation
+            return _exif_orientation(body[6:]) == 1
+    return False
+
+
+def _exif_orientation(tiff):
+    """Return the orientation tag of EXIF data, or None if it cannot be read"""
+
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        (ifd,) = struct.unpack_from(order + "I", tiff, 4)
+        (count,) = struct.unpack_from(order + "H", tiff, ifd)
+        for i in range(count):
+            tag, _, _, value = struct.unpack_from(order + "HHI4s", tiff, ifd + 2 + 12 * i)
+            if tag == 0x0112:
+                return struct.unpack_from(order + "H", value)[0]
+    except (KeyError, struct.error):
+        return None
+    return 1
+
+
+def _skip_sub_blocks(data, pos):
+    """Return the position after the data sub-blocks starting at `pos`"""
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _reencode(data, image_format):
+    """Re-encode an image with Pillow, or return None if the result is not lossless"""
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        params = {"optimize": True}
+        for name in ["icc_profile", "transparency"]:
+            if name in image.info:
+                params[name] = image.info[name]
+        out = io.BytesIO()
+        image.save(out, image_format, **params)
+        result = out.getvalue()
+
+        with Image.open(io.BytesIO(result)) as reencoded:
+            if (
+                reencoded.size != image.size
+                or reencoded.convert("RGBA").tobytes() != image.convert("RGBA").tobytes()
+                or (image.mode not in ("P", "1", "L", "LA", "RGB", "RGBA") and reencoded.tobytes() != image.tobytes())
+            ):
+                return None
+    return result
+
+
+def _smallest(candidates):
+    return min((candidate for candidate in candidates if candidate is not None), key=len)
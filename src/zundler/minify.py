@@ -0,0 +1,301 @@
+"""
+Minify HTML, CSS and JavaScript files.
+
+The minifiers are deliberately conservative. They remove comments and
+redundant whitespace, but never rename anything or rewrite expressions, so
+the result behaves exactly like the original:
+
+* HTML: comments are removed and runs of whitespace between tags are
+  collapsed. Tags, `<pre>`, `<textarea>`, `<script>` and `<style>` elements
+  are copied verbatim.
+* CSS: comments are removed and whitespace is collapsed, and removed
+  entirely around braces, semicolons and commas. A comment only leaves a
+  space behind where the tokens around it would merge otherwise. Strings
+  and `url()` tokens are copied verbatim.
+* JavaScript: comments, indentation, trailing whitespace and blank lines are
+  removed. Line breaks are kept, so automatic semicolon insertion is not
+  affected. Strings, template literals and regular expressions are copied
+  verbatim. If the scanner gets confused, the file is left as it is.
+
+Comments starting with `/*!` usually hold a license and are kept. Files
+whose name contains `.min.` are minified already and are skipped.
+
+"""
+
+import logging
+import re
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FILE_TYPES = {
+    "htm": "html",
+    "html": "html",
+    "css": "css",
+    "js": "js",
+    "mjs": "js",
+}
+
+
+class Minifier:
+    """Minify the files of one bundle and count the bytes saved per file type"""
+
+    def __init__(self):
+        self.sizes = defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+
+    def minify(self, text, filename):
+        """Return the minified contents of a file, or `text` if it cannot be minified"""
+
+        name = Path(filename).name.lower()
+        file_type = FILE_TYPES.get(Path(name).suffix[1:])
+        if not file_type or ".min." in name:
+            return text
+
+        result = MINIFIERS[file_type](text)
+        with self._lock:
+            self.sizes[file_type][0] += len(text.encode())
+            self.sizes[file_type][1] += len(result.encode())
+        return result
+
+    def log_report(self):
+        for file_type, (before, after) in sorted(self.sizes.items()):
+            logger.info(
+                "Minified %s: %d -> %d bytes (saved %d bytes, %.1f%%)",
+                file_type,
+                before,
+                after,
+                before - after,
+                100 * (before - after) / before if before else 0,
+            )
+
+
+# Conditional comments are kept
+_HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+_HTML_TOKEN = re.compile(
+    r"""(?:\s|<!--(?!\[if).*?-->)+"""
+    r"""|<(pre|textarea|script|style)\b(?:[^>"']|"[^"]*"|'[^']*')*>.*?</\1\s*>"""
+    r"""|<[a-zA-Z!/?](?:[^>"']|"[^"]*"|'[^']*')*>""",
+    re.DOTALL | re.IGNORECASE,
+)
+
+
+def minify_html(html):
+    """Remove comments and collapse whitespace in HTML"""
+
+    def replace(m):
+        token = m.group()
+        if m[1] or not (token[0].isspace() or token.startswith("<!--")):
+            return token
+        space = _HTML_COMMENT.sub("", token)
+        if not space:
+            return ""
+        return "\n" if "\n" in space else " "
+
+    return _HTML_TOKEN.sub(replace, html)
+
+
+_CSS_TOKEN = re.compile(
+    r"""/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|url\([^)]*\)|\s+|[{};,]""",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# A character that can be part of a CSS identifier
+_CSS_NAME = re.compile(r"[\w\-\\\x80-\U0010ffff]")
+
+
+def minify_css(css):
+    """Remove comments and whitespace from CSS"""
+
+    result = []
+    space = False
+    comment = False
+    pos = 0
+
+    def append(token):
+        nonlocal space, comment
+        # A comment separates tokens, but unlike whitespace, it is not a
+        # descendant combinator. It can be dropped unless the tokens around
+        # it would merge into one.
+        if result and result[-1] not in "{};," and (space or (comment and _css_tokens_merge(result[-1][-1], token[0]))):
+            result.append(" ")
+        result.append(token)
+        space = comment = False
+
+    for m in _CSS_TOKEN.finditer(css):
+        if m.start() > pos:
+            append(css[pos : m.start()])
+        pos = m.end()
+        token = m.group()
+
+        if token.startswith("/*") and not token.startswith("/*!"):
+            comment = True
+        elif token.isspace():
+            space = True
+        elif token in "{};,":
+            if token == "}" and result and result[-1] == ";":
+                result.pop()
+            result.append(token)
+            space = comment = False
+        else:
+            append(token)
+
+    if pos < len(css):
+        append(css[pos:])
+
+    return "".join(result).strip()
+
+
+def _css_tokens_merge(left, right):
+    """Check whether two characters would run into one CSS token if adjacent"""
+
+    return bool(
+        (_CSS_NAME.match(left) and _CSS_NAME.match(right))
+        or (left in "+-." and right.isdigit())
+        or (left.isdigit() and right in ".%")
+        or (left in "#@" and _CSS_NAME.match(right))
+        or (left in "~|^$*" and right == "=")
+        or (left == "/" and right == "*")
+        or (left == "<" and right == "!")
+    )
+
+
+# Keywords after which a slash starts a regular expression, not a division
+_JS_KEYWORDS = {
+    "await",
+    "case",
+    "delete",
+    "do",
+    "else",
+    "in",
+    "instanceof",
+    "new",
+    "of",
+    "return",
+    "throw",
+    "typeof",
+    "void",
+    "yield",
+}
+
+_JS_TOKEN = re.compile(
+    r"""(?P<newline>\n)"""
+    r"""|(?P<space>[^\S\n]+)"""
+    r"""|(?P<line_comment>//[^\n]*)"""
+    r"""|(?P<block_comment>/\*.*?\*/)"""
+    r"""|(?P<string>"(?:[^"\\\n]|\\[\s\S])*"|'(?:[^'\\\n]|\\[\s\S])*')"""
+    r"""|(?P<word>[\w$\\\x80-\U0010ffff]+)"""
+    r"""|(?P<punctuator>[\s\S])""",
+    re.DOTALL,
+)
+_JS_REGEX = re.compile(r"""/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*""")
+_JS_TEMPLATE = re.compile(r"""(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(`|\$\{)""")
+
+
+class _ScanError(Exception):
+    pass
+
+
+def minify_js(js):
+    """Remove comments, indentation and blank lines from JavaScript"""
+
+    try:
+        return _minify_js(js)
+    except _ScanError:
+        return js
+
+
+def _minify_js(js):
+    lines = []
+    line = []
+    # The last significant token, to tell regular expressions from divisions
+    last = ""
+    # The brace depth inside each `${` of the template literals we are in
+    templates = []
+    pos = 0
+
+    def end_line():
+        text = "".join(line).rstrip()
+        if text:
+            lines.append(text)
+        line.clear()
+
+    while pos < len(js):
+        if js[pos] == "`" or (js[pos] == "}" and templates and templates[-1] == 0):
+            # Copy the literal text of a template up to its end or the next
+            # substitution
+            if js[pos] == "}":
+                templates.pop()
+            m = _JS_TEMPLATE.match(js, pos + 1)
+            if not m:
+                raise _ScanError
+            line.append(js[pos : m.end()])
+            if m[1] == "${":
+                templates.append(0)
+                last = "{"
+            else:
+                last = "`"
+            pos = m.end()
+            continue
+
+        if js[pos] == "/" and js[pos + 1 : pos + 2] not in ("/", "*") and _regex_allowed(last):
+            m = _JS_REGEX.match(js, pos)
+            if not m:
+                raise _ScanError
+            line.append(m.group())
+            last = "regex"
+            pos = m.end()
+            continue
+
+        m = _JS_TOKEN.match(js, pos)
+        pos = m.end()
+        kind = m.lastgroup
+        token = m.group()
+
+        if kind == "newline":
+            end_line()
+        elif kind == "space":
+            if line and line[-1] != " ":
+                line.append(" ")
+        elif kind == "line_comment":
+            pass
+        elif kind == "block_comment":
+            if token.startswith("/*!"):
+                line.append(token)
+            elif "\n" in token:
+                # A comment with a line break counts as one
+                end_line()
+            elif line and line[-1] != " ":
+                line.append(" ")
+        else:
+            if kind == "punctuator":
+                if token in "\"'" or (token == "/" and js[pos : pos + 1] == "*"):
+                    raise _ScanError
+                if templates and token == "{":
+                    templates[-1] += 1
+                elif templates and token == "}":
+                    templates[-1] -= 1
+            line.append(token)
+            last = token
+
+    if templates:
+        raise _ScanError
+    end_line()
+    return "\n".join(lines) + ("\n" if lines and js.endswith("\n") else "")
+
+
+def _regex_allowed(last):
+    """Return True if a slash after the token `last` starts a regular expression"""
+    if not last or last in _JS_KEYWORDS:
+        return True
+    # Not after identifiers, numbers, strings, closing brackets or regexes
+    return not (last[-1].isalnum() or last[-1] in "_$\\)]`\"'" or last[-1] > "\x7f")
+
+
+MINIFIERS = {
+    "html": minify_html,
+    "css": minify_css,
+    "js": minify_js,
+}
@@ -0,0 +1,189 @@
+"""
+Rewrite HTML pages ahead of time.
+
+In the browser, `prepare` in `zundler_main` parses each page before showing
+it, injects the Zundler scripts, inlines scripts, style sheets and images
+and rewrites links and forms. Everything except the file contents is known
+when the bundle is built, so this module does that work in Python instead.
+
+The file contents are not copied into each page, because that would store
+them once per page. Instead, the rewritten page contains placeholders that
+the runtime fills in with plain string replacements, without parsing the
+page:
+
+* `<script data-zundler-util="NAME"></script>` is one of the utility
+  scripts, e.g. `inject_pre`
+* `<script data-zundler-inline="PATH" ...></script>` and
+  `<style data-zundler-inline="PATH" ...></style>` are a script or style
+  sheet from the file tree. Style sheets keep the `media` attribute of
+  their `<link>` tag.
+* `data-zundler-src="PATH"` in an `<img>` tag becomes a `src` attribute
+  that points to the image
+
+Paths are relative to the page, as in the original document. Everything
+but the rewritten tags is copied verbatim.
+
+"""
+
+import re
+from html import escape
+from html.parser import HTMLParser
+
+# Must match the placeholder in zundler_main
+GLOBAL_CONTEXT_PLACEHOLDER = "/* zundler global context */"
+
+HEAD_SCRIPTS = (
+    '<script data-zundler-util="inject_pre"></script>'
+    f"<script>{GLOBAL_CONTEXT_PLACEHOLDER}</script>"
+    '<script data-zundler-util="zundler_common"></script>'
+)
+
+BODY_SCRIPTS = '<script data-zundler-util="inject_post"></script>'
+
+
+def prerender(html):
+    """Rewrite an HTML page for the runtime
+
+    Return the rewritten page and its title, or None if the page cannot be
+    rewritten, e.g. because it has no `<head>` or `<body>` tags. Such pages
+    are left to the runtime.
+    """
+
+    rewriter = _Rewriter(html)
+    rewriter.feed(html)
+    rewriter.close()
+
+    if rewriter.head_end is None or rewriter.body_end is None:
+        return None
+
+    edits = [
+        *rewriter.edits,
+        (rewriter.head_end, rewriter.head_end, HEAD_SCRIPTS),
+        (rewriter.body_end, rewriter.body_end, BODY_SCRIPTS),
+    ]
+    edits.sort(key=lambda edit: edit[0])
+
+    result = []
+    last = 0
+    for start, end, replacement in edits:
+        result.append(html[last:start])
+        result.append(replacement)
+        last = end
+    result.append(html[last:])
+
+    return "".join(result), " ".join("".join(rewriter.title).split())
+
+
+def is_virtual(url):
+    """Return True if `url` is retrieved from the virtual file tree
+
+    This is the same as `isVirtual` in `zundler_common`.
+    """
+    if url is None:
+        return False
+    url = url.lower()
+    return not (
+        url == "" or url.startswith(("#", "https:/", "http:/", "data:", "javascript:", "about:srcdoc", "blob:"))
+    )
+
+
+def _split_url(url):
+    """Return the path of a URL without GET parameters and anchor"""
+    return url.split("#")[0].split("?")[0]
+
+
+def _render_tag(tag, attrs):
+    rendered = "".join(f" {name}" if value is None else f' {name}="{escape(value)}"' for name, value in attrs)
+    return f"<{tag}{rendered}>"
+
+
+class _Rewriter(HTMLParser):
+    """Collect the edits that turn a page into a prerendered page
+
+    Each edit is a tuple `(start, end, replacement)` of offsets into the page.
+    """
+
+    def __init__(self, html):
+        super().__init__(convert_charrefs=True)
+        self.html = html
+        self.line_offsets = [0] + [m.end() for m in re.finditer("\n", html)]
+        self.edits = []
+        self.head_end = None
+        self.body_end = None
+        self.title = []
+        self.in_title = False
+        self.pending_script = None
+
+    def position(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        start = self.position()
+        end = start + len(self.get_starttag_text())
+        attributes = dict(attrs)
+
+        if tag == "head" and self.head_end is None:
+            self.head_end = end
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "a":
+            self.fix_link(start, end, attrs, attributes)
+        elif tag == "form":
+            self.fix_form(start, end, attrs, attributes)
+        elif tag == "script" and is_virtual(attributes.get("src")):
+            path = _split_url(attributes["src"])
+            attrs = [("data-zundler-inline", path)] + [(k, v) for k, v in attrs if k != "src"]
+            # The element ends with the closing tag, see `handle_endtag`
+            self.pending_script = (start, _render_tag("script", attrs) + "</script>")
+        elif tag == "link" and attributes.get("rel") == "stylesheet" and is_virtual(attributes.get("href")):
+            path = _split_url(attributes["href"])
+            attrs = [("data-zundler-inline", path)] + [(k, v) for k, v in attrs if k == "media"]
+            self.edits.append((start, end, _render_tag("style", attrs) + "</style>"))
+        elif tag == "img" and is_virtual(attributes.get("src")):
+            path = _split_url(attributes["src"])
+            attrs = [(k, v) for k, v in attrs if k != "src"] + [("data-zundler-src", path)]
+            self.edits.append((start, end, _render_tag("img", attrs)))
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag == "body":
+            self.body_end = self.position()
+        elif tag == "script" and self.pending_script:
+            start, replacement = self.pending_script
+            end = self.html.index(">", self.position()) + 1
+            self.edits.append((start, end, replacement))
+            self.pending_script = None
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+
+    def fix_link(self, start, end, attrs, attributes):
+        # Same as `fixLink` in zundler_common
+        href = attributes.get("href")
+        if href is None:
+            return
+        if is_virtual(href):
+            attrs = _set_attribute(attrs, "onclick", "virtualClick(event)")
+        elif href.startswith("#"):
+            attrs = _set_attribute(attrs, "href", f"about:srcdoc{href}")
+        elif not href.startswith(("about:srcdoc", "javascript:")):
+            attrs = _set_attribute(attrs, "target", "_blank")
+        else:
+            return
+        self.edits.append((start, end, _render_tag("a", attrs)))
+
+    def fix_form(self, start, end, attrs, attributes):
+        # Same as `fixForm` in zundler_common
+        if is_virtual(attributes.get("action")) and (attributes.get("method") or "").lower() == "get":
+            attrs = _set_attribute(attrs, "onsubmit", "virtualClick(event)")
+            self.edits.append((start, end, _render_tag("form", attrs)))
+
+
+def _set_attribute(attrs, name, value):
+    """Return `attrs` with the attribute `name` set to `value`"""
+    if any(k == name for k, _ in attrs):
+        return [(k, value if k == name else v) for k, v in attrs]
+    return [*attrs, (name, value)]
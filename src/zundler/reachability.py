@@ -0,0 +1,184 @@
+"""
+Find the files that are reachable from the root document.
+
+Sphinx and other generators write plenty of files that no page ever uses,
+e.g. `_sources/`, `objects.inv` or unused theme assets. Starting at the root
+document, this module follows references to other files and collects all
+files that can be reached:
+
+* HTML: `href`, `src`, `srcset`, `data`, `poster` and `action` attributes,
+  redirects in `<meta http-equiv="refresh">` and `url()` in style sheets
+  and `style` attributes
+* CSS: `url()` tokens and `@import` rules
+* JavaScript: only files known to load other files, see `KNOWN_FETCHES`
+
+Other dynamic loads cannot be found this way, so files matching a pattern of
+the allow-list are always kept and followed as well.
+
+"""
+
+import json
+import posixpath
+import re
+from collections import deque
+from fnmatch import fnmatch
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import unquote
+
+from zundler import css as css_tokenizer
+from zundler.prerender import is_virtual
+
+URL_ATTRIBUTES = {"href", "src", "data", "poster", "action"}
+
+_SEARCH_INDEX_DOCNAMES = re.compile(r'"docnames"\s*:\s*(\[[^\]]*\])')
+_REFRESH_URL = re.compile(r";\s*url\s*=\s*['\"]?([^'\"]*)", re.IGNORECASE)
+
+
+def _sphinx_doctools(path, data):
+    # The collapsible sections of the general index swap these images
+    return ["minus.png", "plus.png"]
+
+
+def _sphinx_search_tools(path, data):
+    # Sphinx' search page loads the search index from the root directory
+    return ["../searchindex.js"]
+
+
+def _sphinx_search_index(path, data):
+    # The search page fetches each result to show a summary
+    m = _SEARCH_INDEX_DOCNAMES.search(data.decode(errors="replace"))
+    if not m:
+        return []
+    try:
+        return [f"{name}.html" for name in json.loads(m[1])]
+    except ValueError:
+        return []
+
+
+# Scripts that load other files by name, and functions that return the URLs
+# they load, relative to the script
+KNOWN_FETCHES = {
+    "doctools.js": _sphinx_doctools,
+    "searchtools.js": _sphinx_search_tools,
+    "searchindex.js": _sphinx_search_index,
+}
+
+
+def reachable_files(base_dir, root, keep=()):
+    """Return the paths of all files reachable from `root`
+
+    `root` is the path of the root document relative to `base_dir`. Files
+    whose path relative to `base_dir` matches one of the glob patterns in
+    `keep` are reachable as well. All paths are POSIX paths relative to
+    `base_dir`.
+    """
+
+    base_dir = Path(base_dir)
+    pending = deque([root])
+    if keep:
+        for path in base_dir.rglob("*"):
+            relative_path = path.relative_to(base_dir).as_posix()
+            if path.is_file() and any(fnmatch(relative_path, pattern) for pattern in keep):
+                pending.append(relative_path)
+    result = set()
+
+    while pending:
+        path = pending.popleft()
+        if path in result:
+            continue
+        if (base_dir / path).is_dir():
+            pending.append(posixpath.normpath(posixpath.join(path, "index.html")))
+            continue
+        if not (base_dir / path).is_file():
+            continue
+        result.add(path)
+
+        for url in _references(path, (base_dir / path).read_bytes()):
+            target = _resolve(url, path)
+            if target is not None and target not in result:
+                pending.append(target)
+
+    return result
+
+
+def _references(path, data):
+    """Return the URLs referenced by a file"""
+
+    name = posixpath.basename(path)
+    ext = posixpath.splitext(name)[1].lower()
+
+    if ext in (".html", ".htm"):
+        collector = _Collector()
+        collector.feed(data.decode(errors="replace"))
+        collector.close()
+        return collector.urls
+    if ext == ".css":
+        return _css_references(data)
+    if name in KNOWN_FETCHES:
+        return KNOWN_FETCHES[name](path, data)
+    return []
+
+
+def _css_references(css):
+    urls = []
+
+    def on_url(url, format_hint):
+        urls.append(url)
+
+    def on_import(url, media):
+        urls.append(url)
+
+    css_tokenizer.rewrite(css, on_url=on_url, on_import=on_import)
+    return urls
+
+
+def _resolve(url, path):
+    """Return the path a URL in the file `path` points to, or None if it is external"""
+
+    if not is_virtual(url):
+        return None
+    url = unquote(url.split("#")[0].split("?")[0])
+    if not url:
+        return None
+    if url.startswith("/"):
+        target = posixpath.normpath(url.lstrip("/"))
+    else:
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(path), url))
+    if target == ".." or target.startswith("../"):
+        return None
+    return target
+
+
+class _Collector(HTMLParser):
+    """Collect the URLs an HTML page references"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.urls = []
+        self.in_style = False
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if value is None:
+                continue
+            if name in URL_ATTRIBUTES:
+                self.urls.append(value.strip())
+            elif name in ("srcset", "imagesrcset"):
+                self.urls.extend(candidate.split()[0] for candidate in value.split(",") if candidate.strip())
+            elif name == "style":
+                self.urls.extend(_css_references(value.encode()))
+
+        if tag == "meta" and (dict(attrs).get("http-equiv") or "").lower() == "refresh":
+            m = _REFRESH_URL.search(dict(attrs).get("content") or "")
+            if m:
+                self.urls.append(m[1].strip())
+
+        self.in_style = tag == "style"
+
+    def handle_endtag(self, tag):
+        self.in_style = False
+
+    def handle_data(self, data):
+        if self.in_style:
+            self.urls.extend(_css_references(data.encode()))
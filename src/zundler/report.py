@@ -0,0 +1,201 @@
+"""
+Profile a build and attribute the size of a bundle to its files.
+
+A `BuildReport` is passed through `embed_assets` and collects:
+
+* The time spent in each stage of the build: walking the directory, reading
+  files, sniffing mime types, inlining CSS resources, the optional
+  transformations, serializing JSON, compressing and writing the output.
+  Files may be prepared in several threads, so the time of a stage is the
+  sum over all threads and can exceed the wall time of the build.
+* For each file, its size on disk (`raw`), its size in the file tree after
+  all transformations and base64 encoding (`encoded`), the bytes it adds to
+  the compressed payload (`compressed`) and, for style sheets, the bytes
+  added by inlining the resources they reference (`css_inlined`). Files
+  whose contents are deduplicated add no compressed bytes. In archive mode,
+  the compressed size of a file is exact. Otherwise, the payload is
+  compressed as a whole in one stream, which deflate emits in blocks of
+  several kilobytes. Each block is split among the files fed to the
+  compressor since the previous block by their size, which approximates
+  the compressed size of a file without compressing it again.
+* The size of the runtime, the scripts and styles outside the payload
+  (`runtime`).
+
+The report can be written as JSON with `write` and summarized for humans
+with `summary`. Files taken from the cache are not prepared again, so their
+CSS inlining and the stages they skip are not accounted for.
+
+"""
+
+import json
+import logging
+import posixpath
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from zundler.args import __version__
+
+logger = logging.getLogger(__name__)
+
+# The stages in the order they happen
+STAGES = [
+    "walk",
+    "tree_shake",
+    "cache",
+    "read",
+    "mime",
+    "css",
+    "optimize_images",
+    "search",
+    "minify",
+    "prerender",
+    "serialize",
+    "compress",
+    "write",
+]
+
+
+class BuildReport:
+    """Timings and sizes of one build
+
+    `top` is the number of heaviest files and directories in the summary.
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.stages = defaultdict(float)
+        self.files = {}
+        self._css_inlined = {}
+        self.output_size = None
+        # The bytes of the runtime outside the payload
+        self.runtime_size = None
+        self.started = time.perf_counter()
+        self.wall_time = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time spent in the `with` block to the stage `name`"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] += duration
+
+    def add_file(self, path, filename, mime_type, raw, encoded):
+        """Record a packed file by its `path` in the bundle and its `filename` on disk"""
+
+        with self._lock:
+            entry = self.files.setdefault(path, {"compressed": 0})
+            entry.update({"mime_type": mime_type, "raw": raw, "encoded": encoded})
+            if filename in self._css_inlined:
+                entry["css_inlined"] = self._css_inlined.pop(filename)
+
+    def add_compressed(self, path, compressed):
+        """Add compressed bytes of the payload to the file `path`"""
+
+        with self._lock:
+            entry = self.files.setdefault(path, {})
+            entry["compressed"] = entry.get("compressed", 0) + compressed
+
+    def add_css_inlined(self, filename, size):
+        """Record the bytes added to the style sheet `filename` by inlining resources"""
+
+        with self._lock:
+            self._css_inlined[filename] = size
+
+    def finish(self, output_size):
+        self.output_size = output_size
+        self.wall_time = time.perf_counter() - self.started
+
+    def to_dict(self):
+        totals = {key: sum(file.get(key, 0) for file in self.files.values()) for key in ["raw", "encoded"]}
+        return {
+            "zundler": __version__,
+            "wall_time": self.wall_time,
+            "stages": {name: self.stages[name] for name in STAGES if name in self.stages},
+            "totals": {
+                "files": len(self.files),
+                **totals,
+                "compressed": sum(file.get("compressed", 0) for file in self.files.values()),
+                "css_inlined": sum(file.get("css_inlined", 0) for file in self.files.values()),
+                "runtime": self.runtime_size,
+                "output": self.output_size,
+            },
+            "top_files": self.top_files(),
+            "top_directories": self.top_directories(),
+            "files": dict(sorted(self.files.items())),
+        }
+
+    def top_files(self):
+        """Return the heaviest files by compressed size as `[path, compressed]` pairs"""
+
+        files = sorted(self.files.items(), key=lambda item: (-item[1].get("compressed", 0), item[0]))
+        return [[path, file.get("compressed", 0)] for path, file in files[: self.top]]
+
+    def top_directories(self):
+        """Return the heaviest directories by compressed size as `[path, compressed]` pairs
+
+        The size of a directory includes all its subdirectories.
+        """
+
+        sizes = defaultdict(int)
+        for path, file in self.files.items():
+            directory = posixpath.dirname(path)
+            while directory:
+                sizes[directory] += file.get("compressed", 0)
+                directory = posixpath.dirname(directory)
+        directories = sorted(sizes.items(), key=lambda item: (-item[1], item[0]))
+        return [list(item) for item in directories[: self.top]]
+
+    def write(self, path):
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2) + "\n")
+        logger.info("Build report written to: %s", path)
+
+    def summary(self):
+        """Return a plain text summary"""
+
+        report = self.to_dict()
+        totals = report["totals"]
+        lines = []
+        if report["wall_time"] is not None:
+            lines.append(f"Build took {report['wall_time']:.2f} s")
+        lines += [
+            "Time per stage (summed over threads):",
+            *(f"  {name:<16} {duration:8.3f} s" for name, duration in report["stages"].items()),
+            f"Files: {totals['files']}",
+            f"  raw              {_format_size(totals['raw'])}",
+            f"  encoded          {_format_size(totals['encoded'])}",
+            f"  compressed       {_format_size(totals['compressed'])}",
+            f"  added by CSS     {_format_size(totals['css_inlined'])}",
+        ]
+        if totals["runtime"] is not None:
+            lines.append(f"  runtime          {_format_size(totals['runtime'])}")
+        if totals["output"] is not None:
+            lines.append(f"  output file      {_format_size(totals['output'])}")
+        lines.append("Heaviest files (compressed):")
+        lines.extend(f"  {_format_size(size)}  {path}" for path, size in report["top_files"])
+        lines.append("Heaviest directories (compressed):")
+        lines.extend(f"  {_format_size(size)}  {path}/" for path, size in report["top_directories"])
+        return "\n".join(lines)
+
+
+def stage(report, name):
+    """Time a stage if there is a report, see `BuildReport.stage`"""
+
+    return report.stage(name) if report else nullcontext()
+
+
+def _format_size(size):
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:7.1f} {unit}" if unit != "B" else f"{size:7d} B  "
+        size /= 1024
+    return f"{size:7.1f} GiB"
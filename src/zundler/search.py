@@ -0,0 +1,123 @@
+"""
+Prepare the data of Sphinx' search page ahead of time.
+
+Each visit of the search page normally evaluates `searchindex.js` again,
+which can be several megabytes of JavaScript, and fetches each page in the
+results to show a summary. With search acceleration, this module does the
+expensive parts when the bundle is built:
+
+* The search index is checked to be a call of `Search.setIndex` with a JSON
+  document. Such an index is marked, so the parent document can parse it
+  once with `JSON.parse`, keep it and hand it to each search page.
+* Each page is reduced to the text of its main content, the element with
+  `role="main"`. Like `Search.htmlToText` in `searchtools.js`, header
+  links, scripts and styles are dropped. The elements with an `id` are kept
+  around their text, as `<section>` or `<div>`, so `htmlToText` can still
+  look up the part of the page a search result points to with
+  `[role=main] #anchor`. Search summaries then do not need the whole page.
+
+"""
+
+import json
+import re
+from html import escape
+from html.parser import HTMLParser
+
+# Must match `SEARCH_INDEX_PATTERN` in zundler_common
+SEARCH_INDEX_PATTERN = re.compile(r"^\s*Search\.setIndex\(([\s\S]*)\)\s*;?\s*$")
+
+# Elements whose text `Search.htmlToText` drops, besides header links
+SKIPPED_ELEMENTS = {"script", "style"}
+
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+
+
+def is_search_index(data):
+    """Check whether a script is a Sphinx search index the runtime can parse"""
+
+    m = SEARCH_INDEX_PATTERN.match(data)
+    if not m:
+        return False
+    try:
+        json.loads(m[1])
+    except ValueError:
+        return False
+    return True
+
+
+def page_summary(html):
+    """Return the main content of a page reduced to its text, or None if it has none
+
+    The result is an HTML document whose `role="main"` element has the same
+    text content as the one of the page, and so has each element with an
+    `id` in it.
+    """
+
+    extractor = _SummaryExtractor()
+    extractor.feed(html)
+    extractor.close()
+    if not extractor.found:
+        return None
+    return '<div role="main">' + "".join(extractor.result) + "</div>"
+
+
+class _SummaryExtractor(HTMLParser):
+    """Collect the text of the element with `role="main"` and the elements with ids in it
+
+    Header links, scripts and styles are skipped.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.result = []
+        self.found = False
+        # The open elements in the main element as `(tag, emitted tag or
+        # None, skipped)`, the main element first
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if not self.stack:
+            if not self.found and tag not in VOID_ELEMENTS and attrs.get("role") == "main":
+                self.found = True
+                self.stack.append((tag, None, False))
+            return
+
+        skipped = self.stack[-1][2] or tag in SKIPPED_ELEMENTS or "headerlink" in (attrs.get("class") or "").split()
+        emitted = None
+        if not skipped and attrs.get("id") is not None:
+            emitted = "section" if tag == "section" else "div"
+            self.result.append(f'<{emitted} id="{escape(attrs["id"])}">')
+        if tag not in VOID_ELEMENTS:
+            self.stack.append((tag, emitted, skipped))
+        elif emitted:
+            self.result.append(f"</{emitted}>")
+
+    def handle_endtag(self, tag):
+        # Close the elements left open in between, like `<p>` without `</p>`
+        if not any(open_tag == tag for open_tag, _, _ in self.stack):
+            return
+        while True:
+            open_tag, emitted, _ = self.stack.pop()
+            if emitted:
+                self.result.append(f"</{emitted}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.stack and not self.stack[-1][2]:
+            self.result.append(escape(data, quote=False))
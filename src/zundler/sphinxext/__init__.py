@@ -28,9 +28,47 @@ class ZundlerBuilder(StandaloneHTMLBuilder):
             super().__init__(app)
 
         self.epilog = f"Your self-contained HTML file is now in {relpath(self.app.original_outdir)}."
+        # Prepares the written pages while the build goes on
+        self.preparer = None
+
+    def zundler_cache_dir(self):
+        # Sphinx only writes outdated pages, so with `zundler_incremental`
+        # the prepared files are cached next to the doctrees and only the
+        # rewritten pages and changed assets are prepared again
+        cache_dir = self.config.zundler_cache_dir
+        if cache_dir is None and self.config.zundler_incremental:
+            cache_dir = Path(self.doctreedir).parent / "zundler-cache"
+        return cache_dir
+
+    def prepare_in_background(self, filename):
+        # Worker processes of parallel builds must not inherit the thread
+        # pool, so pages are only prepared ahead in serial builds. Without a
+        # cache directory, they are prepared into a `MemoryCache`.
+        if not self.config.zundler_pipeline or self.parallel_ok:
+            return
+        if self.preparer is None:
+            from zundler.embed import BackgroundPreparer
+
+            self.preparer = BackgroundPreparer(
+                self.zundler_cache_dir(),
+                jobs=self.config.zundler_jobs,
+                prerender=self.config.zundler_prerender,
+                minify=self.config.zundler_minify,
+                optimize_images=self.config.zundler_optimize_images,
+                accelerate_search=self.config.zundler_accelerate_search,
+                archive=self.config.zundler_archive,
+            )
+        self.preparer.submit(filename)
+
+    def handle_page(self, pagename, addctx, templatename="page.html", *, outfilename=None, event_arg=None):
+        # All pages, including extra pages like the index, are written here.
+        # Sphinx 8 made the last arguments keyword-only.
+        super().handle_page(pagename, addctx, templatename, outfilename=outfilename, event_arg=event_arg)
+        self.prepare_in_background(outfilename or self.get_outfilename(pagename))
 
     def run_zundler(self):
         from zundler.embed import embed_assets
+        from zundler.report import BuildReport
 
         root_doc = self.config.zundler_root_doc
         if not root_doc:
@@ -39,14 +77,42 @@ class ZundlerBuilder(StandaloneHTMLBuilder):
         input_path = Path(self.outdir) / (root_doc + ".html")
         output_path = Path(self.app.original_outdir) / (root_doc + ".html")
 
+        cache = None
+        if self.config.zundler_pipeline and self.parallel_ok:
+            logger.info(__("pages were not prepared in advance, as parallel builds write them in worker processes"))
+        if self.preparer is not None:
+            with progress_message(__("waiting for pages prepared in advance")):
+                self.preparer.close()
+            if self.zundler_cache_dir() is None:
+                cache = self.preparer.cache
+            self.preparer = None
+
+        report = BuildReport() if self.config.zundler_stats or self.config.zundler_report else None
+
         with progress_message(__("embedding HTML assets")):
             embed_assets(
                 input_path,
                 output_path=output_path,
                 append_pre=self.config.zundler_append_pre,
                 append_post=self.config.zundler_append_post,
+                jobs=self.config.zundler_jobs,
+                cache_dir=self.zundler_cache_dir(),
+                archive=self.config.zundler_archive,
+                prerender=self.config.zundler_prerender,
+                minify=self.config.zundler_minify,
+                optimize_images=self.config.zundler_optimize_images,
+                tree_shake=self.config.zundler_tree_shake,
+                keep=self.config.zundler_keep,
+                accelerate_search=self.config.zundler_accelerate_search,
+                report=report,
+                cache=cache,
             )
 
+        if self.config.zundler_report:
+            report.write(Path(self.app.original_outdir) / self.config.zundler_report)
+        if self.config.zundler_stats:
+            logger.info(report.summary())
+
 
 def run_zundler(app, exception):
     app.builder.run_zundler()
@@ -84,6 +150,84 @@ def setup(app):
         "",
     )
 
+    app.add_config_value(
+        "zundler_jobs",
+        1,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_cache_dir",
+        None,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_incremental",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_pipeline",
+        True,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_archive",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_prerender",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_minify",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_optimize_images",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_tree_shake",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_keep",
+        [],
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_accelerate_search",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_stats",
+        False,
+        "",
+    )
+
+    app.add_config_value(
+        "zundler_report",
+        None,
+        "",
+    )
+
     app.add_builder(ZundlerBuilder)
 
     # This should run as the last function in the build-finished event
@@ -9,7 +9,27 @@ const test = require("node:test");
 const assert = require("node:assert/strict");
 const path = require("node:path");
 
-const { isVirtual, fixLink, fixForm } = require(
+const zlib = require("node:zlib");
+
+const {
+	isVirtual,
+	normalizePath,
+	lookupFile,
+	getFile,
+	getFileUrl,
+	retainObjectUrls,
+	unpinObjectUrls,
+	getSearchIndex,
+	getPageSummary,
+	readArchive,
+	LruCache,
+	decodeBase64,
+	_decodeBase64WithTable,
+	fixLink,
+	fixForm,
+	timeStage,
+	performanceEntries,
+} = require(
 	path.join(__dirname, "..", "..", "src", "zundler", "assets", "zundler_common.js"),
 );
 
@@ -56,3 +76,273 @@ test("fixForm does not throw on a form without an action", () => {
 	assert.doesNotThrow(() => fixForm(form));
 	assert.equal(form.getAttribute("onsubmit"), null);
 });
+
+test("normalizePath resolves against the given page, not the current one", () => {
+	globalThis.window = { globalContext: { current_path: "b/other.html" } };
+	globalThis.DEBUG = false;
+	try {
+		assert.equal(normalizePath("../_static/a.css", "a/b/page.html"), "a/_static/a.css");
+		assert.equal(normalizePath("./img.png", "page.html"), "img.png");
+		assert.equal(normalizePath("img.png"), "b/img.png");
+	} finally {
+		delete globalThis.window;
+		delete globalThis.DEBUG;
+	}
+});
+
+test("lookupFile resolves paths that share a blob", async () => {
+	globalThis.window = {
+		globalContext: {
+			fileTree: {
+				"_images/a.png": { mime_type: "image/png", base64encoded: true, blob: "abc" },
+				"_downloads/a.png": { mime_type: "image/png", base64encoded: true, blob: "abc" },
+			},
+			blobs: { abc: "iVBORw0K" },
+		},
+	};
+	try {
+		assert.equal((await lookupFile("_images/a.png")).data, "iVBORw0K");
+		assert.equal((await lookupFile("_downloads/a.png")).data, "iVBORw0K");
+		assert.equal((await lookupFile("_downloads/a.png")).mime_type, "image/png");
+		assert.equal(await lookupFile("missing.png"), undefined);
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("readArchive decodes byte ranges at any offset", () => {
+	const bytes = Buffer.from("0123456789abcdef");
+	globalThis.window = { atob, zundlerArchive: bytes.toString("base64") };
+	try {
+		for (let offset = 0; offset < bytes.length; offset++) {
+			for (let length = 1; offset + length <= bytes.length; length++) {
+				assert.deepEqual(
+					Buffer.from(readArchive(offset, length)),
+					bytes.subarray(offset, offset + length),
+				);
+			}
+		}
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("lookupFile reads entries from the archive", async () => {
+	const first = zlib.deflateSync("<html>first</html>");
+	const second = zlib.deflateSync("body { color: red }");
+	const png = Buffer.from([0x89, 0x50, 0x4e, 0x47, 0, 1, 2, 3]);
+	const entry = (mime_type, base64encoded, offset, length, method) => ({
+		mime_type,
+		base64encoded,
+		offset,
+		length,
+		method,
+	});
+	globalThis.window = {
+		atob,
+		zundlerArchive: Buffer.concat([first, second, png]).toString("base64"),
+		globalContext: {
+			fileTree: {
+				"index.html": entry("text/html", false, 0, first.length, "deflate"),
+				"a.css": entry("text/css", false, first.length, second.length, "deflate"),
+				"a.png": entry("image/png", true, first.length + second.length, png.length, "store"),
+			},
+		},
+	};
+	try {
+		assert.equal((await lookupFile("a.css")).data, "body { color: red }");
+		assert.equal((await lookupFile("index.html")).data, "<html>first</html>");
+		assert.equal((await lookupFile("a.css")).mime_type, "text/css");
+		const image = (await lookupFile("a.png")).data;
+		assert.ok(image instanceof Uint8Array);
+		assert.deepEqual(Buffer.from(image), png);
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("base64 decoders agree with Buffer for all padding lengths", () => {
+	const bytes = Buffer.from(Array.from({ length: 300 }, (_, i) => (i * 37) % 256));
+	for (let length = 0; length <= bytes.length; length++) {
+		const expected = bytes.subarray(0, length);
+		const padded = expected.toString("base64");
+		assert.deepEqual(Buffer.from(decodeBase64(padded)), expected);
+		assert.deepEqual(Buffer.from(_decodeBase64WithTable(padded)), expected);
+		assert.deepEqual(Buffer.from(_decodeBase64WithTable(padded.replace(/=+$/, ""))), expected);
+	}
+});
+
+test("LruCache evicts the least recently used entries beyond its size", () => {
+	const evicted = [];
+	const cache = new LruCache(10, (value) => value.length, (key) => evicted.push(key));
+	cache.set("a", "xxxx");
+	cache.set("b", "xxxx");
+	assert.equal(cache.get("a"), "xxxx");
+	cache.set("c", "xxxx");
+	assert.equal(cache.get("b"), undefined);
+	assert.equal(cache.get("a"), "xxxx");
+	assert.equal(cache.get("c"), "xxxx");
+	// An entry larger than the limit is kept until the next one arrives
+	cache.set("d", "x".repeat(20));
+	assert.equal(cache.get("d"), "x".repeat(20));
+	assert.equal(cache.get("a"), undefined);
+	assert.deepEqual(evicted, ["b", "a", "c"]);
+});
+
+test("LruCache keeps pinned entries", () => {
+	const pinned = new Set(["a"]);
+	const cache = new LruCache(10, (value) => value.length, undefined, (key) => pinned.has(key));
+	cache.set("a", "xxxx");
+	cache.set("b", "xxxx");
+	cache.set("c", "xxxx");
+	assert.equal(cache.get("a"), "xxxx");
+	assert.equal(cache.get("b"), undefined);
+	pinned.clear();
+	cache.set("d", "xxxx");
+	assert.equal(cache.get("c"), undefined);
+	assert.equal(cache.get("a"), "xxxx");
+});
+
+test("getFileUrl shares one object URL per path", async () => {
+	globalThis.window = {
+		globalContext: {
+			fileTree: {
+				"logo.svg": { mime_type: "image/svg+xml", base64encoded: false, blob: "abc" },
+			},
+			blobs: { abc: "<svg></svg>" },
+		},
+	};
+	try {
+		const url = await getFileUrl("logo.svg");
+		assert.match(url, /^blob:/);
+		assert.equal(await getFileUrl("logo.svg"), url);
+		assert.equal(await (await fetch(url)).text(), "<svg></svg>");
+		assert.equal(retainObjectUrls([url]), true);
+		assert.equal(retainObjectUrls(["blob:nodedata:unknown"]), false);
+		unpinObjectUrls();
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("getSearchIndex parses a marked search index once", async () => {
+	globalThis.window = {
+		globalContext: {
+			fileTree: {
+				"searchindex.js": { mime_type: "text/javascript", base64encoded: false, blob: "a", search_index: true },
+				"other.js": { mime_type: "text/javascript", base64encoded: false, blob: "b" },
+				"page.html": { mime_type: "text/html", base64encoded: false, blob: "c", summary: { blob: "d" } },
+			},
+			blobs: {
+				a: 'Search.setIndex({"docnames": ["index"], "terms": {"a)": 0}})\n',
+				b: "Search.setIndex({})",
+				c: "<p>Text</p>",
+				d: "Text",
+			},
+			summaries: true,
+		},
+	};
+	try {
+		const index = await getSearchIndex("searchindex.js");
+		assert.deepEqual(index, { docnames: ["index"], terms: { "a)": 0 } });
+		assert.equal(await getSearchIndex("searchindex.js"), index);
+		assert.equal(await getSearchIndex("other.js"), undefined);
+		assert.equal(await getPageSummary("page.html"), "Text");
+		assert.equal(await getPageSummary("other.js"), undefined);
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("getPageSummary reads summaries from the archive, and only if there are any", async () => {
+	// Decoded archive entries are cached by offset, so use fresh offsets
+	const page = Buffer.from("page".repeat(100));
+	const summary = Buffer.from("<p>Text</p>");
+	globalThis.window = {
+		zundlerArchive: Buffer.concat([page, summary]).toString("base64"),
+		globalContext: {
+			fileTree: {
+				"page.html": {
+					mime_type: "text/html",
+					base64encoded: false,
+					offset: 0,
+					length: page.length,
+					method: "store",
+					summary: { offset: page.length, length: summary.length, method: "store" },
+				},
+			},
+			summaries: true,
+		},
+	};
+	try {
+		assert.equal(await getPageSummary("page.html"), "<p>Text</p>");
+		// The iframe does not ask the parent document
+		window.globalContext = { summaries: false };
+		window.parent = {
+			postMessage: () => assert.fail("asked the parent"),
+		};
+		assert.equal(await getPageSummary("page.html"), undefined);
+	} finally {
+		delete globalThis.window;
+	}
+});
+
+test("getFile batches requests from the iframe to the parent", async () => {
+	const batches = [];
+	globalThis.DEBUG = false;
+	globalThis.window = {
+		globalContext: {},
+		parent: {
+			postMessage: (message, origin, [port]) => {
+				assert.equal(message.action, "connect");
+				port.onmessage = (event) => {
+					const requests = event.data.argument.requests;
+					batches.push(requests);
+					const files = requests.map(({ id, path }) => ({
+						id,
+						file: path === "missing.js" ? undefined : { data: `/* ${path} */`, mime_type: "text/javascript" },
+					}));
+					port.postMessage({ action: "sendFiles", argument: { files } });
+					port.close();
+				};
+			},
+		},
+	};
+	const warn = console.warn;
+	console.warn = () => {};
+	try {
+		const files = await Promise.all([getFile("a.js"), getFile("b.js"), getFile("a.js"), getFile("missing.js")]);
+		assert.deepEqual(
+			files.map((file) => file?.data),
+			["/* a.js */", "/* b.js */", "/* a.js */", undefined],
+		);
+		assert.equal(batches.length, 1);
+		assert.deepEqual(
+			batches[0].map((request) => request.path),
+			["a.js", "b.js", "missing.js"],
+		);
+	} finally {
+		console.warn = warn;
+		delete globalThis.window;
+		delete globalThis.DEBUG;
+	}
+});
+
+test("timeStage measures stages, including failed and asynchronous ones", async () => {
+	assert.equal(await timeStage("sync", () => 42), 42);
+	await timeStage("async", () => new Promise((resolve) => setTimeout(resolve, 20)));
+	await assert.rejects(
+		timeStage("failed", () => {
+			throw new Error("failed");
+		}),
+	);
+	performance.measure("not zundler", { start: 0, end: 1 });
+
+	const entries = performanceEntries();
+	assert.deepEqual(
+		entries.map((entry) => entry.name),
+		["sync", "async", "failed"],
+	);
+	assert.ok(entries[1].duration >= 15);
+	assert.ok(entries[0].start <= entries[1].start && entries[1].start <= entries[2].start);
+});
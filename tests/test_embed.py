@@ -1,15 +1,33 @@
 """Unit tests for the embed module."""
 
+import base64
+import io
+import json
+import os
+import re
+import struct
+import zlib
 from pathlib import Path
 
 import pytest
 
+from zundler import embed, extract, images
+from zundler.batch import embed_batch, load_manifest
+from zundler.cache import MemoryCache, PreparedCache
 from zundler.embed import (
+    CssAssetGraph,
+    DeflateWriter,
     embed_assets,
     embed_css_resources,
     extract_assets,
+    list_assets,
     load_filetree,
 )
+from zundler.minify import minify_css, minify_html, minify_js
+from zundler.prerender import BODY_SCRIPTS, HEAD_SCRIPTS, prerender
+from zundler.reachability import reachable_files
+from zundler.report import BuildReport
+from zundler.search import is_search_index, page_summary
 
 
 @pytest.fixture
@@ -106,6 +124,107 @@ class TestEmbedCssImport:
         assert b"base64" in result
 
 
+class TestEmbedCssUrls:
+    """url() tokens are rewritten in a single pass over the style sheet."""
+
+    @pytest.fixture
+    def theme_path(self, css_tree):
+        (css_tree / "bg.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 20)
+        (css_tree / "my font.woff2").write_bytes(b"wOF2" + b"\x00" * 20)
+        (css_tree / "my.font.woff2").write_bytes(b"wOF2" + b"\x00" * 20)
+        return str(css_tree / "styles" / "theme.css")
+
+    def test_urls_in_comments_and_strings_are_kept(self, theme_path):
+        css = b'/* url(../bg.png) */\na::after { content: "url(../bg.png)"; }\n'
+        assert embed_css_resources(css, theme_path) == css
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            b"../my\\ font.woff2",
+            b"../my\\20 font.woff2",
+            b"../my\\000020font.woff2",
+            # The whitespace after a hex escape is part of it
+            b"../my\\2e font.woff2",
+            b"../my\\2e\tfont.woff2",
+            b"../\\6D y\\2e font.woff2",
+        ],
+    )
+    def test_escaped_url(self, theme_path, url):
+        css = b"@font-face { src: url(%s) format('woff2'); }\n" % url
+        result = embed_css_resources(css, theme_path)
+
+        assert b'url("data:font/woff2;charset=utf-8;base64, ' in result
+        assert b"format('woff2')" in result
+
+    def test_fragment_and_external_urls_are_kept(self, theme_path):
+        css = b"a { fill: url(#gradient); background: url(https://example.com/x.png); }\n"
+        assert embed_css_resources(css, theme_path) == css
+
+    def test_many_urls(self, theme_path):
+        css = b"".join(b".icon-%d { background: url('../bg.png'); }\n" % i for i in range(500))
+        result = embed_css_resources(css, theme_path)
+
+        assert result.count(b"data:image/png") == 500
+        assert b"../bg.png" not in result
+
+    def test_import_with_media_query(self, css_tree):
+        theme_path = str(css_tree / "styles" / "theme.css")
+        css = b'@import url("../basic.css") screen and (min-width: 600px);\n'
+        result = embed_css_resources(css, theme_path)
+
+        assert result.startswith(b"@media screen and (min-width: 600px) {")
+        assert b"body { margin: 0; }" in result
+
+
+class TestCssAssetGraph:
+    """Resources shared between style sheets are resolved once."""
+
+    def test_shared_font_is_encoded_once(self, css_tree, monkeypatch):
+        (css_tree / "font.woff2").write_bytes(b"wOF2" + b"\x00" * 20)
+        (css_tree / "a.css").write_bytes(b'@font-face { src: url("font.woff2") format("woff2"); }\n')
+        (css_tree / "b.css").write_bytes(b"h1 { background: url(font.woff2); }\n")
+
+        calls = []
+        get_mime_type = embed.get_mime_type
+        monkeypatch.setattr(embed, "get_mime_type", lambda *args: calls.append(args) or get_mime_type(*args))
+
+        graph = CssAssetGraph()
+        for name in ["a.css", "b.css"]:
+            path = css_tree / name
+            result = embed_css_resources(path.read_bytes(), str(path), graph=graph)
+            assert b"data:font/" in result or b"data:application/" in result
+
+        assert len(calls) == 1
+        assert graph.dependencies(css_tree / "a.css") == {str(css_tree / "font.woff2")}
+
+    def test_import_cycle(self, css_tree):
+        (css_tree / "a.css").write_bytes(b'@import "styles/b.css";\na { color: red; }\n')
+        (css_tree / "styles" / "b.css").write_bytes(b'@import "../a.css";\nb { color: blue; }\n')
+
+        path = css_tree / "a.css"
+        graph = CssAssetGraph()
+        result = embed_css_resources(path.read_bytes(), str(path), graph=graph)
+
+        assert b"@import" not in result
+        assert b"a { color: red; }" in result
+        assert b"b { color: blue; }" in result
+        assert graph.dependencies(path) == {str(path), str(css_tree / "styles" / "b.css")}
+
+    def test_import_cycle_in_parallel(self, css_tree):
+        (css_tree / "a.css").write_bytes(b'@import "b.css";\na { color: red; }\n')
+        (css_tree / "b.css").write_bytes(b'@import "a.css";\nb { color: blue; }\n')
+        for i in range(20):
+            (css_tree / f"c{i}.css").write_bytes(b'@import "%s.css";\nc { color: green; }\n' % b"ab"[i % 2 : i % 2 + 1])
+
+        serial = load_filetree(str(css_tree))
+        for name in ["c0.css", "c1.css"]:
+            assert serial[name]["data"].count("a { color: red; }") == 1
+            assert serial[name]["data"].count("b { color: blue; }") == 1
+        for _ in range(5):
+            assert load_filetree(str(css_tree), jobs=8) == serial
+
+
 class TestFileTreeWithImport:
     """Integration test: verify basic.css content ends up in theme.css in the file tree."""
 
@@ -117,6 +236,730 @@ class TestFileTreeWithImport:
         assert "@import" not in theme_data
 
 
+class TestParallelFileTree:
+    """Preparing files in a worker pool must not change the result."""
+
+    def test_parallel_matches_serial(self, css_tree):
+        (css_tree / "index.html").write_text("<html><body>Hi</body></html>")
+        (css_tree / "bg.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 20)
+
+        serial = load_filetree(str(css_tree))
+        parallel = load_filetree(str(css_tree), jobs=4)
+
+        assert list(parallel) == list(serial)
+        assert parallel == serial
+
+
+class TestDeflateWriter:
+    """Streaming compression must produce one valid base64 string."""
+
+    def test_chunks_decode_to_input(self):
+        fp = io.StringIO()
+        writer = DeflateWriter(fp)
+        chunks = [f"chunk {i} " * (i * 37 % 1000) for i in range(200)]
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+
+        data = zlib.decompress(base64.b64decode(fp.getvalue(), validate=True))
+        assert data.decode() == "".join(chunks)
+
+    def test_compressed_bytes_are_attributed(self, monkeypatch):
+        report = BuildReport()
+        monkeypatch.setattr(zlib, "compress", None)
+        writer = DeflateWriter(io.StringIO(), report=report)
+        for i in range(200):
+            writer.write(os.urandom(i * 50).hex(), path=f"file{i}")
+        writer.close()
+
+        compressed = [report.files[f"file{i}"]["compressed"] for i in range(200)]
+        assert sum(compressed) <= writer.compressed_size < sum(compressed) + 200
+        # Random data does not compress, so large files get a large share
+        assert compressed[199] > compressed[100] > 0
+
+
+class TestPreparedCache:
+    """Unchanged files must be taken from the cache, changed ones prepared again."""
+
+    @pytest.fixture
+    def cache_dir(self, tmp_path_factory):
+        return tmp_path_factory.mktemp("cache")
+
+    def test_unchanged_files_are_not_prepared_again(self, css_tree, cache_dir, monkeypatch):
+        with PreparedCache(cache_dir) as cache:
+            first = load_filetree(str(css_tree), cache=cache)
+
+        def fail(filename, css_graph=None):
+            raise AssertionError(f"prepared again: {filename}")
+
+        monkeypatch.setattr(embed, "prepare_file", fail)
+        with PreparedCache(cache_dir) as cache:
+            second = load_filetree(str(css_tree), cache=cache)
+
+        assert second == first
+
+    def test_changed_import_invalidates_css(self, css_tree, cache_dir):
+        with PreparedCache(cache_dir) as cache:
+            load_filetree(str(css_tree), cache=cache)
+
+        (css_tree / "basic.css").write_bytes(b"body { margin: 1px; }\n")
+        with PreparedCache(cache_dir) as cache:
+            tree = load_filetree(str(css_tree), cache=cache)
+
+        assert "body { margin: 1px; }" in tree["styles/theme.css"]["data"]
+
+    def test_files_with_the_same_stat_are_not_read(self, css_tree, cache_dir):
+        basic_css = css_tree / "basic.css"
+        with PreparedCache(cache_dir) as cache:
+            load_filetree(str(css_tree), cache=cache)
+
+        # Rewritten with the same size and modification time
+        stat = basic_css.stat()
+        basic_css.write_bytes(b"body { margin: 1; }\n")
+        os.utime(basic_css, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        with PreparedCache(cache_dir) as cache:
+            assert load_filetree(str(css_tree), cache=cache)["basic.css"]["data"] == "body { margin: 0; }\n"
+
+    def test_file_changed_while_prepared(self, css_tree, cache_dir, monkeypatch):
+        basic_css = css_tree / "basic.css"
+        prepare_file = embed.prepare_file
+
+        def prepare_and_change(filename, **kwargs):
+            entry = prepare_file(filename, **kwargs)
+            if filename == basic_css.as_posix():
+                basic_css.write_bytes(b"body { margin: 1px; }\n")
+            return entry
+
+        with monkeypatch.context() as m, PreparedCache(cache_dir) as cache:
+            m.setattr(embed, "prepare_file", prepare_and_change)
+            assert load_filetree(str(css_tree), cache=cache)["basic.css"]["data"] == "body { margin: 0; }\n"
+
+        with PreparedCache(cache_dir) as cache:
+            assert load_filetree(str(css_tree), cache=cache)["basic.css"]["data"] == "body { margin: 1px; }\n"
+
+    def test_archive_compression_is_cached(self, css_tree, cache_dir):
+        embed_assets(str(css_tree / "basic.css"), output_path=io.StringIO(), cache_dir=cache_dir, archive=True)
+
+        with PreparedCache(cache_dir) as cache:
+            data = (css_tree / "basic.css").read_bytes()
+            assert cache.get_blob(f"deflate {embed.content_hash(data)}") == zlib.compress(data)
+
+    def test_files_prepared_in_advance(self, tmp_path, cache_dir, monkeypatch):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "index.html").write_text("<html><body>  Hi  </body></html>")
+        preparer = embed.BackgroundPreparer(cache_dir, jobs=2, minify=True)
+        preparer.submit(src / "index.html")
+        preparer.close()
+
+        def fail(filename, **kwargs):
+            raise AssertionError(f"prepared again: {filename}")
+
+        monkeypatch.setattr(embed, "prepare_file", fail)
+        output = io.StringIO()
+        embed_assets(str(src / "index.html"), output_path=output, cache_dir=cache_dir, minify=True)
+        assert output.getvalue()
+
+    def test_files_prepared_in_advance_in_memory(self, tmp_path, monkeypatch):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "index.html").write_text("<html><body>  Hi  </body></html>")
+        preparer = embed.BackgroundPreparer(None, minify=True)
+        preparer.submit(src / "index.html")
+        preparer.close()
+
+        def fail(filename, **kwargs):
+            raise AssertionError(f"prepared again: {filename}")
+
+        monkeypatch.setattr(embed, "prepare_file", fail)
+        output = io.StringIO()
+        embed_assets(str(src / "index.html"), output_path=output, cache=preparer.cache, minify=True)
+        assert output.getvalue()
+
+    def test_sphinx_build_uses_files_prepared_in_advance(self, tmp_path, monkeypatch):
+        application = pytest.importorskip("sphinx.application")
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "conf.py").write_text('extensions = ["zundler.sphinxext"]\n')
+        (src / "index.rst").write_text("Index\n=====\n\n.. toctree::\n\n   page\n")
+        (src / "page.rst").write_text("Page\n====\n\nHi\n")
+
+        caches = []
+        prepared_late = []
+        prepare_file = embed.prepare_file
+        bundle = embed.embed_assets
+
+        def record_prepare_file(filename, *args, **kwargs):
+            if caches:
+                prepared_late.append(Path(filename).name)
+            return prepare_file(filename, *args, **kwargs)
+
+        def record_embed_assets(*args, **kwargs):
+            caches.append(kwargs["cache"])
+            return bundle(*args, **kwargs)
+
+        monkeypatch.setattr(embed, "prepare_file", record_prepare_file)
+        monkeypatch.setattr(embed, "embed_assets", record_embed_assets)
+        build_dir = tmp_path / "_build"
+        (build_dir / "zundler").mkdir(parents=True)
+        app = application.Sphinx(src, src, build_dir / "zundler", build_dir / "doctrees", "zundler", status=None)
+        app.build()
+
+        assert (build_dir / "zundler" / "index.html").exists()
+        assert isinstance(caches[0], MemoryCache)
+        assert caches[0].hits >= 2
+        assert "index.html" not in prepared_late
+        assert "page.html" not in prepared_late
+
+    def test_eviction(self, css_tree, cache_dir):
+        with PreparedCache(cache_dir, max_size=0) as cache:
+            load_filetree(str(css_tree), cache=cache)
+
+        with PreparedCache(cache_dir) as cache:
+            assert cache.get(str(css_tree / "basic.css")) is None
+
+
+class TestDeduplication:
+    """Identical files must be stored once in the bundle."""
+
+    def test_identical_files_share_a_blob(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "_images").mkdir(parents=True)
+        (src / "_downloads").mkdir()
+        (src / "index.html").write_text("<html><body>Hi</body></html>")
+        png = b"\x89PNG\r\n\x1a\n" + b"\x01" * 20
+        (src / "_images" / "a.png").write_bytes(png)
+        (src / "_downloads" / "a.png").write_bytes(png)
+
+        bundle = tmp_path / "bundle.html"
+        embed_assets(str(src / "index.html"), output_path=str(bundle))
+
+        blob = re.search(r'window\.globalContext = "(?P<blob>[A-Za-z0-9/+=]+)"', bundle.read_text())["blob"]
+        context = json.loads(zlib.decompress(base64.b64decode(blob)))
+        file_tree = context["fileTree"]
+
+        assert file_tree["_images/a.png"]["blob"] == file_tree["_downloads/a.png"]["blob"]
+        assert len(context["blobs"]) == 2
+
+        out = tmp_path / "out"
+        extract_assets(str(bundle), output_path=str(out))
+        assert (out / "_images" / "a.png").read_bytes() == png
+        assert (out / "_downloads" / "a.png").read_bytes() == png
+
+
+class TestArchive:
+    """Archive mode compresses each unique file on its own."""
+
+    def test_archive_roundtrip(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "_images").mkdir(parents=True)
+        (src / "_downloads").mkdir()
+        (src / "index.html").write_text("<html><body>Hi</body></html>")
+        css = "body { color: red }\n" * 20
+        (src / "style.css").write_text(css)
+        png = b"\x89PNG\r\n\x1a\n" + b"\x01" * 20
+        (src / "_images" / "a.png").write_bytes(png)
+        (src / "_downloads" / "a.png").write_bytes(png)
+
+        bundle = tmp_path / "bundle.html"
+        embed_assets(str(src / "index.html"), output_path=str(bundle), archive=True)
+        html = bundle.read_text()
+
+        archive = re.search(r'window\.zundlerArchive = "(?P<archive>[A-Za-z0-9/+=]*)"', html)["archive"]
+        archive = base64.b64decode(archive)
+        blob = re.search(r'window\.globalContext = "(?P<blob>[A-Za-z0-9/+=]+)"', html)["blob"]
+        context = json.loads(zlib.decompress(base64.b64decode(blob)))
+        file_tree = context["fileTree"]
+
+        assert "blobs" not in context
+        assert file_tree["_images/a.png"]["offset"] == file_tree["_downloads/a.png"]["offset"]
+        entry = file_tree["style.css"]
+        assert entry["method"] == "deflate"
+        chunk = archive[entry["offset"] : entry["offset"] + entry["length"]]
+        assert zlib.decompress(chunk) == css.encode()
+        # Binary files in compressed formats are stored as raw bytes
+        entry = file_tree["_images/a.png"]
+        assert entry["method"] == "store"
+        assert archive[entry["offset"] : entry["offset"] + entry["length"]] == png
+
+        out = tmp_path / "out"
+        extract_assets(str(bundle), output_path=str(out))
+        assert (out / "_images" / "a.png").read_bytes() == png
+        assert (out / "_downloads" / "a.png").read_bytes() == png
+        assert (out / "style.css").read_text() == css
+
+    def test_binary_files_are_not_encoded(self, tmp_path, monkeypatch):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "index.html").write_text("<html><body>Hi</body></html>")
+        png = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+        (src / "a.png").write_bytes(png)
+        index = str(src / "index.html")
+        cache_dir = tmp_path / "cache"
+
+        with monkeypatch.context() as m:
+            m.setattr(base64, "b64decode", None)
+            # Once prepared, once from the cache
+            for name in ["first.html", "second.html"]:
+                embed_assets(index, output_path=str(tmp_path / name), archive=True, cache_dir=cache_dir)
+        embed_assets(index, output_path=str(tmp_path / "default.html"), cache_dir=cache_dir)
+
+        for name in ["first.html", "second.html", "default.html"]:
+            out = tmp_path / name.replace(".html", "")
+            extract_assets(str(tmp_path / name), output_path=str(out))
+            assert (out / "a.png").read_bytes() == png
+
+
+class TestPrerender:
+    """HTML pages can be rewritten when the bundle is built."""
+
+    PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<title>A &amp; B</title>
+<link rel="stylesheet" href="_static/style.css?v=1">
+<link rel="stylesheet" href="_static/print.css" media="print" type="text/css">
+<script src="_static/app.js" defer></script>
+<script>document.write("<img src='x.png'>")</script>
+</head>
+<body>
+<a href="other.html#part">Other</a>
+<a href="#top">Top</a>
+<a href="https://example.com">Elsewhere</a>
+<a name="anchor"></a>
+<img src="_images/a.png" alt="a"/>
+<form action="search.html" method="get"></form>
+</body>
+</html>
+"""
+
+    def test_prerender_rewrites_tags(self):
+        html, title = prerender(self.PAGE)
+
+        assert title == "A & B"
+        assert html.startswith("<!DOCTYPE html>\n<html>\n<head>" + HEAD_SCRIPTS)
+        assert html.endswith(BODY_SCRIPTS + "</body>\n</html>\n")
+        assert '<style data-zundler-inline="_static/style.css"></style>' in html
+        assert '<style data-zundler-inline="_static/print.css" media="print"></style>' in html
+        assert '<script data-zundler-inline="_static/app.js" defer></script>' in html
+        assert """<script>document.write("<img src='x.png'>")</script>""" in html
+        assert '<a href="other.html#part" onclick="virtualClick(event)">' in html
+        assert '<a href="about:srcdoc#top">' in html
+        assert '<a href="https://example.com" target="_blank">' in html
+        assert '<a name="anchor"></a>' in html
+        assert '<img alt="a" data-zundler-src="_images/a.png">' in html
+        assert '<form action="search.html" method="get" onsubmit="virtualClick(event)">' in html
+
+    def test_prerender_skips_fragments(self):
+        assert prerender("<p>No head or body</p>") is None
+
+    def test_prerendered_entry(self, tmp_path):
+        (tmp_path / "index.html").write_text(self.PAGE)
+        (tmp_path / "fragment.html").write_text("<p>Fragment</p>")
+
+        file_tree = load_filetree(tmp_path, prerender=True)
+
+        assert file_tree["index.html"]["prerendered"] is True
+        assert file_tree["index.html"]["title"] == "A & B"
+        assert "data-zundler-util" in file_tree["index.html"]["data"]
+        assert "prerendered" not in file_tree["fragment.html"]
+        assert file_tree["fragment.html"]["data"] == "<p>Fragment</p>"
+
+
+class TestMinify:
+    """HTML, CSS and JavaScript files can be minified before packing."""
+
+    def test_minify_html_keeps_pre_and_scripts(self):
+        html = (
+            "<html>\n  <!-- comment -->\n  <body>\n"
+            "    <pre>  a\n    b  </pre>\n"
+            "    <script>  if (a  <  b) {  }  </script>\n"
+            '    <p title="a  >  b">  x   y  </p>\n'
+            "  </body>\n</html>\n"
+        )
+
+        assert minify_html(html) == (
+            "<html>\n<body>\n<pre>  a\n    b  </pre>\n"
+            "<script>  if (a  <  b) {  }  </script>\n"
+            '<p title="a  >  b"> x y </p>\n</body>\n</html>\n'
+        )
+
+    def test_minify_css_keeps_strings_and_urls(self):
+        css = 'a , b {\n  color : red ;\n  background: url( "x y.png" ) ;\n}\n/* c */ .c { content: "a  ;  b" }'
+
+        assert minify_css(css) == 'a,b{color : red;background: url( "x y.png" )}.c{content: "a  ;  b"}'
+
+    @pytest.mark.parametrize(
+        ("css", "expected"),
+        [
+            # Compound selectors stay compound, descendant ones descendant
+            (".a/**/.b{color:red}", ".a.b{color:red}"),
+            (".a /**/ .b{color:red}", ".a .b{color:red}"),
+            ("a/**/:hover{color:red}", "a:hover{color:red}"),
+            # Tokens that would merge are kept apart
+            ("a{margin:1/**/px}", "a{margin:1 px}"),
+            ("a{margin:0/**/auto}", "a{margin:0 auto}"),
+            ("[a|/* x */=b]{color:red}", "[a| =b]{color:red}"),
+        ],
+    )
+    def test_minify_css_comments(self, css, expected):
+        assert minify_css(css) == expected
+
+    def test_minify_js_keeps_strings_and_regexes(self):
+        js = """// comment
+function f(a, b) {
+    /* block */
+    var re = /[/]'/g;  // trailing
+    var s = "// no comment", d = a / b / 2;
+    return `x ${ {a: 1}.a } /* y */`
+}
+"""
+
+        assert (
+            minify_js(js)
+            == """function f(a, b) {
+var re = /[/]'/g;
+var s = "// no comment", d = a / b / 2;
+return `x ${ {a: 1}.a } /* y */`
+}
+"""
+        )
+
+    def test_minified_files_are_skipped(self, tmp_path):
+        js = "var a  =  1;  // comment\n"
+        (tmp_path / "app.js").write_text(js)
+        (tmp_path / "lib.min.js").write_text(js)
+
+        file_tree = load_filetree(tmp_path, minify=True)
+
+        assert file_tree["app.js"]["data"] == "var a = 1;\n"
+        assert file_tree["lib.min.js"]["data"] == js
+
+
+class TestImageOptimizer:
+    """Images can be recompressed losslessly before packing."""
+
+    @pytest.fixture(autouse=True)
+    def without_pillow(self, monkeypatch):
+        monkeypatch.setattr(images, "Image", None)
+
+    @staticmethod
+    def png(*chunks):
+        return images.PNG_SIGNATURE + b"".join(images._png_chunk(chunk_type, body) for chunk_type, body in chunks)
+
+    def test_png_is_recompressed(self):
+        ihdr = (b"IHDR", bytes.fromhex("00000040 00000040 08 00 00 00 00"))
+        pixels = b"".join(b"\x00" + bytes(range(64)) for _ in range(64))
+        original = self.png(
+            ihdr,
+            (b"tEXt", b"Software\0Diagram tool"),
+            (b"IDAT", zlib.compress(pixels, 0)[:100]),
+            (b"IDAT", zlib.compress(pixels, 0)[100:]),
+            (b"IEND", b""),
+        )
+
+        result = images.optimize_png(original)
+
+        assert len(result) < len(original)
+        chunks = images._png_chunks(result)
+        assert [chunk_type for chunk_type, _ in chunks] == [b"IHDR", b"IDAT", b"IEND"]
+        assert zlib.decompress(chunks[1][1]) == pixels
+
+    def test_jpeg_metadata_is_stripped(self):
+        def segment(marker, body):
+            return bytes([0xFF, marker]) + struct.pack(">H", len(body) + 2) + body
+
+        def exif(orientation):
+            return b"Exif\0\0II*\0\x08\0\0\0\x01\0\x12\x01\x03\0\x01\0\0\0" + struct.pack("<HH", orientation, 0)
+
+        jfif = segment(0xE0, b"JFIF\0\x01\x01\0\0\x01\0\x01\0\0")
+        image_data = segment(0xDA, b"\x01\x01\0\0?\0") + b"\x12\x34\xff\xd9"
+
+        original = b"\xff\xd8" + jfif + segment(0xFE, b"comment") + segment(0xE1, exif(1)) + image_data
+        assert images.optimize_jpeg(original) == b"\xff\xd8" + jfif + image_data
+
+        rotated = b"\xff\xd8" + jfif + segment(0xE1, exif(6)) + image_data
+        assert images.optimize_jpeg(rotated) == rotated
+
+    def test_gif_comments_are_stripped(self):
+        header = b"GIF89a\x01\0\x01\0\x80\0\0" + b"\0\0\0\xff\xff\xff"
+        frame = b"\x2c\0\0\0\0\x01\0\x01\0\0\x02\x02\x44\x01\0"
+        comment = b"\x21\xfe\x07comment\0"
+
+        assert images.optimize_gif(header + comment + frame + b"\x3b") == header + frame + b"\x3b"
+
+    def test_results_are_cached_by_content(self, tmp_path, monkeypatch):
+        pixels = b"\x00\xff" * 100
+        image = self.png(
+            (b"IHDR", bytes.fromhex("000000c7 00000001 08 00 00 00 00")),
+            (b"IDAT", zlib.compress(pixels, 0)),
+            (b"IEND", b""),
+        )
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "a.png").write_bytes(image)
+        (src / "b.png").write_bytes(image)
+
+        calls = []
+        monkeypatch.setitem(images.OPTIMIZERS, "image/png", lambda data: calls.append(data) or data[:-1])
+        with PreparedCache(tmp_path / "cache") as cache:
+            file_tree = load_filetree(src, cache=cache, optimize_images=True)
+
+        assert len(calls) == 1
+        assert base64.b64decode(file_tree["b.png"]["data"]) == image[:-1]
+
+
+class TestTreeShaking:
+    """Only files reachable from the root document are packed."""
+
+    @pytest.fixture
+    def site(self, tmp_path):
+        files = {
+            "index.html": """<html><head>
+                <link rel="stylesheet" href="_static/style.css?v=1">
+                <script src="_static/searchtools.js"></script>
+                <style>body { background: url('_static/bg.png') }</style>
+                </head><body>
+                <a href="sub/">Sub</a>
+                <a href="https://example.com/other.html">External</a>
+                <img srcset="_images/a.png 1x, _images/a%402x.png 2x">
+                </body></html>""",
+            "sub/index.html": '<a href="../index.html#top">Up</a>',
+            "_static/style.css": "@import 'base.css'; div { background: url(div.png) }",
+            "_static/base.css": "",
+            "_static/bg.png": "",
+            "_static/div.png": "",
+            "_static/searchtools.js": "",
+            "searchindex.js": 'Search.setIndex({"docnames": ["index", "orphan"]})',
+            "orphan.html": "",
+            "_images/a.png": "",
+            "_images/a@2x.png": "",
+            "_static/mathjax/extension.js": "",
+            "_sources/index.rst.txt": "",
+            "objects.inv": "",
+        }
+        for name, content in files.items():
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).write_text(content)
+        return tmp_path
+
+    def test_reachable_files(self, site):
+        assert reachable_files(site, "index.html") == {
+            "index.html",
+            "sub/index.html",
+            "_static/style.css",
+            "_static/base.css",
+            "_static/bg.png",
+            "_static/div.png",
+            "_static/searchtools.js",
+            "searchindex.js",
+            "orphan.html",
+            "_images/a.png",
+            "_images/a@2x.png",
+        }
+
+    def test_unreachable_files_are_dropped(self, site, caplog):
+        with caplog.at_level("INFO"):
+            file_tree = load_filetree(site, root="index.html", keep=["_static/mathjax/*"])
+
+        assert "_static/mathjax/extension.js" in file_tree
+        assert "_sources/index.rst.txt" not in file_tree
+        assert "objects.inv" not in file_tree
+        assert "Dropped unreachable file: objects.inv [0 bytes]" in caplog.text
+
+
+class TestSearchAcceleration:
+    """Sphinx' search index and page summaries can be prepared ahead of time."""
+
+    PAGE = """<html><body>
+<div class="sidebar">Navigation</div>
+<div role="main">
+<section id="title">
+<h1>Title<a class="headerlink" href="#title">¶</a></h1>
+<p>Some <em>text</em> &amp; more.<br/></p>
+<script>let x = 1 < 2;</script><style>p { color: red }</style>
+<section id="usage"><h2>Usage</h2>
+<dl><dt id="api.run">run()</dt><dd><p>Runs <b>it</p></dd></dl>
+</section>
+</section>
+</div>
+</body></html>"""
+
+    SUMMARY = (
+        '<div role="main">\n<section id="title">\nTitle\nSome text &amp; more.\n\n'
+        '<section id="usage">Usage\n<div id="api.run">run()</div>Runs it\n</section>\n</section>\n</div>'
+    )
+
+    def test_is_search_index(self):
+        assert is_search_index('Search.setIndex({"docnames": ["index"]})\n')
+        assert not is_search_index("Search.setIndex({docnames: ['index']})")
+        assert not is_search_index("console.log(1)")
+
+    def test_page_summary(self):
+        assert page_summary(self.PAGE) == self.SUMMARY
+        assert page_summary("<p>No main content</p>") is None
+
+    def test_page_summary_keeps_anchors(self):
+        # What `Search.htmlToText(html, "#usage")` returns
+        sections = re.findall(r'<section id="usage">(.*?)</section>', page_summary(self.PAGE), re.DOTALL)
+        assert [re.sub("<[^>]*>", "", section) for section in sections] == ["Usage\nrun()Runs it\n"]
+
+    def test_search_entries(self, tmp_path):
+        (tmp_path / "searchindex.js").write_text('Search.setIndex({"docnames": ["page"]})')
+        (tmp_path / "page.html").write_text(self.PAGE)
+
+        file_tree = load_filetree(tmp_path, accelerate_search=True)
+
+        assert file_tree["searchindex.js"]["search_index"] is True
+        assert file_tree["page.html"]["summary"] == self.SUMMARY
+        assert "summary" not in load_filetree(tmp_path)["page.html"]
+
+    @pytest.mark.parametrize("archive", [False, True])
+    def test_summaries_are_stored_outside_the_index(self, tmp_path, archive):
+        (tmp_path / "index.html").write_text(self.PAGE)
+        bundle = tmp_path / "bundle.html"
+        embed_assets(str(tmp_path / "index.html"), output_path=str(bundle), archive=archive, accelerate_search=True)
+
+        html = bundle.read_text()
+        blob = re.search(r'window\.globalContext = "([^"]+)"', html)[1]
+        context = json.loads(zlib.decompress(base64.b64decode(blob)))
+        assert context["summaries"] is True
+        summary = context["fileTree"]["index.html"]["summary"]
+        if archive:
+            data = base64.b64decode(re.search(r'window\.zundlerArchive = "([^"]*)"', html)[1])
+            data = data[summary["offset"] : summary["offset"] + summary["length"]]
+            if summary["method"] == "deflate":
+                data = zlib.decompress(data)
+            assert data.decode() == self.SUMMARY
+        else:
+            assert context["blobs"][summary["blob"]] == self.SUMMARY
+
+
+class TestBuildReport:
+    """A build report records the timings of all stages and the size of each file."""
+
+    @pytest.fixture
+    def site(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "_static").mkdir(parents=True)
+        (src / "index.html").write_text("<html><body>Hi</body></html>")
+        (src / "_static" / "style.css").write_text("a { background: url(a.png) }\n")
+        (src / "_static" / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4)
+        (src / "copy.png").write_bytes((src / "_static" / "a.png").read_bytes())
+        return src
+
+    @pytest.mark.parametrize("archive", [False, True])
+    def test_report(self, site, tmp_path, archive):
+        report = BuildReport(top=2)
+        bundle = tmp_path / "bundle.html"
+        embed_assets(str(site / "index.html"), output_path=str(bundle), archive=archive, report=report)
+        result = report.to_dict()
+
+        assert {"walk", "read", "mime", "css", "serialize", "compress", "write"} <= set(result["stages"])
+        assert result["totals"]["files"] == 4
+        assert result["totals"]["output"] == bundle.stat().st_size
+
+        style = result["files"]["_static/style.css"]
+        assert style["raw"] == len("a { background: url(a.png) }\n")
+        assert style["css_inlined"] == style["encoded"] - style["raw"] > 1000
+        # Only one of the identical images adds to the payload
+        images = [result["files"][path]["compressed"] for path in ["copy.png", "_static/a.png"]]
+        assert images.count(0) == 1
+        totals = result["totals"]
+        assert totals["compressed"] > 0 and totals["runtime"] > 0
+        assert totals["compressed"] + totals["runtime"] < totals["output"]
+        # The common script is shipped once, outside the payload
+        assert bundle.read_text().count("sourceURL=zundler_common.js") == 1
+        assert "Heaviest files" in report.summary()
+
+        sizes = [size for _, size in result["top_files"]]
+        assert sizes == sorted(sizes, reverse=True) and len(sizes) == 2
+        assert result["top_directories"][0][0] == "_static"
+
+    def test_write(self, site, tmp_path):
+        report = BuildReport()
+        embed_assets(str(site / "index.html"), output_path=str(tmp_path / "bundle.html"), report=report)
+        report.write(tmp_path / "report.json")
+
+        assert json.loads((tmp_path / "report.json").read_text())["files"]["index.html"]["mime_type"] == "text/html"
+
+
+class TestBatch:
+    """Several documents must be bundled with a shared cache, each into its own file."""
+
+    @pytest.fixture
+    def sites(self, tmp_path):
+        sites = []
+        for language in ["en", "de"]:
+            src = tmp_path / language
+            (src / "_static").mkdir(parents=True)
+            (src / "index.html").write_text(f"<html lang='{language}'><body>Hi</body></html>")
+            (src / "_static" / "basic.css").write_text("body { margin: 0; }\n")
+            (src / "_static" / "theme.css").write_text('@import "basic.css";\n')
+            sites.append(src)
+        return sites
+
+    def test_identical_files_are_prepared_once(self, sites, monkeypatch):
+        cache = MemoryCache()
+        load_filetree(str(sites[0]), cache=cache)
+
+        def fail(filename, **kwargs):
+            raise AssertionError(f"prepared again: {filename}")
+
+        with monkeypatch.context() as m:
+            m.setattr(embed, "prepare_file", fail)
+            with pytest.raises(AssertionError, match=r"index\.html"):
+                load_filetree(str(sites[1]), cache=cache)
+
+        (sites[1] / "index.html").write_text((sites[0] / "index.html").read_text())
+        monkeypatch.setattr(embed, "prepare_file", fail)
+        assert load_filetree(str(sites[1]), cache=cache) == load_filetree(str(sites[0]), cache=cache)
+
+    def test_changed_import_is_a_miss(self, sites):
+        cache = MemoryCache()
+        load_filetree(str(sites[0]), cache=cache)
+
+        (sites[1] / "_static" / "basic.css").write_text("body { margin: 1px; }\n")
+        tree = load_filetree(str(sites[1]), cache=cache)
+        assert "margin: 1px" in tree["_static/theme.css"]["data"]
+
+    def test_embed_batch(self, sites, tmp_path):
+        manifest = tmp_path / "manifest.json"
+        manifest.write_text(json.dumps([{"input": "de/index.html", "output": "out/de.html"}]))
+        bundles = [(sites[0] / "index.html", None), *load_manifest(manifest)]
+
+        assert embed_batch(bundles, jobs=2) == []
+        assert (sites[0] / "SELF_CONTAINED_index.html").exists()
+        assert (tmp_path / "out" / "de.html").exists()
+
+    def test_failures_are_returned(self, sites, tmp_path):
+        missing = tmp_path / "missing" / "index.html"
+        assert embed_batch([(missing, None), (sites[0] / "index.html", None)]) == [missing]
+        assert (sites[0] / "SELF_CONTAINED_index.html").exists()
+
+
+class TestOutput:
+    """The bundle must only be replaced once it is complete."""
+
+    def test_failed_build_keeps_old_output(self, tmp_path, monkeypatch):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "index.html").write_text("<html><body>Hi</body></html>")
+        bundle = tmp_path / "bundle.html"
+        bundle.write_text("previous bundle")
+
+        def fail(filename, **kwargs):
+            raise RuntimeError(f"cannot prepare {filename}")
+
+        monkeypatch.setattr(embed, "prepare_file", fail)
+        with pytest.raises(RuntimeError):
+            embed_assets(str(src / "index.html"), output_path=str(bundle))
+
+        assert bundle.read_text() == "previous bundle"
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["bundle.html", "src"]
+
+
 class TestExtractAssets:
     """Round-trip: a file produced by embed_assets must be extractable."""
 
@@ -142,3 +985,56 @@ class TestExtractAssets:
         assert (out / "a.png").read_bytes() == b"\x89PNG\r\n\x1a\n" + b"\x00" * 20
         assert (out / "index.html").exists()
         assert (out / "file_tree.json").exists()
+
+    @pytest.fixture
+    def bundle(self, tmp_path, request):
+        src = tmp_path / "src"
+        (src / "_static").mkdir(parents=True)
+        (src / "index.html").write_text("<html><body>" + "Hi " * 100 + "</body></html>")
+        (src / "_static" / "basic.css").write_text("body { margin: 0; }\n" * 10)
+        (src / "_static" / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(range(256)))
+        (src / "copy.png").write_bytes((src / "_static" / "a.png").read_bytes())
+        bundle = tmp_path / "bundle.html"
+        embed_assets(str(src / "index.html"), output_path=str(bundle), archive=request.param)
+        return bundle
+
+    @pytest.mark.parametrize("bundle", [False, True], indirect=True)
+    def test_selective_extraction(self, bundle, tmp_path, monkeypatch):
+        # Small chunks, so files and lines span several of them
+        monkeypatch.setattr(extract, "CHUNK_SIZE", 7)
+        out = tmp_path / "out"
+        extract_assets(str(bundle), output_path=str(out), include=["_static/*", "*.html"], exclude=["*.css"])
+
+        assert sorted(path.relative_to(out).as_posix() for path in out.rglob("*.*")) == [
+            "_static/a.png",
+            "file_tree.json",
+            "index.html",
+        ]
+        assert (out / "_static" / "a.png").read_bytes() == (bundle.parent / "src" / "copy.png").read_bytes()
+        assert (out / "index.html").read_text().startswith("<html>")
+
+    @pytest.mark.parametrize("bundle", [False, True], indirect=True)
+    def test_list_assets(self, bundle):
+        assert list_assets(str(bundle), exclude=["index.html"]) == [
+            ("_static/a.png", 264),
+            ("_static/basic.css", 200),
+            ("copy.png", 264),
+        ]
+
+    @pytest.mark.parametrize("bundle", [False], indirect=True)
+    def test_unselected_files_are_not_decoded(self, bundle, tmp_path, monkeypatch):
+        decoded = []
+        decode = extract._decode
+        monkeypatch.setattr(extract, "_decode", lambda data, entry: decoded.append(data) or decode(data, entry))
+
+        assert [path for path, _ in list_assets(str(bundle), include=["*.css"])] == ["_static/basic.css"]
+        assert decoded == []
+
+        extract_assets(str(bundle), output_path=str(tmp_path / "out"), include=["*.css"])
+        assert decoded == ["body { margin: 0; }\n" * 10]
+
+    @pytest.mark.parametrize("bundle", [True], indirect=True)
+    def test_listing_does_not_read_the_archive(self, bundle, monkeypatch):
+        monkeypatch.setattr(extract, "_iter_archive", None)
+
+        assert list_assets(str(bundle), include=["*.png"]) == [("_static/a.png", 264), ("copy.png", 264)]